@@ -1,99 +1,275 @@
-from flask import Flask, render_template, request, jsonify, redirect
-from pymongo import MongoClient
+from flask import Blueprint, Flask, current_app, g, render_template, request, jsonify, redirect, url_for, Response
 import gridfs
 from bson.objectid import ObjectId
-import io
-from base64 import b64encode
-import torch
-import torchvision.models as models
-import torchvision.transforms as transforms
-from PIL import Image
-import numpy as np
+from bson.errors import InvalidId
+import hashlib
+import mimetypes
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 import os
+import time
 
-app = Flask(__name__)
+from config import Config, mongo_client
+from embedding_codec import decode_embedding, encode_embedding
+from embedding_service import configure_embedding_model, preload_embedding_model, service_from_env
+import metrics
+from neighbors import enqueue_neighbor_update
+from perceptual_hash import (
+    HASH_FIELDS, MATCH_DISTANCE, PosterHashIndex, confirm_duplicates, poster_hashes, resolve_duplicates,
+)
+from poster_derivatives import release_poster, store_derivatives
+from query_cache import cache_from_env
+from recommendations import MAX_RECOMMENDATIONS, build_filter, parse_embedding, recommend
+from search_backends import backend_from_env
+from text_index import TextIndex, reciprocal_rank_fusion
 
-# --- Connexion à MongoDB ---
-try:
-    # Pour se connecter au cluster sharded avec réplica, ajoutez l'option replicaSet si nécessaire
-    client = MongoClient("mongodb://localhost:27017/")
-    db = client["movie_database"]
+views = Blueprint("cinematch", __name__)
+
+# --- Ressources partagées par les routes ---
+# Créées par create_app (et la connexion MongoDB recréée dans chaque worker après le fork,
+# voir gunicorn.conf.py) plutôt qu'à l'import du module.
+client = db = movies_collection = neighbors_collection = neighbor_updates = fs = None
+embedding_service = search_index = text_index = poster_hash_index = query_cache = profiler = None
+
+# Les films ajoutés par scrap.py (autre processus) sont récupérés par les index au plus tard
+# toutes les INDEX_REFRESH_INTERVAL secondes.
+INDEX_REFRESH_INTERVAL = float(os.environ.get("INDEX_REFRESH_INTERVAL", 60))
+# Délai (secondes) conseillé aux clients dans Retry-After quand l'inférence est saturée
+EMBEDDING_RETRY_AFTER = int(os.environ.get("EMBEDDING_RETRY_AFTER", 5))
+
+def connect_mongo(config):
+    """(Re)crée le client MongoDB et les collections utilisées par les routes."""
+    global client, db, movies_collection, neighbors_collection, neighbor_updates, fs
+    # Pour se connecter au cluster sharded avec réplica, ajoutez l'option replicaSet à MONGO_URI
+    client = mongo_client(config)
+    db = client[config["MONGO_DB"]]
     movies_collection = db["movies"]
+    # Films similaires précalculés par neighbors.py, et file des éditions/suppressions à lui signaler
+    neighbors_collection = db["movie_neighbors"]
+    neighbor_updates = db["neighbor_updates"]
     fs = gridfs.GridFS(db)
+    # Après un fork, l'index relit encore la collection (re-ranking "mongo", routage des shards)
+    if search_index is not None:
+        search_index.bind_collection(movies_collection)
     print("Connected to MongoDB")
-except Exception as e:
-    print(f"Error connecting to MongoDB: {e}")
-    exit()
-
-# --- Initialisation du modèle ResNet pour générer les embeddings ---
-model = models.resnet18(pretrained=True)
-model.eval()
-embedding_model = torch.nn.Sequential(*list(model.children())[:-1])
-preprocess = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
-
-def generate_embedding(image_bytes):
-    """Génère un embedding à partir des bytes d'une image."""
-    try:
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        input_tensor = preprocess(image).unsqueeze(0)
-        with torch.no_grad():
-            embedding = embedding_model(input_tensor)
-        embedding = embedding.squeeze().numpy().flatten()
-        return embedding
-    except Exception as e:
-        print(f"Error generating embedding: {e}")
+
+def create_app(config_object=Config):
+    """Fabrique de l'application : flask --app app run, ou gunicorn -c gunicorn.conf.py."""
+    global embedding_service, search_index, text_index, poster_hash_index, query_cache, profiler
+    app = Flask(__name__)
+    app.config.from_object(config_object)
+    connect_mongo(app.config)
+
+    # --- Service d'embeddings ---
+    # Le modèle ResNet est chargé à la première requête qui en a besoin, ou ici avec PRELOAD_MODEL
+    # (gunicorn --preload : chargé une fois dans le maître, partagé en copy-on-write par les workers).
+    # Les requêtes concurrentes sont regroupées en micro-lots par un worker unique.
+    configure_embedding_model(weights_path=app.config["EMBEDDING_WEIGHTS_PATH"])
+    if app.config["PRELOAD_MODEL"]:
+        preload_embedding_model()
+    embedding_service = service_from_env()
+
+    # --- Index vectoriel résident ---
+    # Les embeddings sont chargés une seule fois en mémoire.
+    # Le type d'index (exact, flat, ivfpq, hnsw) est choisi par SEARCH_BACKEND, voir search_backends.py.
+    search_index = backend_from_env(dim=512)
+    search_index.bind_collection(movies_collection)
+    # --- Index texte (BM25) ---
+    # title, overview, genres et cast indexés en mémoire ; mis à jour par edit/delete,
+    # les insertions de scrap.py sont récupérées comme pour l'index vectoriel.
+    text_index = TextIndex()
+    # --- Empreintes des posters (pHash/dHash) ---
+    # Une affiche du catalogue envoyée telle quelle (ou recompressée) est reconnue sans passer par le CNN.
+    poster_hash_index = PosterHashIndex()
+    if app.config["LOAD_INDEXES"]:
+        try:
+            print(f"Loaded {search_index.load_from_collection(movies_collection)} embeddings into the search index")
+        except Exception as e:
+            print(f"Error loading the search index: {e}")
+        try:
+            print(f"Indexed {text_index.load_from_collection(movies_collection)} movies for text search")
+        except Exception as e:
+            print(f"Error loading the text index: {e}")
+        try:
+            print(f"Loaded {poster_hash_index.load_from_collection(movies_collection)} poster hashes")
+        except Exception as e:
+            print(f"Error loading the poster hash index: {e}")
+
+    # --- Cache des requêtes par poster ---
+    # Une même affiche renvoyée (retry, rafraîchissement, image populaire) ne repasse ni par
+    # le modèle ni par l'index : clé = sha256 des octets, top-k invalidé par search_index.version.
+    query_cache = cache_from_env()
+
+    # --- Mesures ---
+    # Histogrammes par étape et par route sur /metrics, en-têtes Server-Timing, et profileur
+    # par échantillonnage pilotable par /debug/profiler quand PROFILER_ENABLED=1.
+    metrics.Gauge("cinematch_embedding_queue_depth", "Images waiting for the inference worker.",
+                  lambda: embedding_service.stats()["queue_depth"])
+    metrics.Gauge("cinematch_search_index_size", "Embeddings in the resident search index.", lambda: len(search_index))
+    metrics.Gauge("cinematch_text_index_size", "Movies in the BM25 text index.", lambda: len(text_index))
+    metrics.Gauge("cinematch_poster_hash_index_size", "Posters in the perceptual hash index.",
+                  lambda: len(poster_hash_index))
+    profiler = metrics.SamplingProfiler(interval=app.config["PROFILER_INTERVAL_MS"] / 1000)
+
+    app.register_blueprint(views)
+    return app
+
+@views.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.start_trace()
+
+@views.after_app_request
+def record_request_timing(response):
+    """Latence par route (jusqu'au retour de la vue) ; Server-Timing si TRACE_HEADERS ou X-Trace: 1."""
+    trace = metrics.end_trace()
+    if "request_started" not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_started
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint or "not_found",
+                                    method=request.method, status=response.status_code)
+    if current_app.config["TRACE_HEADERS"] or request.headers.get("X-Trace") == "1":
+        response.headers["Server-Timing"] = metrics.server_timing(trace, total=elapsed)
+    return response
+
+@views.route('/metrics')
+def prometheus_metrics():
+    """Histogrammes par étape et par route au format texte Prometheus (propres à ce worker)."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@views.route('/debug/profiler', methods=['GET', 'POST'])
+def sampling_profiler():
+    """POST action=start|stop active ou arrête le profileur ; GET renvoie les piles repliées (flamegraph)."""
+    if not current_app.config["PROFILER_ENABLED"]:
+        return "Not found", 404
+    if request.method == 'POST':
+        action = request.values.get('action')
+        if action == 'start':
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        else:
+            return jsonify({"error": "action must be start or stop"}), 400
+        return jsonify(profiler.stats())
+    return Response(profiler.collapsed(), mimetype="text/plain")
+
+# Un poster n'est jamais modifié sur place (une nouvelle affiche = un nouveau fichier GridFS),
+# le navigateur peut donc le garder en cache aussi longtemps que l'on veut.
+POSTER_CACHE_MAX_AGE = 365 * 24 * 3600
+
+def poster_url(movie, size=None):
+    """URL du poster d'un film servie par la route /poster, ou None s'il n'en a pas.
+
+    size choisit une déclinaison (thumb, medium, thumb_webp...) ; tant qu'elle n'a pas été
+    générée (voir poster_derivatives.py), l'original est servi à la place."""
+    variant = (movie.get("poster_variants") or {}).get(size) if size else None
+    if variant:
+        return url_for('cinematch.poster', image_id=str(variant))
+    if not movie.get("image_id"):
+        return None
+    return url_for('cinematch.poster', image_id=str(movie["image_id"]))
+
+def poster_srcset(movie, webp=False):
+    """srcset 1x/2x des vignettes pour les écrans haute densité (None si elles manquent)."""
+    suffix = "_webp" if webp else ""
+    variants = movie.get("poster_variants") or {}
+    if not (variants.get(f"thumb{suffix}") and variants.get(f"medium{suffix}")):
         return None
+    return f"{poster_url(movie, 'thumb' + suffix)} 1x, {poster_url(movie, 'medium' + suffix)} 2x"
 
-def cosine_similarity(a, b):
-    """Calcule la similarité cosinus entre deux vecteurs."""
-    dot = np.dot(a, b)
-    norm_a = np.linalg.norm(a)
-    norm_b = np.linalg.norm(b)
-    if norm_a == 0 or norm_b == 0:
-        return 0.0
-    return dot / (norm_a * norm_b)
+def poster_etag(grid_out):
+    """ETag d'un poster GridFS, le même pour app.py et async_app.py."""
+    # Le md5 n'est plus calculé par les versions récentes de GridFS : l'id du fichier suffit
+    return getattr(grid_out, "md5", None) or f"{grid_out._id}-{grid_out.length}"
 
-@app.route('/')
+@views.route('/poster/<image_id>')
+def poster(image_id):
+    """Diffuse un poster GridFS par morceaux, avec cache HTTP, requêtes conditionnelles et Range."""
+    try:
+        with metrics.stage("gridfs_open"):
+            grid_out = fs.get(ObjectId(image_id))
+    except (InvalidId, gridfs.errors.NoFile):
+        return "Poster not found", 404
+
+    mimetype = grid_out.content_type or mimetypes.guess_type(grid_out.filename or "")[0] or "image/jpeg"
+    response = Response(
+        wrap_file(request.environ, grid_out, buffer_size=grid_out.chunk_size),
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
+    response.content_length = grid_out.length
+    response.set_etag(poster_etag(grid_out))
+    response.last_modified = grid_out.upload_date
+    response.cache_control.public = True
+    response.cache_control.max_age = POSTER_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=grid_out.length)
+
+# --- Pagination et projections ---
+# Les pages ne lisent que les champs affichés : jamais l'embedding (2 Ko par film).
+PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+LISTING_PROJECTION = {"title": 1, "overview": 1, "image_id": 1, "poster_variants": 1, "genres": 1, "release_year": 1}
+DETAIL_PROJECTION = {"embedding": 0}
+
+def find_movie(movie_id, projection=None):
+    """Récupère un film par son ObjectId (lookup indexé sur _id), ou None si l'id est invalide ou inconnu."""
+    try:
+        return movies_collection.find_one({"_id": ObjectId(movie_id)}, projection)
+    except InvalidId:
+        return None
+
+@views.route('/')
 def index():
-    movies = list(movies_collection.find())
+    """Liste paginée par curseur : ?after=<_id du dernier film affiché>&limit=N."""
+    limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    cursor = request.args.get('after')
+    query = {}
+    if cursor:
+        try:
+            query["_id"] = {"$gt": ObjectId(cursor)}
+        except InvalidId:
+            return "Invalid cursor", 400
+
+    # On demande un film de plus pour savoir s'il existe une page suivante
+    with metrics.stage("mongo_find"):
+        movies = list(movies_collection.find(query, LISTING_PROJECTION).sort("_id", 1).limit(limit + 1))
+    next_cursor = str(movies[limit - 1]["_id"]) if len(movies) > limit else None
     movie_list = []
-    for movie in movies:
-        poster_data = None
-        if movie.get("image_id"):
-            try:
-                grid_out = fs.get(ObjectId(movie["image_id"]))
-                poster_data = b64encode(grid_out.read()).decode('utf-8')
-            except Exception as e:
-                print(f"Error getting poster for {movie.get('title', 'No title')}: {e}")
+    for movie in movies[:limit]:
         movie_list.append({
+            "id": str(movie["_id"]),
             "title": movie.get("title", "No title"),
             "overview": movie.get("overview", "No overview available"),
-            "poster_data": poster_data,
+            "poster_url": poster_url(movie, "thumb"),
+            "poster_srcset": poster_srcset(movie),
+            "poster_webp_srcset": poster_srcset(movie, webp=True),
+            "genres": movie.get("genres", []),
+            "year": movie.get("release_year") or "",
         })
-    return render_template('index.html', movies=movie_list)
-
-@app.route('/movie/<int:movie_index>')
-def movie_detail(movie_index):
-    movies = list(movies_collection.find())
-    if 0 <= movie_index < len(movies):
-        movie = movies[movie_index]
-        poster_data = None
-        if movie.get("image_id"):
-            try:
-                grid_out = fs.get(ObjectId(movie["image_id"]))
-                poster_data = b64encode(grid_out.read()).decode('utf-8')
-            except Exception as e:
-                print(f"Error getting poster for {movie.get('title', 'No title')}: {e}")
-        return render_template('movie_detail.html', movie={
+    with metrics.stage("render_template"):
+        return render_template('index.html', movies=movie_list, cursor=cursor, next_cursor=next_cursor, limit=limit)
+
+@views.route('/movie/<movie_id>')
+def movie_detail(movie_id):
+    with metrics.stage("mongo_find"):
+        movie = find_movie(movie_id, DETAIL_PROJECTION)
+    if movie:
+        # Une lecture par _id : titres et vignettes sont recopiés dans la liste de voisins
+        with metrics.stage("mongo_neighbors"):
+            neighbors = neighbors_collection.find_one({"_id": movie["_id"]}, {"neighbors": 1}) or {}
+        related = [
+            {
+                "id": str(entry["id"]),
+                "title": entry.get("title", "No title"),
+                "poster_url": url_for('cinematch.poster', image_id=entry["poster_id"]) if entry.get("poster_id") else None,
+                "similarity": entry["score"],
+            } for entry in neighbors.get("neighbors", [])
+        ]
+        return render_template('movie_detail.html', related=related, movie={
             "title": movie.get("title", "No title"),
             "overview": movie.get("overview", "No overview available"),
-            "poster_data": poster_data,
+            "poster_url": poster_url(movie),
             "release_date": movie.get("release_date", "N/A"),
             "runtime": movie.get("runtime", "N/A"),
             "status": movie.get("status", "N/A"),
@@ -105,7 +281,75 @@ def movie_detail(movie_index):
     else:
         return "Movie not found", 404
 
-@app.route('/search_by_poster', methods=['POST'])
+def duplicate_hits(image_bytes, k):
+    """Top-k d'une affiche (quasi) identique à un poster du catalogue, sans le CNN ; None sinon.
+
+    Le film reconnu vient en tête, suivi de ses voisins précalculés (neighbors.py), ou à
+    défaut d'une recherche dans l'index avec son embedding stocké."""
+    with metrics.stage("perceptual_hash"):
+        matches = poster_hash_index.match(poster_hashes(image_bytes), MATCH_DISTANCE)
+    if not matches:
+        return None
+    movie_id = matches[0][0]
+    with metrics.stage("mongo_neighbors"):
+        neighbors = neighbors_collection.find_one({"_id": ObjectId(movie_id)}, {"neighbors.id": 1, "neighbors.score": 1})
+    entries = (neighbors or {}).get("neighbors", [])
+    if len(entries) >= k - 1:
+        return [(movie_id, 1.0)] + [(str(entry["id"]), entry["score"]) for entry in entries[:k - 1]]
+    with metrics.stage("mongo_find"):
+        movie = find_movie(movie_id, {"embedding": 1})
+    if not movie or movie.get("embedding") is None:
+        return None
+    with metrics.stage("vector_search"):
+        return search_index.search(decode_embedding(movie["embedding"]), k=k)
+
+def poster_hits(image_bytes, k):
+    """Top-k (movie_id, similarité) pour une affiche, via le cache de requêtes ; None si l'embedding échoue.
+
+    Lève TimeoutError si le worker d'inférence ne rend pas l'embedding à temps."""
+    with metrics.stage("index_refresh"):
+        search_index.refresh_if_stale(movies_collection, INDEX_REFRESH_INTERVAL)
+        poster_hash_index.refresh_if_stale(movies_collection, INDEX_REFRESH_INTERVAL)
+    index_version = search_index.version
+    with metrics.stage("query_cache"):
+        cache_key = query_cache.key(image_bytes)
+        hits = query_cache.get_results(cache_key, index_version, k)
+    if hits is None:
+        hits = duplicate_hits(image_bytes, k)
+        if hits is not None:
+            query_cache.put_results(cache_key, index_version, k, hits)
+            return hits
+        with metrics.stage("query_cache"):
+            query_embedding = query_cache.get_embedding(cache_key)
+        if query_embedding is None:
+            # Décodage, attente du micro-lot et inférence, vus depuis la requête
+            with metrics.stage("embedding"):
+                query_embedding = embedding_service.embed(image_bytes)
+            if query_embedding is None:
+                return None
+            query_cache.put_embedding(cache_key, query_embedding)
+        with metrics.stage("vector_search"):
+            hits = search_index.search(query_embedding, k=k)
+        query_cache.put_results(cache_key, index_version, k, hits)
+    return hits
+
+@metrics.stage("mongo_hydrate")
+def hydrate(hits):
+    """Une seule requête $in pour charger les films des résultats, sans relire les embeddings."""
+    movies = movies_collection.find(
+        {"_id": {"$in": [ObjectId(movie_id) for movie_id, _ in hits]}},
+        {"embedding": 0}
+    )
+    return {str(m["_id"]): m for m in movies}
+
+def embedding_unavailable():
+    """503 quand le worker d'inférence n'a pas rendu l'embedding à temps : le client peut réessayer."""
+    metrics.EMBEDDING_TIMEOUTS.inc(endpoint=request.endpoint)
+    response = jsonify({"error": "Embedding service is overloaded, retry later"})
+    response.headers["Retry-After"] = str(EMBEDDING_RETRY_AFTER)
+    return response, 503
+
+@views.route('/search_by_poster', methods=['POST'])
 def search_by_poster():
     """
     Reçoit une image via une requête POST, calcule son embedding,
@@ -114,52 +358,158 @@ def search_by_poster():
     if 'poster' not in request.files:
         return jsonify({"error": "No poster file provided"}), 400
     file = request.files['poster']
-    image_bytes = file.read()
-    query_embedding = generate_embedding(image_bytes)
-    if query_embedding is None:
+    try:
+        hits = poster_hits(file.read(), k=5)
+    except TimeoutError:
+        return embedding_unavailable()
+    if hits is None:
         return jsonify({"error": "Error generating embedding"}), 500
 
-    # On récupère tous les films qui ont un embedding stocké
-    movies = list(movies_collection.find({"embedding": {"$ne": None}}))
-    results = []
-    for movie in movies:
-        emb = movie.get("embedding")
-        if emb is not None:
-            sim = cosine_similarity(np.array(query_embedding), np.array(emb))
-            results.append((sim, movie))
-    
-    # Trier par similarité décroissante et retourner par exemple les 5 premiers résultats
-    results.sort(key=lambda x: x[0], reverse=True)
-    
-    # Modification ici pour inclure les données du poster
+    movies_by_id = hydrate(hits)
+
     top_results = [
         {
-            "title": m.get("title", "No title"), 
-            "similarity": s,
-            "poster_data": m.get("poster_data", ""),  # Ajout des données de poster
-            "overview": m.get("overview", "")  # Optionnel, mais utile
-        } for s, m in results[:5]
+            "id": movie_id,
+            "title": movies_by_id[movie_id].get("title", "No title"),
+            "year": movies_by_id[movie_id].get("release_year") or "",
+            "similarity": similarity,
+            "poster_url": poster_url(movies_by_id[movie_id], "thumb"),
+            "overview": movies_by_id[movie_id].get("overview", "")  # Optionnel, mais utile
+        } for movie_id, similarity in hits if movie_id in movies_by_id
     ]
-    
+
     return jsonify(top_results)
 
-# Vous pouvez ajouter d'autres routes (/movies, /scrape_movies, /recommendations, /stats, etc.) selon les besoins.
+@views.route('/search', methods=['GET', 'POST'])
+def search():
+    """
+    Recherche texte (BM25) sur le titre, le synopsis, les genres et le casting : ?q=...&k=10.
+    Si une affiche est aussi envoyée (POST multipart, champ 'poster'), les classements
+    texte et image sont fusionnés par reciprocal rank fusion.
+    """
+    query = (request.values.get('q') or '').strip()
+    poster = request.files.get('poster')
+    if not query and not poster:
+        return jsonify({"error": "q or poster is required"}), 400
+    k = min(max(request.values.get('k', 10, type=int), 1), MAX_PAGE_SIZE)
+
+    rankings = []
+    text_scores = {}
+    if query:
+        with metrics.stage("text_search"):
+            text_index.refresh_if_stale(movies_collection, INDEX_REFRESH_INTERVAL)
+            # Chaque classement est pris plus large que k pour que la fusion ait de la marge
+            text_hits = text_index.search(query, k=k * 2 if poster else k)
+        text_scores = dict(text_hits)
+        rankings.append(text_hits)
+    poster_scores = {}
+    if poster:
+        try:
+            image_hits = poster_hits(poster.read(), k=k * 2 if query else k)
+        except TimeoutError:
+            return embedding_unavailable()
+        if image_hits is None:
+            return jsonify({"error": "Error generating embedding"}), 500
+        poster_scores = dict(image_hits)
+        rankings.append(image_hits)
+
+    hits = reciprocal_rank_fusion(rankings, k=k) if len(rankings) > 1 else rankings[0]
+    movies_by_id = hydrate(hits)
+    return jsonify({
+        "mode": "hybrid" if len(rankings) > 1 else "text" if query else "poster",
+        "results": [
+            {
+                "id": movie_id,
+                "title": movies_by_id[movie_id].get("title", "No title"),
+                "overview": movies_by_id[movie_id].get("overview", ""),
+                "poster_url": poster_url(movies_by_id[movie_id], "thumb"),
+                "genres": movies_by_id[movie_id].get("genres", []),
+                "score": score,
+                "text_score": text_scores.get(movie_id),
+                "similarity": poster_scores.get(movie_id),
+            } for movie_id, score in hits if movie_id in movies_by_id
+        ],
+    })
+
+@views.route('/stats/embeddings')
+def embedding_stats():
+    """Profondeur de file et tailles de lot du service d'embeddings."""
+    return jsonify(embedding_service.stats())
+
+@views.route('/stats/cache')
+def cache_stats():
+    """Taux de succès et évictions du cache des requêtes par poster."""
+    return jsonify(query_cache.stats())
+
+@views.route('/recommendations', methods=['GET', 'POST'])
+def recommendations():
+    """
+    Films similaires à un film (movie_id) ou à un embedding, filtrables par genres,
+    plage de release_year (year_min/year_max) et original_language.
+    POST : corps JSON ; GET : query string (?movie_id=...&genres=Drama&genres=Comedy).
+    """
+    if request.method == 'POST':
+        params = request.get_json(silent=True) or {}
+        genres = params.get('genres')
+    else:
+        params = request.args
+        genres = request.args.getlist('genres')
+    if isinstance(genres, str):
+        genres = [genres]
+    movie_id = params.get('movie_id')
+    embedding = params.get('embedding')
+    if not movie_id and not embedding:
+        return jsonify({"error": "movie_id or embedding is required"}), 400
+    try:
+        k = min(max(int(params.get('k', 10)), 1), MAX_RECOMMENDATIONS)
+        filters = build_filter(genres, params.get('year_min'), params.get('year_max'), params.get('original_language'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid k or year range"}), 400
+    if embedding and not movie_id:
+        try:
+            embedding = parse_embedding(embedding, search_index.dim)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+    search_index.refresh_if_stale(movies_collection, INDEX_REFRESH_INTERVAL)
+    try:
+        with metrics.stage("recommend"):
+            results = recommend(movies_collection, search_index, movie_id=movie_id or None,
+                                embedding=embedding, k=k, filters=filters)
+    except InvalidId:
+        return jsonify({"error": "Invalid movie id"}), 400
+
+    return jsonify({"recommendations": [
+        {
+            "id": str(movie["_id"]),
+            "title": movie.get("title", "No title"),
+            "overview": movie.get("overview", ""),
+            "poster_url": poster_url(movie, "thumb"),
+            "genres": movie.get("genres", []),
+            "year": movie.get("release_year"),
+            "original_language": movie.get("original_language"),
+            "similarity": similarity,
+        } for movie, similarity in results
+    ]})
+
+# Vous pouvez ajouter d'autres routes (/movies, /scrape_movies, /stats, etc.) selon les besoins.
 
 
 # Ajoutez ces routes à votre fichier app.py
-@app.route('/delete_movie/<int:movie_index>', methods=['DELETE'])
-def delete_movie(movie_index):
+@views.route('/delete_movie/<movie_id>', methods=['DELETE'])
+def delete_movie(movie_id):
     try:
-        movies = list(movies_collection.find())
-        if 0 <= movie_index < len(movies):
-            movie = movies[movie_index]
-            
-            # Supprimer l'image GridFS si elle existe
-            if movie.get("image_id"):
-                fs.delete(ObjectId(movie["image_id"]))
-            
+        movie = find_movie(movie_id, {"image_id": 1, "poster_variants": 1})
+        if movie:
             # Supprimer le document de la collection
             movies_collection.delete_one({"_id": movie["_id"]})
+            search_index.remove(movie["_id"])
+            text_index.remove(movie["_id"])
+            poster_hash_index.remove(movie["_id"])
+            
+            # Puis l'image GridFS et ses déclinaisons, si aucun autre film ne partage cette affiche
+            release_poster(movies_collection, fs, movie.get("image_id"), movie.get("poster_variants"))
+            enqueue_neighbor_update(neighbor_updates, movie["_id"])
             
             return jsonify({"message": "Film supprimé avec succès"}), 200
         else:
@@ -168,42 +518,36 @@ def delete_movie(movie_index):
         print(f"Erreur lors de la suppression: {e}")
         return jsonify({"error": "Erreur lors de la suppression"}), 500
 
-@app.route('/edit_movie/<int:movie_index>', methods=['GET', 'POST'])
-def edit_movie(movie_index):
-    movies = list(movies_collection.find())
-    if 0 <= movie_index < len(movies):
-        movie = movies[movie_index]
-        
+# --- Clé de sharding ---
+# Lue une fois dans config.collections puis gardée en cache ; relue au plus toutes les
+# SHARD_KEY_REFRESH_INTERVAL secondes (au cas où la collection serait resharded).
+SHARD_KEY_REFRESH_INTERVAL = float(os.environ.get("SHARD_KEY_REFRESH_INTERVAL", 300))
+_shard_key = {"fields": [], "loaded_at": None}
+
+def shard_key_fields():
+    """Champs de la clé de sharding de movies (hors _id), [] si la collection n'est pas shardée."""
+    now = time.monotonic()
+    if _shard_key["loaded_at"] is None or now - _shard_key["loaded_at"] >= SHARD_KEY_REFRESH_INTERVAL:
+        try:
+            collection_config = client.config.collections.find_one(
+                {"_id": f"{db.name}.{movies_collection.name}"}, {"key": 1})
+            _shard_key["fields"] = [field for field in (collection_config or {}).get("key", {}) if field != "_id"]
+        except Exception as e:
+            # On garde la dernière valeur connue et on réessaiera au prochain intervalle
+            print(f"Erreur lors de la récupération de la clé de sharding : {e}")
+        _shard_key["loaded_at"] = now
+    return _shard_key["fields"]
+
+@views.route('/edit_movie/<movie_id>', methods=['GET', 'POST'])
+def edit_movie(movie_id):
+    # Ni le formulaire ni la mise à jour n'ont besoin de l'embedding stocké
+    movie = find_movie(movie_id, DETAIL_PROJECTION)
+    if movie:
         if request.method == 'GET':
-            # Récupérer l'image pour l'affichage
-            poster_data = None
-            if movie.get("image_id"):
-                try:
-                    grid_out = fs.get(ObjectId(movie["image_id"]))
-                    poster_data = b64encode(grid_out.read()).decode('utf-8')
-                except Exception as e:
-                    print(f"Erreur lors de la récupération de l'image: {e}")
-            
-            movie['poster_data'] = poster_data
+            movie['poster_url'] = poster_url(movie)
             return render_template('edit_movie.html', movie=movie)
         
         elif request.method == 'POST':
-            # Identifier la clé de sharding
-            shard_key = None
-            try:
-                # Essayez de récupérer la configuration de la collection
-                config_db = client.config
-                collections = config_db.collections
-                collection_config = collections.find_one({"_id": f"{db.name}.{movies_collection.name}"})
-                
-                if collection_config and 'key' in collection_config:
-                    shard_key = list(collection_config['key'].keys())[0]
-                    print(f"Clé de sharding identifiée : {shard_key}")
-                else:
-                    print("Impossible de trouver la clé de sharding")
-            except Exception as e:
-                print(f"Erreur lors de la récupération de la clé de sharding : {e}")
-            
             # Préparer les données de mise à jour
             update_data = {
                 "title": request.form.get("title"),
@@ -211,61 +555,71 @@ def edit_movie(movie_index):
                 "release_date": request.form.get("release_date")
             }
             
-            # Gestion de la nouvelle affiche
+            # Gestion de la nouvelle affiche : l'ancienne n'est supprimée qu'après la mise à jour
+            new_files = []
             poster = request.files.get('poster')
             if poster and poster.filename:
-                # Supprimer l'ancienne image si elle existe
-                if movie.get("image_id"):
-                    fs.delete(ObjectId(movie["image_id"]))
-                
-                # Stocker la nouvelle image
                 poster_bytes = poster.read()
-                image_id = fs.put(poster_bytes, filename=secure_filename(poster.filename))
-                update_data["image_id"] = str(image_id)
-                
-                # Régénérer l'embedding
-                embedding = generate_embedding(poster_bytes)
-                if embedding is not None:
-                    update_data["embedding"] = embedding.tolist()
+                hashes = poster_hashes(poster_bytes)
+                update_data.update(hashes or dict.fromkeys(HASH_FIELDS))
+                update_data["poster_sha256"] = hashlib.sha256(poster_bytes).hexdigest()
+                # Affiche déjà au catalogue : on réutilise son fichier, ses vignettes et son embedding
+                (source,), (same_file,) = resolve_duplicates([hashes], poster_hash_index, movies_collection,
+                                                             [update_data["poster_sha256"]])
+                embedding = None
+                try:
+                    if source is not None and not same_file:
+                        # Proche en pHash mais pas le même fichier : l'embedding doit le confirmer
+                        embedding = embedding_service.embed(poster_bytes)
+                        source = confirm_duplicates([source], [False], [embedding])[0]
+                    # Embedding calculé avant toute écriture dans GridFS : un timeout n'y laisse rien
+                    if source is None and embedding is None:
+                        embedding = embedding_service.embed(poster_bytes)
+                except TimeoutError:
+                    return embedding_unavailable()
+                if source is not None:
+                    update_data["image_id"] = str(source["image_id"])
+                    update_data["poster_variants"] = source.get("poster_variants") or {}
+                    update_data["embedding"] = source["embedding"]
+                else:
+                    # Stocker la nouvelle image et ses vignettes
+                    filename = secure_filename(poster.filename)
+                    image_id = fs.put(poster_bytes, filename=filename, content_type=poster.mimetype)
+                    update_data["image_id"] = str(image_id)
+                    update_data["poster_variants"] = store_derivatives(fs, poster_bytes, filename)
+                    new_files = [image_id, *update_data["poster_variants"].values()]
+                    
+                    # Nouvel embedding (déjà calculé, éventuellement pour écarter un doublon)
+                    if embedding is not None:
+                        update_data["embedding"] = encode_embedding(embedding)
             
-            # Préparer la requête de mise à jour
+            # Un seul $set ciblé : _id plus la clé de sharding, pour que mongos route vers un seul shard
             update_query = {"_id": movie["_id"]}
-            
-            # Si une clé de sharding est trouvée, l'ajouter à la requête
-            if shard_key and shard_key != '_id':
-                update_query[shard_key] = movie.get(shard_key)
+            for field in shard_key_fields():
+                update_query[field] = movie.get(field)
             
             try:
-                # Tenter plusieurs méthodes de mise à jour
-                result = movies_collection.replace_one(
-                    update_query, 
-                    {**movie, **update_data}
-                )
-                
-                if result.modified_count == 0:
-                    # Fallback method
-                    movies_collection.update_one(
-                        update_query, 
-                        {"$set": update_data},
-                        bypass_document_validation=True
-                    )
-                
-                print("Mise à jour réussie")
-                return redirect('/')
-            
+                result = movies_collection.update_one(update_query, {"$set": update_data, "$currentDate": {"updated_at": True}})
             except Exception as e:
-                print(f"Erreur de mise à jour complète : {e}")
-                
-                # Dernière tentative avec une mise à jour minimale
-                try:
-                    movies_collection.update_one(
-                        {"_id": movie["_id"]}, 
-                        {"$set": update_data}
-                    )
-                    return redirect('/')
-                except Exception as final_error:
-                    print(f"Erreur finale : {final_error}")
-                    return f"Erreur de mise à jour : {final_error}", 500
+                result = None
+                print(f"Erreur de mise à jour : {e}")
+            if result is None or result.matched_count == 0:
+                # Le document n'a pas changé : les fichiers tout juste écrits sont orphelins
+                for file_id in new_files:
+                    fs.delete(file_id)
+                if result is None:
+                    return "Erreur de mise à jour", 500
+                return "Film non trouvé", 404
+            
+            if "image_id" in update_data:
+                release_poster(movies_collection, fs, movie.get("image_id"), movie.get("poster_variants"))
+                poster_hash_index.add(movie["_id"], update_data)
+            
+            if "embedding" in update_data:
+                search_index.add(movie["_id"], decode_embedding(update_data["embedding"]))
+            text_index.add(movie["_id"], {**movie, **update_data})
+            enqueue_neighbor_update(neighbor_updates, movie["_id"])
+            return redirect('/')
     
     return "Film non trouvé", 404
 
@@ -273,4 +627,4 @@ def edit_movie(movie_index):
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,382 @@
+"""Variante ASGI (Quart + Motor) des routes de lecture de app.py.
+
+Les accès MongoDB et GridFS ne bloquent plus un worker : une lecture GridFS lente ne fait
+qu'attendre sur la boucle d'événements, et un processus garde des milliers de connexions
+ouvertes. Le travail CPU (décodage des images, ResNet, recherche dans l'index) part dans un
+ThreadPoolExecutor. Les routes d'écriture (édition, suppression) restent dans app.py.
+
+    hypercorn "async_app:create_async_app()" --bind 0.0.0.0:8001 --workers 2
+"""
+import asyncio
+import mimetypes
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from quart import Quart, Response, jsonify, render_template, request
+from werkzeug.datastructures import ContentRange
+from werkzeug.sansio.http import is_resource_modified
+
+from app import (
+    DETAIL_PROJECTION, EMBEDDING_RETRY_AFTER, INDEX_REFRESH_INTERVAL, LISTING_PROJECTION, MAX_PAGE_SIZE, PAGE_SIZE,
+    POSTER_CACHE_MAX_AGE, poster_etag,
+)
+from config import Config, mongo_client
+from embedding_codec import decode_embedding
+from embedding_service import EMBED_TIMEOUT, configure_embedding_model, preload_embedding_model, service_from_env
+import metrics
+from perceptual_hash import MATCH_DISTANCE, PosterHashIndex, poster_hashes
+from query_cache import cache_from_env
+from search_backends import backend_from_env
+from text_index import TextIndex, reciprocal_rank_fusion
+
+# Threads pour le travail CPU (prétraitement, index) et les rafraîchissements d'index
+EXECUTOR_WORKERS = int(os.environ.get("ASYNC_EXECUTOR_WORKERS", 8))
+
+# --- Ressources partagées, créées par create_async_app / au démarrage du serveur ---
+motor_client = movies = neighbors = posters = None
+sync_movies = None
+executor = embedding_service = search_index = text_index = poster_hash_index = query_cache = None
+
+
+def poster_path(file_id):
+    return f"/poster/{file_id}" if file_id else None
+
+
+def poster_url(movie, size=None):
+    """Même logique que app.poster_url : déclinaison si elle existe, sinon l'original."""
+    variant = (movie.get("poster_variants") or {}).get(size) if size else None
+    return poster_path(variant or movie.get("image_id"))
+
+
+def poster_srcset(movie, webp=False):
+    suffix = "_webp" if webp else ""
+    variants = movie.get("poster_variants") or {}
+    if not (variants.get(f"thumb{suffix}") and variants.get(f"medium{suffix}")):
+        return None
+    return f"{poster_path(variants['thumb' + suffix])} 1x, {poster_path(variants['medium' + suffix])} 2x"
+
+
+async def run_cpu(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+
+async def find_movie(movie_id, projection=None):
+    try:
+        return await movies.find_one({"_id": ObjectId(movie_id)}, projection)
+    except InvalidId:
+        return None
+
+
+async def hydrate(hits):
+    """Une seule requête $in (sans les embeddings) pour les films d'une liste de résultats."""
+    cursor = movies.find({"_id": {"$in": [ObjectId(movie_id) for movie_id, _ in hits]}}, {"embedding": 0})
+    with metrics.stage("mongo_hydrate"):
+        return {str(movie["_id"]): movie async for movie in cursor}
+
+
+async def duplicate_hits(image_bytes, k):
+    """Version asynchrone de app.duplicate_hits : affiche du catalogue reconnue sans le CNN."""
+    with metrics.stage("perceptual_hash"):
+        hashes = await run_cpu(poster_hashes, image_bytes)
+        matches = poster_hash_index.match(hashes, MATCH_DISTANCE)
+    if not matches:
+        return None
+    movie_id = matches[0][0]
+    with metrics.stage("mongo_neighbors"):
+        entry = await neighbors.find_one({"_id": ObjectId(movie_id)}, {"neighbors.id": 1, "neighbors.score": 1})
+    entries = (entry or {}).get("neighbors", [])
+    if len(entries) >= k - 1:
+        return [(movie_id, 1.0)] + [(str(neighbor["id"]), neighbor["score"]) for neighbor in entries[:k - 1]]
+    with metrics.stage("mongo_find"):
+        movie = await find_movie(movie_id, {"embedding": 1})
+    if not movie or movie.get("embedding") is None:
+        return None
+    with metrics.stage("vector_search"):
+        return await run_cpu(search_index.search, decode_embedding(movie["embedding"]), k)
+
+
+async def poster_hits(image_bytes, k):
+    """Version asynchrone de app.poster_hits : le modèle et l'index tournent dans l'executor."""
+    cache_key = await run_cpu(query_cache.key, image_bytes)
+    await run_cpu(search_index.refresh_if_stale, sync_movies, INDEX_REFRESH_INTERVAL)
+    await run_cpu(poster_hash_index.refresh_if_stale, sync_movies, INDEX_REFRESH_INTERVAL)
+    index_version = search_index.version
+    hits = query_cache.get_results(cache_key, index_version, k)
+    if hits is None:
+        hits = await duplicate_hits(image_bytes, k)
+        if hits is not None:
+            query_cache.put_results(cache_key, index_version, k, hits)
+            return hits
+        query_embedding = await run_cpu(query_cache.get_embedding, cache_key)
+        if query_embedding is None:
+            # submit décode l'image dans l'executor ; l'attente du micro-lot ne bloque aucun thread
+            future = await run_cpu(embedding_service.submit, image_bytes)
+            with metrics.stage("embedding"):
+                # Même délai que embed() côté Flask : TimeoutError si le worker est saturé
+                query_embedding = await asyncio.wait_for(asyncio.wrap_future(future), EMBED_TIMEOUT)
+            if query_embedding is None:
+                return None
+            await run_cpu(query_cache.put_embedding, cache_key, query_embedding)
+        with metrics.stage("vector_search"):
+            hits = await run_cpu(search_index.search, query_embedding, k)
+        query_cache.put_results(cache_key, index_version, k, hits)
+    return hits
+
+
+def embedding_unavailable():
+    """Même réponse 503 que app.embedding_unavailable."""
+    metrics.EMBEDDING_TIMEOUTS.inc(endpoint=request.endpoint)
+    response = jsonify({"error": "Embedding service is overloaded, retry later"})
+    response.headers["Retry-After"] = str(EMBEDDING_RETRY_AFTER)
+    return response, 503
+
+
+def create_async_app(config_object=Config):
+    """Fabrique de l'application ASGI ; mêmes réglages (config.py) que create_app."""
+    global sync_movies, embedding_service, search_index, text_index, poster_hash_index, query_cache
+    app = Quart(__name__)
+    app.config.from_object(config_object)
+
+    configure_embedding_model(weights_path=app.config["EMBEDDING_WEIGHTS_PATH"])
+    if app.config["PRELOAD_MODEL"]:
+        preload_embedding_model()
+    embedding_service = service_from_env()
+    query_cache = cache_from_env()
+
+    # Les index se chargent et se rafraîchissent avec le client synchrone, dans l'executor
+    sync_client = mongo_client(app.config)
+    sync_movies = sync_client[app.config["MONGO_DB"]]["movies"]
+    search_index = backend_from_env(dim=512)
+    search_index.bind_collection(sync_movies)
+    text_index = TextIndex()
+    poster_hash_index = PosterHashIndex()
+    if app.config["LOAD_INDEXES"]:
+        try:
+            print(f"Loaded {search_index.load_from_collection(sync_movies)} embeddings into the search index")
+            print(f"Indexed {text_index.load_from_collection(sync_movies)} movies for text search")
+            print(f"Loaded {poster_hash_index.load_from_collection(sync_movies)} poster hashes")
+        except Exception as e:
+            print(f"Error loading the search indexes: {e}")
+
+    @app.before_serving
+    async def connect():
+        # Le client Motor est lié à la boucle d'événements : il est créé une fois le serveur démarré
+        global motor_client, movies, neighbors, posters, executor
+        motor_client = AsyncIOMotorClient(
+            app.config["MONGO_URI"],
+            maxPoolSize=app.config["MONGO_MAX_POOL_SIZE"],
+            minPoolSize=app.config["MONGO_MIN_POOL_SIZE"],
+        )
+        db = motor_client[app.config["MONGO_DB"]]
+        movies = db["movies"]
+        neighbors = db["movie_neighbors"]
+        posters = AsyncIOMotorGridFSBucket(db)
+        executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="cpu")
+        print("Connected to MongoDB (async)")
+
+    @app.after_serving
+    async def disconnect():
+        motor_client.close()
+        executor.shutdown(wait=False)
+
+    @app.route('/poster/<image_id>')
+    async def poster(image_id):
+        """Diffuse un poster GridFS par morceaux de chunk_size, avec ETag, 304 et requêtes Range."""
+        try:
+            with metrics.stage("gridfs_open"):
+                grid_out = await posters.open_download_stream(ObjectId(image_id))
+        except (InvalidId, NoFile):
+            return "Poster not found", 404
+
+        etag, last_modified = poster_etag(grid_out), grid_out.upload_date
+
+        def cacheable(response):
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = POSTER_CACHE_MAX_AGE
+            response.cache_control.immutable = True
+            return response
+
+        # Mêmes règles que make_conditional dans app.poster : If-None-Match prime sur If-Modified-Since
+        if not is_resource_modified(http_if_none_match=request.headers.get("If-None-Match"),
+                                    http_if_modified_since=request.headers.get("If-Modified-Since"),
+                                    etag=etag, last_modified=last_modified):
+            return cacheable(Response("", status=304))
+
+        start, end, status = 0, grid_out.length, 200
+        if request.range is not None and len(request.range.ranges) == 1:
+            byte_range = request.range.range_for_length(grid_out.length)
+            if byte_range is None:
+                response = Response("", status=416)
+                response.content_range = ContentRange("bytes", None, None, grid_out.length)
+                return response
+            (start, end), status = byte_range, 206
+
+        async def body():
+            if start:
+                grid_out.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await grid_out.read(min(grid_out.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+        mimetype = grid_out.content_type or mimetypes.guess_type(grid_out.filename or "")[0] or "image/jpeg"
+        response = Response(body(), status=status, mimetype=mimetype)
+        response.content_length = end - start
+        if status == 206:
+            response.content_range = ContentRange("bytes", start, end, grid_out.length)
+        response.headers["Accept-Ranges"] = "bytes"
+        # Comme werkzeug, Last-Modified n'est renvoyé qu'avec le contenu, pas sur un 304
+        response.last_modified = last_modified
+        return cacheable(response)
+
+    @app.route('/')
+    async def index():
+        """Liste paginée par curseur, comme app.index."""
+        limit = min(max(request.args.get('limit', PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        cursor = request.args.get('after')
+        query = {}
+        if cursor:
+            try:
+                query["_id"] = {"$gt": ObjectId(cursor)}
+            except InvalidId:
+                return "Invalid cursor", 400
+
+        with metrics.stage("mongo_find"):
+            page = await movies.find(query, LISTING_PROJECTION).sort("_id", 1).limit(limit + 1).to_list(length=limit + 1)
+        next_cursor = str(page[limit - 1]["_id"]) if len(page) > limit else None
+        movie_list = [
+            {
+                "id": str(movie["_id"]),
+                "title": movie.get("title", "No title"),
+                "overview": movie.get("overview", "No overview available"),
+                "poster_url": poster_url(movie, "thumb"),
+                "poster_srcset": poster_srcset(movie),
+                "poster_webp_srcset": poster_srcset(movie, webp=True),
+                "genres": movie.get("genres", []),
+                "year": movie.get("release_year") or "",
+            } for movie in page[:limit]
+        ]
+        return await render_template('index.html', movies=movie_list, cursor=cursor, next_cursor=next_cursor, limit=limit)
+
+    @app.route('/movie/<movie_id>')
+    async def movie_detail(movie_id):
+        # Film et liste de voisins lus en parallèle
+        movie, movie_neighbors = await asyncio.gather(
+            find_movie(movie_id, DETAIL_PROJECTION),
+            neighbors.find_one({"_id": ObjectId(movie_id)}, {"neighbors": 1}) if ObjectId.is_valid(movie_id)
+            else asyncio.sleep(0),
+        )
+        if not movie:
+            return "Movie not found", 404
+        related = [
+            {
+                "id": str(entry["id"]),
+                "title": entry.get("title", "No title"),
+                "poster_url": poster_path(entry.get("poster_id")),
+                "similarity": entry["score"],
+            } for entry in (movie_neighbors or {}).get("neighbors", [])
+        ]
+        return await render_template('movie_detail.html', related=related, movie={
+            "title": movie.get("title", "No title"),
+            "overview": movie.get("overview", "No overview available"),
+            "poster_url": poster_url(movie),
+            "release_date": movie.get("release_date", "N/A"),
+            "runtime": movie.get("runtime", "N/A"),
+            "status": movie.get("status", "N/A"),
+            "original_language": movie.get("original_language", "N/A"),
+            "budget": movie.get("budget", "N/A"),
+            "revenue": movie.get("revenue", "N/A"),
+            "genres": movie.get("genres", [])
+        })
+
+    @app.route('/search_by_poster', methods=['POST'])
+    async def search_by_poster():
+        files = await request.files
+        if 'poster' not in files:
+            return jsonify({"error": "No poster file provided"}), 400
+        try:
+            hits = await poster_hits(files['poster'].read(), k=5)
+        except TimeoutError:
+            return embedding_unavailable()
+        if hits is None:
+            return jsonify({"error": "Error generating embedding"}), 500
+        movies_by_id = await hydrate(hits)
+        return jsonify([
+            {
+                "id": movie_id,
+                "title": movies_by_id[movie_id].get("title", "No title"),
+                "year": movies_by_id[movie_id].get("release_year") or "",
+                "similarity": similarity,
+                "poster_url": poster_url(movies_by_id[movie_id], "thumb"),
+                "overview": movies_by_id[movie_id].get("overview", "")
+            } for movie_id, similarity in hits if movie_id in movies_by_id
+        ])
+
+    @app.route('/search', methods=['GET', 'POST'])
+    async def search():
+        """Recherche texte (BM25) et hybride texte + poster, comme app.search."""
+        values = await request.values
+        files = await request.files
+        query = (values.get('q') or '').strip()
+        poster = files.get('poster')
+        if not query and not poster:
+            return jsonify({"error": "q or poster is required"}), 400
+        k = min(max(values.get('k', 10, type=int), 1), MAX_PAGE_SIZE)
+
+        rankings = []
+        text_scores = {}
+        if query:
+            await run_cpu(text_index.refresh_if_stale, sync_movies, INDEX_REFRESH_INTERVAL)
+            text_hits = await run_cpu(text_index.search, query, k * 2 if poster else k)
+            text_scores = dict(text_hits)
+            rankings.append(text_hits)
+        poster_scores = {}
+        if poster:
+            try:
+                image_hits = await poster_hits(poster.read(), k * 2 if query else k)
+            except TimeoutError:
+                return embedding_unavailable()
+            if image_hits is None:
+                return jsonify({"error": "Error generating embedding"}), 500
+            poster_scores = dict(image_hits)
+            rankings.append(image_hits)
+
+        hits = reciprocal_rank_fusion(rankings, k=k) if len(rankings) > 1 else rankings[0]
+        movies_by_id = await hydrate(hits)
+        return jsonify({
+            "mode": "hybrid" if len(rankings) > 1 else "text" if query else "poster",
+            "results": [
+                {
+                    "id": movie_id,
+                    "title": movies_by_id[movie_id].get("title", "No title"),
+                    "overview": movies_by_id[movie_id].get("overview", ""),
+                    "poster_url": poster_url(movies_by_id[movie_id], "thumb"),
+                    "genres": movies_by_id[movie_id].get("genres", []),
+                    "score": score,
+                    "text_score": text_scores.get(movie_id),
+                    "similarity": poster_scores.get(movie_id),
+                } for movie_id, score in hits if movie_id in movies_by_id
+            ],
+        })
+
+    @app.route('/metrics')
+    async def prometheus_metrics():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    @app.route('/stats/embeddings')
+    async def embedding_stats():
+        return jsonify(embedding_service.stats())
+
+    return app
+
+
+if __name__ == '__main__':
+    create_async_app().run(debug=True, port=8001)
@@ -0,0 +1,172 @@
+"""Benchmark des backends de recherche de posters (exact, flat, ivfpq, hnsw).
+
+Génère un catalogue synthétique d'embeddings groupés en clusters (plus proche de
+vrais embeddings ResNet qu'un bruit uniforme), calcule la vérité terrain par
+recherche exacte puis mesure pour chaque type d'index :
+recall@5/@10, latence p50/p99 d'une requête, temps de construction et mémoire.
+
+    python benchmarks/bench_ann.py --n 1000000 --queries 500
+    python benchmarks/bench_ann.py --n 100000 --backends exact hnsw --ef-search 128 --json ann.json
+    python benchmarks/bench_ann.py --n 1000000 --backends exact compressed --index-dtype int8 --pca-dim 128 --rerank 64
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from projection import fit_projection  # noqa: E402
+from search_backends import CompressedIndex, FaissBackend, create_backend, faiss  # noqa: E402
+
+
+def synthetic_embeddings(n, centers, rng, chunk_size=100_000):
+    """Vecteurs normalisés tirés autour des centres donnés, générés par blocs."""
+    n_clusters, dim = centers.shape
+    data = np.empty((n, dim), dtype=np.float32)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        assign = rng.integers(0, n_clusters, size=stop - start)
+        block = centers[assign] + 0.6 * rng.normal(size=(stop - start, dim)).astype(np.float32)
+        data[start:stop] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return data
+
+
+def exact_top_k(data, queries, k, block_size=100_000):
+    """Vérité terrain : top-k exact par blocs pour ne pas matérialiser n x q scores d'un coup."""
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), k), dtype=np.int64)
+    for start in range(0, len(data), block_size):
+        scores = queries @ data[start:start + block_size].T
+        ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        top = np.argpartition(scores, -k, axis=1)[:, -k:]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_ids, order, axis=1)
+
+
+def memory_bytes(backend):
+    """Taille des structures de l'index (hors table des identifiants).
+
+    Pour l'index compressé : codes et copie float32 du re-ranking en mémoire."""
+    if isinstance(backend, CompressedIndex):
+        return backend.resident_bytes() + backend.rerank_bytes()
+    if isinstance(backend, FaissBackend):
+        index = backend._index if not getattr(backend, "_staging", None) else None
+        if index is None:
+            return backend._staging._matrix.nbytes
+        return int(faiss.serialize_index(index).nbytes)
+    return backend._matrix[:len(backend)].nbytes
+
+
+def run_backend(kind, params, data, queries, truth, batch_size):
+    backend = create_backend(kind, dim=data.shape[1], **params)
+    ids = [str(i) for i in range(len(data))]
+    start = time.perf_counter()
+    for offset in range(0, len(data), batch_size):
+        backend.add_many(ids[offset:offset + batch_size], data[offset:offset + batch_size])
+    build_seconds = time.perf_counter() - start
+
+    latencies = []
+    recall = {5: [], 10: []}
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        hits = backend.search(query, k=10)
+        latencies.append(time.perf_counter() - start)
+        found = [int(movie_id) for movie_id, _ in hits]
+        for k in recall:
+            recall[k].append(len(set(found[:k]) & set(expected[:k].tolist())) / k)
+
+    latencies = np.array(latencies) * 1000
+    extra = {}
+    if isinstance(backend, CompressedIndex):
+        extra = {"codes_mb": round(backend.resident_bytes() / 2 ** 20, 1),
+                 "rerank_memory_mb": round(backend.rerank_bytes() / 2 ** 20, 1)}
+    return {
+        "backend": kind,
+        "params": params,
+        "build_seconds": round(build_seconds, 2),
+        "memory_mb": round(memory_bytes(backend) / 2 ** 20, 1),
+        "recall@5": round(float(np.mean(recall[5])), 4),
+        "recall@10": round(float(np.mean(recall[10])), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+        **extra,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall / latency / memory benchmark of the search backends")
+    parser.add_argument("--n", type=int, default=1_000_000, help="catalog size")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--clusters", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=100_000)
+    parser.add_argument("--backends", nargs="+", default=["exact", "flat", "ivfpq", "hnsw"])
+    parser.add_argument("--nlist", type=int, default=4096)
+    parser.add_argument("--pq-m", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, default=32)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-search", type=int, default=128)
+    parser.add_argument("--index-dtype", choices=CompressedIndex.DTYPES, default="int8")
+    parser.add_argument("--pca-dim", type=int, help="PCA projection of the compressed index (fitted on the catalog)")
+    parser.add_argument("--whiten", action="store_true")
+    parser.add_argument("--rerank", type=int, default=64, help="candidates re-ranked in float32 (0: none)")
+    # Sans MongoDB, le re-ranking ne peut lire les vecteurs float32 que dans une copie résidente,
+    # comptée dans memory MB ; en production (INDEX_RERANK_FROM=mongo) seule la colonne codes reste
+    parser.add_argument("--rerank-from", choices=("memory", "none"), default="memory",
+                        help="memory: resident float32 copy (counted in memory MB); none: quantized scores only")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    params = {
+        "exact": {},
+        "flat": {},
+        "ivfpq": {"nlist": args.nlist, "m": args.pq_m, "nprobe": args.nprobe},
+        "hnsw": {"m": args.hnsw_m, "ef_construction": args.ef_construction, "ef_search": args.ef_search},
+        "compressed": {"dtype": args.index_dtype, "rerank": args.rerank if args.rerank_from == "memory" else 0,
+                       "rerank_from": "memory"},
+    }
+
+    print(f"Generating {args.n} x {args.dim} catalog and {args.queries} queries...")
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(args.clusters, args.dim)).astype(np.float32)
+    data = synthetic_embeddings(args.n, centers, rng)
+    queries = synthetic_embeddings(args.queries, centers, rng)
+    truth = exact_top_k(data, queries, 10)
+    if args.pca_dim and "compressed" in args.backends:
+        projection = fit_projection(data[:200_000], args.pca_dim, whiten=args.whiten)
+        params["compressed"]["projection"] = projection
+        print(f"Fitted PCA projection {projection.version} ({args.dim} -> {args.pca_dim})")
+
+    results = []
+    for kind in args.backends:
+        print(f"Benchmarking {kind}...")
+        result = run_backend(kind, params[kind], data, queries, truth, args.batch_size)
+        if result["params"].get("projection") is not None:
+            result["params"] = {**result["params"], "projection": result["params"]["projection"].metadata()}
+        results.append(result)
+        print(f"  {result}")
+
+    header = (f"{'backend':<10} {'recall@5':>9} {'recall@10':>10} {'p50 ms':>8} {'p99 ms':>8} {'memory MB':>10} "
+              f"{'codes MB':>9} {'build s':>8}")
+    print(header)
+    for r in results:
+        print(f"{r['backend']:<10} {r['recall@5']:>9} {r['recall@10']:>10} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['memory_mb']:>10} "
+              f"{r.get('codes_mb', r['memory_mb']):>9} {r['build_seconds']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"n": args.n, "dim": args.dim, "queries": args.queries, "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
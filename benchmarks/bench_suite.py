@@ -0,0 +1,342 @@
+"""Suite de benchmarks reproductible : recherche par poster, liste, embeddings et ingestion.
+
+Pour chaque taille de catalogue (--scales), une base dédiée est remplie de films
+synthétiques (embeddings 512-d groupés en clusters, posters JPEG générés dans GridFS),
+puis l'application est construite par create_app et interrogée en process :
+
+- search_by_poster de bout en bout (affiches inédites, puis la même affiche : cache),
+- classement seul (search_index.search sur des vecteurs aléatoires),
+- index() : temps de réponse et taille de la page, en tête et au milieu du catalogue.
+
+Indépendamment de la taille : débit de generate_embeddings_batch par taille de lot et
+débit d'ingestion de insert_movies_to_mongodb (posters servis par un serveur HTTP local).
+
+Les résultats (avec le commit courant) sont écrits en JSON ; --compare affiche l'écart
+avec un fichier précédent pour repérer une régression entre deux commits.
+
+    python benchmarks/bench_suite.py --store mongomock --scales 1000 10000 --json bench.json
+    python benchmarks/bench_suite.py --store mongo --scales 1000 10000 100000 --json bench.json --compare main.json
+
+Avec mongomock (requêtes évaluées en Python), seules les comparaisons entre deux
+exécutions ont un sens ; les chiffres absolus se mesurent sur un mongod local.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_ann import synthetic_embeddings  # noqa: E402
+
+GENRES = ["Action", "Adventure", "Animation", "Comedy", "Crime", "Drama", "Family", "Fantasy",
+          "Horror", "Mystery", "Romance", "Science Fiction", "Thriller", "War", "Western"]
+WORDS = ["night", "city", "last", "dark", "love", "war", "star", "king", "river", "shadow", "dream", "secret",
+         "road", "storm", "ghost", "summer", "iron", "silent", "lost", "blue", "fire", "winter", "island", "house"]
+
+
+def use_store(kind, mongo_uri):
+    """Branche create_app et GridFS sur la base choisie ; retourne le client de la suite."""
+    import pymongo
+
+    if kind == "mongomock":
+        import mongomock
+        import mongomock.gridfs
+
+        mongomock.gridfs.enable_gridfs_integration()
+        # Un seul client partagé : chaque instance mongomock aurait sinon sa propre base
+        shared = mongomock.MongoClient()
+        pymongo.MongoClient = lambda *args, **kwargs: shared
+        return shared
+    return pymongo.MongoClient(mongo_uri)
+
+
+def synthetic_poster(rng, width=300, height=450):
+    """Affiche JPEG : dégradé et quelques formes aléatoires (taille et décodage réalistes)."""
+    top, bottom = rng.integers(0, 256, size=(2, 3))
+    ramp = np.linspace(0, 1, height)[:, None, None]
+    pixels = (top * (1 - ramp) + bottom * ramp).astype(np.uint8)
+    image = Image.fromarray(np.broadcast_to(pixels, (height, width, 3)).copy())
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        draw.ellipse([x0, y0, x0 + rng.integers(20, 120), y0 + rng.integers(20, 160)],
+                     fill=tuple(int(c) for c in rng.integers(0, 256, size=3)))
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def synthetic_movie(rng, i):
+    title = " ".join(rng.choice(WORDS, size=rng.integers(1, 4))).title()
+    year = int(rng.integers(1950, 2025))
+    return {
+        "title": f"{title} {i}",
+        "overview": " ".join(rng.choice(WORDS, size=30)),
+        "genres": list(rng.choice(GENRES, size=rng.integers(1, 4), replace=False)),
+        "release_date": f"{year}-01-01",
+        "release_year": year,
+        "original_language": str(rng.choice(["en", "fr", "es", "ja", "ko"])),
+    }
+
+
+def seed_catalog(db, n, rng, poster_count, chunk_size=5000):
+    """Remplit db.movies de n films ; poster_count affiches distinctes sont partagées entre eux."""
+    import gridfs
+
+    from embedding_codec import encode_embedding
+
+    db["movies"].drop()
+    db["fs.files"].drop()
+    db["fs.chunks"].drop()
+    fs = gridfs.GridFS(db)
+    poster_ids = [fs.put(synthetic_poster(rng), filename=f"bench_{i}_poster", content_type="image/jpeg")
+                  for i in range(min(n, poster_count))]
+    centers = rng.normal(size=(max(n // 50, 10), 512)).astype(np.float32)
+    embeddings = synthetic_embeddings(n, centers, rng)
+    for start in range(0, n, chunk_size):
+        db["movies"].insert_many([
+            {**synthetic_movie(rng, i), "image_id": poster_ids[i % len(poster_ids)],
+             "embedding": encode_embedding(embeddings[i])}
+            for i in range(start, min(start + chunk_size, n))
+        ])
+    return embeddings
+
+
+def summarize(latencies):
+    latencies = np.array(latencies) * 1000
+    return {
+        "count": len(latencies),
+        "mean_ms": round(float(latencies.mean()), 3),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+    }
+
+
+def timed_requests(send, count):
+    latencies, sizes = [], []
+    for i in range(count):
+        start = time.perf_counter()
+        response = send(i)
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"Unexpected status {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        sizes.append(len(response.get_data()))
+    return {**summarize(latencies), "mean_bytes": int(np.mean(sizes))}
+
+
+def bench_scale(n, args, config, client, rng):
+    import app
+
+    print(f"Seeding {n} movies...")
+    start = time.perf_counter()
+    seed_catalog(client[args.db], n, rng, args.posters)
+    seed_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    flask_app = app.create_app(config)
+    startup_seconds = time.perf_counter() - start
+    http = flask_app.test_client()
+    result = {"n": n, "seed_seconds": round(seed_seconds, 2), "startup_seconds": round(startup_seconds, 2),
+              "indexed": len(app.search_index)}
+
+    def post_poster(image):
+        return lambda i: http.post('/search_by_poster', data={'poster': (io.BytesIO(image(i)), 'poster.jpg')})
+
+    # Affiches jamais vues : décodage + modèle + index + hydratation à chaque requête
+    uncached = [synthetic_poster(rng) for _ in range(args.queries)]
+    post_poster(lambda i: uncached[0])(0)  # chargement du modèle hors mesure
+    result["search_e2e"] = timed_requests(post_poster(lambda i: uncached[i]), args.queries)
+    result["search_e2e_cached"] = timed_requests(post_poster(lambda i: uncached[0]), args.queries)
+
+    queries = rng.normal(size=(args.queries, 512)).astype(np.float32)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        app.search_index.search(query, k=5)
+        latencies.append(time.perf_counter() - start)
+    result["ranking"] = summarize(latencies)
+
+    result["index_first_page"] = timed_requests(lambda i: http.get('/'), args.queries)
+    middle = app.movies_collection.find({}, {"_id": 1}).sort("_id", 1).skip(n // 2).limit(1)[0]["_id"]
+    result["index_middle_page"] = timed_requests(lambda i: http.get(f'/?after={middle}'), args.queries)
+    return result
+
+
+def bench_embedding(batch_sizes, images, rng):
+    """Images/s de generate_embeddings_batch pour chaque taille de lot (tenseurs déjà prétraités)."""
+    from embedding_service import generate_embeddings_batch, load_image_tensor
+
+    tensors = [load_image_tensor(synthetic_poster(rng)) for _ in range(max(batch_sizes))]
+    generate_embeddings_batch(tensors[:1])  # chargement du modèle hors mesure
+    results = []
+    for batch_size in batch_sizes:
+        batches = max(images // batch_size, 1)
+        start = time.perf_counter()
+        for _ in range(batches):
+            generate_embeddings_batch(tensors[:batch_size])
+        elapsed = time.perf_counter() - start
+        results.append({
+            "batch_size": batch_size,
+            "images_per_second": round(batches * batch_size / elapsed, 1),
+            "ms_per_batch": round(1000 * elapsed / batches, 2),
+        })
+        print(f"  batch {batch_size:>3}: {results[-1]['images_per_second']} images/s")
+    return results
+
+
+def bench_ingest(db, count, rng):
+    """insert_movies_to_mongodb sur count films dont les posters sont servis en HTTP local."""
+    import gridfs
+
+    from scrap import insert_movies_to_mongodb
+
+    # Affiches toutes distinctes : une affiche répétée serait partagée sans passer par le modèle
+    posters = [synthetic_poster(rng) for _ in range(count)]
+
+    class PosterHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = posters[int(self.path.rsplit("/", 1)[-1].split(".")[0]) % len(posters)]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PosterHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    movies = [{**synthetic_movie(rng, i), "poster": f"{base_url}/poster/{i}.jpg"} for i in range(count)]
+    collection = db["ingest_bench"]
+    collection.drop()
+    try:
+        stats = insert_movies_to_mongodb(movies, collection, gridfs.GridFS(db))
+    finally:
+        server.shutdown()
+    return {"movies": count, "inserted": stats["inserted"], "duplicates": stats["duplicates"],
+            "seconds": round(stats["seconds"], 2),
+            "posters_per_second": round(stats["posters"] / stats["seconds"], 1) if stats["seconds"] else None}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current, threshold):
+    """Écart des latences p50 (et débits) entre deux exécutions ; signale les régressions."""
+    def flatten(results):
+        values = {}
+        for scale in results.get("scales", []):
+            for name, metric in scale.items():
+                if isinstance(metric, dict) and "p50_ms" in metric:
+                    values[f"n={scale['n']} {name} p50_ms"] = (metric["p50_ms"], False)
+        for entry in results.get("embedding", []):
+            values[f"embedding batch={entry['batch_size']} images/s"] = (entry["images_per_second"], True)
+        if results.get("ingest", {}).get("posters_per_second"):
+            values["ingest posters/s"] = (results["ingest"]["posters_per_second"], True)
+        return values
+
+    before, after = flatten(previous), flatten(current)
+    print(f"\nComparison with {previous.get('commit')} (regression threshold {threshold:.0%}):")
+    for name, (value, higher_is_better) in after.items():
+        if name not in before or not before[name][0]:
+            continue
+        change = value / before[name][0] - 1
+        regressed = -change > threshold if higher_is_better else change > threshold
+        print(f"  {name:<45} {before[name][0]:>10} -> {value:>10} ({change:+.1%}){'  REGRESSION' if regressed else ''}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search / listing / embedding / ingestion benchmark suite")
+    parser.add_argument("--store", choices=["mongomock", "mongo"], default="mongomock")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--db", default="cinematch_bench", help="database dropped and reseeded for each scale")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--posters", type=int, default=500, help="distinct poster images stored in GridFS")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--embed-images", type=int, default=128, help="images embedded per batch size")
+    parser.add_argument("--ingest", type=int, default=200, help="movies ingested by insert_movies_to_mongodb (0: skip)")
+    parser.add_argument("--weights", help="ResNet-18 state_dict; random weights by default (same cost)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as a regression")
+    args = parser.parse_args()
+    if args.db == "movie_database":
+        parser.error("the benchmark drops its database: use a dedicated --db")
+
+    rng = np.random.default_rng(args.seed)
+    client = use_store(args.store, args.mongo_uri)
+
+    from config import Config
+    from embedding_service import configure_embedding_model
+
+    weights_path = args.weights
+    if not weights_path:
+        # Poids aléatoires : même temps d'inférence, aucun téléchargement
+        import torch
+        import torchvision.models as models
+
+        torch.manual_seed(args.seed)
+        weights_path = os.path.join(tempfile.mkdtemp(), "resnet18_random.pth")
+        torch.save(models.resnet18(weights=None).state_dict(), weights_path)
+    configure_embedding_model(weights_path=weights_path)
+    config = type("BenchConfig", (Config,), {
+        "MONGO_URI": args.mongo_uri, "MONGO_DB": args.db, "EMBEDDING_WEIGHTS_PATH": weights_path,
+        "LOAD_INDEXES": True, "PRELOAD_MODEL": False,
+    })
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "store": args.store,
+        "search_backend": os.environ.get("SEARCH_BACKEND", "exact"),
+        "embedding_mode": os.environ.get("EMBEDDING_MODE", "eager"),
+        "args": vars(args),
+    }
+    print("Embedding throughput per batch size...")
+    results["embedding"] = bench_embedding(args.batch_sizes, args.embed_images, rng)
+    if args.ingest:
+        print(f"Ingesting {args.ingest} movies...")
+        results["ingest"] = bench_ingest(client[args.db], args.ingest, rng)
+    results["scales"] = []
+    for n in args.scales:
+        result = bench_scale(n, args, config, client, rng)
+        results["scales"].append(result)
+        print(f"n={n}: search p50 {result['search_e2e']['p50_ms']} ms "
+              f"(cached {result['search_e2e_cached']['p50_ms']} ms, ranking {result['ranking']['p50_ms']} ms), "
+              f"index p50 {result['index_first_page']['p50_ms']} ms / {result['index_first_page']['mean_bytes']} bytes")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results, args.threshold)
+
+
+if __name__ == '__main__':
+    main()
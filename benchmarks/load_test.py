@@ -0,0 +1,160 @@
+"""Test de charge HTTP des routes de lecture, pour comparer app.py (gunicorn) et async_app.py (hypercorn).
+
+Des URLs réelles (films, posters, titres) sont tirées de la base, puis --concurrency clients
+enchaînent les requêtes pendant --duration secondes sur un mélange pondéré de routes.
+Le rapport donne, par route : débit, latence p50/p95/p99 et erreurs.
+
+    gunicorn -c gunicorn.conf.py
+    python benchmarks/load_test.py --url http://localhost:8000 --concurrency 200 --duration 30
+    hypercorn "async_app:create_async_app()" --bind 0.0.0.0:8001 --workers 2
+    python benchmarks/load_test.py --url http://localhost:8001 --concurrency 200 --duration 30 --json async.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+import aiohttp
+import numpy as np
+from pymongo import MongoClient
+
+# Poids de chaque route dans le mélange (une page de liste charge ~24 vignettes)
+DEFAULT_MIX = {"index": 1, "movie": 2, "poster": 8, "search": 1, "search_by_poster": 0}
+
+
+def sample_targets(mongo_uri, db_name, size):
+    """Identifiants de films, de posters et titres tirés au hasard dans la base."""
+    client = MongoClient(mongo_uri)
+    movies = client[db_name]["movies"]
+    sample = list(movies.aggregate([
+        {"$sample": {"size": size}},
+        {"$project": {"title": 1, "image_id": 1, "poster_variants.thumb": 1}},
+    ]))
+    client.close()
+    return {
+        "movies": [str(movie["_id"]) for movie in sample],
+        "posters": [str((movie.get("poster_variants") or {}).get("thumb") or movie["image_id"])
+                    for movie in sample if movie.get("image_id")],
+        "titles": [movie["title"].split()[0] for movie in sample if movie.get("title")],
+    }
+
+
+def request_for(route, targets, uploads):
+    """(méthode, chemin, options aiohttp) d'une requête tirée au hasard pour une route."""
+    if route == "index":
+        return "GET", "/", {}
+    if route == "movie":
+        return "GET", f"/movie/{random.choice(targets['movies'])}", {}
+    if route == "poster":
+        return "GET", f"/poster/{random.choice(targets['posters'])}", {}
+    if route == "search":
+        return "GET", "/search", {"params": {"q": random.choice(targets["titles"])}}
+    data = aiohttp.FormData()
+    data.add_field("poster", random.choice(uploads), filename="poster.jpg", content_type="image/jpeg")
+    return "POST", "/search_by_poster", {"data": data}
+
+
+async def client_loop(session, base_url, routes, weights, targets, uploads, deadline, results):
+    while time.perf_counter() < deadline:
+        route = random.choices(routes, weights)[0]
+        method, path, options = request_for(route, targets, uploads)
+        start = time.perf_counter()
+        # Une requête plus lente que --timeout lève asyncio.TimeoutError, pas une ClientError
+        try:
+            async with session.request(method, base_url + path, **options) as response:
+                await response.read()
+                outcome = "ok" if response.status < 400 else "error"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        except aiohttp.ClientError:
+            outcome = "error"
+        results[route].append((time.perf_counter() - start, outcome))
+
+
+async def run(args, targets, uploads):
+    mix = {**DEFAULT_MIX, **dict(args.mix)}
+    if not uploads:
+        mix["search_by_poster"] = 0
+    routes = [route for route, weight in mix.items() if weight > 0]
+    weights = [mix[route] for route in routes]
+    results = {route: [] for route in routes}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        deadline = time.perf_counter() + args.duration
+        await asyncio.gather(*[
+            client_loop(session, args.url.rstrip("/"), routes, weights, targets, uploads, deadline, results)
+            for _ in range(args.concurrency)
+        ])
+    return results
+
+
+def summarize(results, duration):
+    summary = []
+    for route, samples in results.items():
+        if not samples:
+            continue
+        latencies = np.array([latency for latency, _ in samples]) * 1000
+        summary.append({
+            "route": route,
+            "requests": len(samples),
+            "rps": round(len(samples) / duration, 1),
+            "errors": sum(1 for _, outcome in samples if outcome != "ok"),
+            "timeouts": sum(1 for _, outcome in samples if outcome == "timeout"),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 1),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 1),
+            "p99_ms": round(float(np.percentile(latencies, 99)), 1),
+        })
+    return summary
+
+
+def parse_mix(value):
+    route, _, weight = value.partition("=")
+    if route not in DEFAULT_MIX or not weight:
+        raise argparse.ArgumentTypeError(f"expected ROUTE=WEIGHT with ROUTE in {', '.join(DEFAULT_MIX)}")
+    return route, float(weight)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the read routes (sync vs async server)")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--mongo-uri", default=os.environ.get("MONGO_URI", "mongodb://localhost:27017/"))
+    parser.add_argument("--db", default=os.environ.get("MONGO_DB", "movie_database"))
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--sample", type=int, default=1000, help="movies sampled to build the URLs")
+    parser.add_argument("--mix", type=parse_mix, nargs="*", default=[], help="route weights, e.g. poster=10 search=0")
+    parser.add_argument("--upload", nargs="*", default=[], help="poster images used for /search_by_poster")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    targets = sample_targets(args.mongo_uri, args.db, args.sample)
+    if not targets["movies"]:
+        parser.error("no movies found in the database")
+    uploads = []
+    for path in args.upload:
+        with open(path, "rb") as f:
+            uploads.append(f.read())
+
+    print(f"Load testing {args.url} with {args.concurrency} clients for {args.duration}s...")
+    results = asyncio.run(run(args, targets, uploads))
+    summary = summarize(results, args.duration)
+
+    print(f"{'route':<17} {'requests':>9} {'rps':>8} {'errors':>7} {'timeouts':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for r in summary:
+        print(f"{r['route']:<17} {r['requests']:>9} {r['rps']:>8} {r['errors']:>7} {r['timeouts']:>9} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8}")
+    total = sum(r["requests"] for r in summary)
+    print(f"Total: {total} requests, {total / args.duration:.1f} req/s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"url": args.url, "concurrency": args.concurrency, "duration": args.duration,
+                       "results": summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
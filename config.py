@@ -0,0 +1,46 @@
+import os
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()  # Variables lues aussi depuis un fichier .env s'il existe
+except ImportError:
+    pass
+
+
+class Config:
+    """Configuration de l'application, lue dans l'environnement (voir create_app dans app.py)."""
+
+    MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+    MONGO_DB = os.environ.get("MONGO_DB", "movie_database")
+    # Connexions par processus : à dimensionner avec le nombre de threads de chaque worker
+    MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+    MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+    # Fichier local des poids ResNet-18 (state_dict) : aucun téléchargement au démarrage
+    EMBEDDING_WEIGHTS_PATH = os.environ.get("EMBEDDING_WEIGHTS_PATH") or None
+    # Charge le modèle dans create_app (avant le fork des workers gunicorn --preload)
+    # plutôt qu'à la première requête qui en a besoin
+    PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "0") == "1"
+    # Index vectoriel et texte chargés au démarrage (désactivable pour les scripts et les tests)
+    LOAD_INDEXES = os.environ.get("LOAD_INDEXES", "1") == "1"
+    # En-tête Server-Timing (durée de chaque étape) sur toutes les réponses ; sinon seulement
+    # pour les requêtes qui envoient X-Trace: 1
+    TRACE_HEADERS = os.environ.get("TRACE_HEADERS", "0") == "1"
+    # Route /debug/profiler (profileur par échantillonnage activable à chaud)
+    PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+    PROFILER_INTERVAL_MS = float(os.environ.get("PROFILER_INTERVAL_MS", 10))
+
+
+def mongo_client(config):
+    """MongoClient configuré (URI et tailles de pool) à partir d'un dict de configuration."""
+    from pymongo import MongoClient
+
+    return MongoClient(
+        config["MONGO_URI"],
+        maxPoolSize=config["MONGO_MAX_POOL_SIZE"],
+        minPoolSize=config["MONGO_MIN_POOL_SIZE"],
+    )
+
+
+def config_dict(config_object=Config):
+    """Attributs en majuscules d'une classe de configuration, sous forme de dict."""
+    return {key: getattr(config_object, key) for key in dir(config_object) if key.isupper()}
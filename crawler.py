@@ -0,0 +1,149 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class TokenBucket:
+    """Limiteur de débit partagé entre threads : rate requêtes/s, rafales jusqu'à burst."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class Crawler:
+    """Client HTTP du scraper : session poolée, débit limité, concurrence bornée par hôte,
+    retries avec backoff exponentiel et requêtes conditionnelles (ETag / If-Modified-Since).
+
+    Les validateurs (ETag, Last-Modified) sont gardés par URL dans cache_path pour que
+    le passage suivant puisse sauter les pages qui n'ont pas changé (réponse 304). Ceux
+    d'une page téléchargée restent en attente jusqu'à confirm(url), que l'appelant fait
+    une fois les films de la page enregistrés : une page dont l'écriture a échoué est
+    retéléchargée au passage suivant au lieu d'être sautée.
+    """
+
+    def __init__(self, rate=4.0, burst=4, max_per_host=4, concurrency=8, retries=3,
+                 backoff_factor=0.5, timeout=30, cache_path=None, user_agent="CineMatch/1.0"):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.max_per_host = max_per_host
+        self.cache_path = cache_path
+        self._bucket = TokenBucket(rate, burst)
+        self._host_slots = {}
+        self._lock = threading.Lock()
+        self._validators = self._load_validators()
+        self._pending = {}
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET", "HEAD"),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = user_agent
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _load_validators(self):
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error reading crawler cache {self.cache_path}: {e}")
+        return {}
+
+    def confirm(self, urls):
+        """Valide les validateurs des pages dont le contenu est enregistré (voir save)."""
+        with self._lock:
+            for url in urls:
+                if url not in self._pending:
+                    continue
+                validators = self._pending.pop(url)
+                if validators:
+                    self._validators[url] = validators
+                else:
+                    self._validators.pop(url, None)
+
+    def save(self):
+        """Persiste les validateurs HTTP confirmés pour le prochain passage."""
+        if not self.cache_path:
+            return
+        with self._lock:
+            data = json.dumps(self._validators)
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_path)
+
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._host_slots[host]
+
+    def fetch(self, url, conditional=True):
+        """GET limité en débit. Retourne le contenu, ou None si la page n'a pas changé (304).
+
+        Lève requests.exceptions.RequestException en cas d'échec après les retries.
+        """
+        headers = {}
+        if conditional:
+            with self._lock:
+                validators = self._validators.get(url, {})
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        with self._host_slot(url):
+            self._bucket.acquire()
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        if conditional:
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            with self._lock:
+                self._pending[url] = validators if validators["etag"] or validators["last_modified"] else None
+        return response.content
+
+    def map(self, function, items):
+        """Applique function à chaque élément avec au plus `concurrency` requêtes en vol."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(function, items))
+
+    def close(self):
+        # Les validateurs non confirmés sont abandonnés : ces pages seront retéléchargées
+        self.save()
+        self.session.close()
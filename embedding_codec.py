@@ -0,0 +1,77 @@
+import argparse
+import os
+import struct
+
+import numpy as np
+from bson.binary import Binary, USER_DEFINED_SUBTYPE
+from pymongo import UpdateOne
+
+# Format binaire d'un embedding stocké dans MongoDB :
+#   en-tête little-endian <version:uint8><dtype:uint8><dim:uint16> puis les valeurs brutes.
+# Soit 2 Ko (float32) ou 1 Ko (float16) pour 512 dimensions, contre ~6 Ko pour un tableau BSON de doubles.
+EMBEDDING_FORMAT_VERSION = 1
+HEADER = struct.Struct("<BBH")
+DTYPE_CODES = {"float32": 1, "float16": 2}
+DTYPES = {code: np.dtype(name).newbyteorder("<") for name, code in DTYPE_CODES.items()}
+STORAGE_DTYPE = os.environ.get("EMBEDDING_STORAGE_DTYPE", "float32")
+
+
+def encode_embedding(embedding, dtype=None):
+    """Encode un embedding en BSON Binary compact (None reste None)."""
+    if embedding is None:
+        return None
+    dtype = dtype or STORAGE_DTYPE
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f"Unsupported embedding dtype '{dtype}' (expected one of: {', '.join(DTYPE_CODES)})")
+    vector = np.asarray(embedding, dtype=DTYPES[DTYPE_CODES[dtype]]).reshape(-1)
+    header = HEADER.pack(EMBEDDING_FORMAT_VERSION, DTYPE_CODES[dtype], vector.shape[0])
+    return Binary(header + vector.tobytes(), USER_DEFINED_SUBTYPE)
+
+
+def decode_embedding(value):
+    """Décode un embedding stocké (Binary versionné ou ancien tableau de floats) en ndarray.
+
+    Pour le format binaire, le tableau est une vue sur le buffer BSON (np.frombuffer, sans copie).
+    """
+    if value is None:
+        return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        version, dtype_code, dim = HEADER.unpack_from(value)
+        if version != EMBEDDING_FORMAT_VERSION or dtype_code not in DTYPES:
+            raise ValueError(f"Unknown embedding format (version {version}, dtype {dtype_code})")
+        return np.frombuffer(value, dtype=DTYPES[dtype_code], count=dim, offset=HEADER.size)
+    return np.asarray(value, dtype=np.float32)
+
+
+def migrate_embeddings(collection, batch_size=500, dtype=None):
+    """Convertit par lots les embeddings encore stockés en tableaux BSON vers le format binaire."""
+    migrated = 0
+    while True:
+        docs = list(collection.find({"embedding": {"$type": "array"}}, {"embedding": 1}).limit(batch_size))
+        if not docs:
+            break
+        operations = [
+            UpdateOne({"_id": doc["_id"]}, {"$set": {"embedding": encode_embedding(doc["embedding"], dtype)}})
+            for doc in docs
+        ]
+        collection.bulk_write(operations, ordered=False)
+        migrated += len(docs)
+        print(f"Migrated {migrated} embeddings")
+    return migrated
+
+
+if __name__ == '__main__':
+    # Migration des documents existants :
+    #   python embedding_codec.py --batch-size 500 --dtype float16
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Convert stored embeddings to the packed binary format")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dtype", choices=list(DTYPE_CODES), default=STORAGE_DTYPE)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    total = migrate_embeddings(client["movie_database"]["movies"], args.batch_size, args.dtype)
+    print(f"Done: {total} documents converted to {args.dtype}")
+    client.close()
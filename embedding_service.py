@@ -0,0 +1,383 @@
+import argparse
+import io
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+import torchvision.models as models
+import torchvision.transforms as transforms
+from PIL import Image
+
+import metrics
+
+EMBEDDING_MODES = ("eager", "quantized", "torchscript", "onnx")
+# Attente maximale d'un embedding demandé par une requête HTTP (file du worker saturée)
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", 30))
+
+def build_reference_model(weights_path=None):
+    """ResNet-18 float32 sans sa couche fully-connected : sortie [N, 512, 1, 1].
+
+    Avec weights_path, les poids sont lus dans ce fichier local (state_dict) au lieu d'être téléchargés."""
+    # Utilisons resnet18 dont la couche finale (après pooling) produit un vecteur de 512 dimensions.
+    if weights_path:
+        model = models.resnet18(weights=None)
+        model.load_state_dict(torch.load(weights_path, map_location="cpu", weights_only=True))
+    else:
+        model = models.resnet18(pretrained=True)
+    model.eval()  # Mode évaluation
+    # On retire la dernière couche fully-connected pour récupérer le vecteur avant classification
+    return torch.nn.Sequential(*list(model.children())[:-1]).eval()
+
+def build_quantized_model(weights_path=None):
+    """ResNet-18 int8 pré-quantifié de torchvision (quantification statique, moteur fbgemm/qnnpack).
+
+    weights_path : state_dict du modèle déjà quantifié (voir --export-weights --mode quantized)."""
+    from torchvision.models import quantization
+
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+    if weights_path:
+        model = quantization.resnet18(weights=None, quantize=True)
+        model.fc = torch.nn.Identity()
+        model.load_state_dict(torch.load(weights_path, map_location="cpu", weights_only=True))
+    else:
+        model = quantization.resnet18(pretrained=True, quantize=True)
+    model.fc = torch.nn.Identity()  # la sortie déquantifiée est alors le vecteur [N, 512]
+    model.eval()
+    return model
+
+def build_embedding_runner(mode="eager", channels_last=False, num_threads=None, onnx_path="resnet18_embedding.onnx",
+                           weights_path=None):
+    """Construit la fonction d'inférence batch (tenseur [N, 3, 224, 224] -> ndarray [N, 512]).
+
+    mode : eager (référence float32), quantized (int8), torchscript (trace + torch.jit.freeze)
+    ou onnx (export puis ONNX Runtime). channels_last et num_threads règlent le CPU.
+    weights_path : poids locaux (hors ligne), sinon téléchargement des poids torchvision.
+    """
+    if mode not in EMBEDDING_MODES:
+        raise ValueError(f"Unknown embedding mode '{mode}' (expected one of: {', '.join(EMBEDDING_MODES)})")
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    if mode == "onnx":
+        return _build_onnx_runner(onnx_path, num_threads, weights_path)
+
+    net = build_quantized_model(weights_path) if mode == "quantized" else build_reference_model(weights_path)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    if channels_last:
+        net = net.to(memory_format=memory_format)
+    if mode == "torchscript":
+        example = torch.randn(1, 3, 224, 224).contiguous(memory_format=memory_format)
+        with torch.no_grad():
+            net = torch.jit.freeze(torch.jit.trace(net, example))
+
+    def run(batch):
+        with torch.inference_mode():
+            output = net(batch.contiguous(memory_format=memory_format))
+        return output.reshape(len(batch), -1).numpy()
+    return run
+
+def _build_onnx_runner(onnx_path, num_threads, weights_path=None):
+    import onnxruntime
+
+    if not os.path.exists(onnx_path):
+        example = torch.randn(1, 3, 224, 224)
+        torch.onnx.export(
+            build_reference_model(weights_path), example, onnx_path,
+            input_names=["input"], output_names=["embedding"],
+            dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}},
+            dynamo=False,
+        )
+        print(f"Exported embedding model to {onnx_path}")
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+    session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def run(batch):
+        output = session.run(None, {"input": batch.numpy()})[0]
+        return output.reshape(len(batch), -1)
+    return run
+
+def runner_config_from_env():
+    """Options d'inférence lues dans EMBEDDING_MODE, EMBEDDING_CHANNELS_LAST, EMBEDDING_THREADS,
+    EMBEDDING_ONNX_PATH et EMBEDDING_WEIGHTS_PATH."""
+    return {
+        "mode": os.environ.get("EMBEDDING_MODE", "eager"),
+        "channels_last": os.environ.get("EMBEDDING_CHANNELS_LAST", "0") == "1",
+        "num_threads": int(os.environ["EMBEDDING_THREADS"]) if os.environ.get("EMBEDDING_THREADS") else None,
+        "onnx_path": os.environ.get("EMBEDDING_ONNX_PATH", "resnet18_embedding.onnx"),
+        "weights_path": os.environ.get("EMBEDDING_WEIGHTS_PATH") or None,
+    }
+
+# --- Modèle ResNet pour générer les embeddings ---
+# Construit à la première utilisation (ou par preload_embedding_model) puis partagé par tout le
+# processus. Chargé dans le maître gunicorn avant le fork, ses poids sont partagés en
+# copy-on-write par les workers au lieu d'être dupliqués.
+_runner = None
+_runner_lock = threading.Lock()
+_runner_config = runner_config_from_env()
+
+def configure_embedding_model(**options):
+    """Change les options du modèle (mode, weights_path...) avant son chargement ; None = inchangé."""
+    options = {key: value for key, value in options.items() if value is not None}
+    with _runner_lock:
+        if _runner is not None and any(_runner_config.get(key) != value for key, value in options.items()):
+            raise RuntimeError("The embedding model is already loaded with other options")
+        _runner_config.update(options)
+
+def get_embedding_runner():
+    """Fonction d'inférence du processus, construite au premier appel."""
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                started = time.perf_counter()
+                _runner = build_embedding_runner(**_runner_config)
+                print(f"Loaded {_runner_config['mode']} embedding model in {time.perf_counter() - started:.1f}s")
+    return _runner
+
+preload_embedding_model = get_embedding_runner
+# Définir la transformation pour les images
+preprocess = transforms.Compose([
+    transforms.Resize(256),
+    transforms.CenterCrop(224),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+])
+
+def load_image_tensor(image_bytes):
+    """Décode une image et applique le prétraitement ResNet (tenseur [3, 224, 224] ou None)."""
+    try:
+        with metrics.stage("image_decode"):
+            image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+            return preprocess(image)
+    except Exception as e:
+        print(f"Error decoding image: {e}")
+        return None
+
+def generate_embeddings_batch(input_tensors):
+    """Passe un lot de tenseurs prétraités dans le modèle en un seul forward.
+
+    Retourne une liste de vecteurs numpy de 512 floats (None pour tout le lot en cas d'erreur)."""
+    try:
+        runner = get_embedding_runner()
+        with metrics.stage("embedding_inference"):
+            return list(runner(torch.stack(input_tensors)))
+    except Exception as e:
+        print(f"Error generating embeddings: {e}")
+        return [None] * len(input_tensors)
+
+def generate_embedding(image_bytes):
+    """Génère un embedding (vecteur numpy de 512 floats) à partir des bytes d'une image."""
+    input_tensor = load_image_tensor(image_bytes)
+    if input_tensor is None:
+        return None
+    return generate_embeddings_batch([input_tensor])[0]
+
+
+class EmbeddingService:
+    """Worker d'inférence partagé par les threads de requêtes.
+
+    Chaque appelant décode et prétraite son image dans son propre thread, puis dépose
+    le tenseur dans une file. Un thread unique regroupe les tenseurs en attente en un
+    micro-lot (au plus max_batch_size images, en attendant au plus max_wait_ms après
+    la première) et fait un seul forward ResNet pour tout le lot.
+
+    Le thread est démarré à la première requête de chaque processus : un service créé
+    avant un fork (gunicorn --preload) fonctionne donc aussi dans les workers.
+    """
+
+    def __init__(self, max_batch_size=16, max_wait_ms=10):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._images = 0
+        self._errors = 0
+        self._inference_seconds = 0.0
+        self._queue_wait_seconds = 0.0
+        self._worker = None
+        self._worker_pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._worker_pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._worker_pid != os.getpid():
+                # Les threads ne survivent pas au fork : nouvelle file et nouveau worker
+                self._queue = queue.Queue()
+                self._worker = threading.Thread(target=self._run, args=(self._queue,), name="embedding-service", daemon=True)
+                self._worker.start()
+                self._worker_pid = os.getpid()
+
+    def submit(self, image_bytes):
+        """Retourne un Future dont le résultat est l'embedding (ou None si l'image est illisible)."""
+        future = Future()
+        input_tensor = load_image_tensor(image_bytes)
+        if input_tensor is None:
+            future.set_result(None)
+        else:
+            self._ensure_worker()
+            self._queue.put((input_tensor, future, time.perf_counter()))
+        return future
+
+    def embed(self, image_bytes, timeout=EMBED_TIMEOUT):
+        """Version bloquante de submit() ; lève TimeoutError si l'embedding n'est pas prêt à temps."""
+        return self.submit(image_bytes).result(timeout=timeout)
+
+    def _next_batch(self, pending):
+        batch = [pending.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, pending):
+        while True:
+            batch = self._next_batch(pending)
+            started = time.perf_counter()
+            embeddings = generate_embeddings_batch([input_tensor for input_tensor, _, _ in batch])
+            elapsed = time.perf_counter() - started
+            for (_, future, _), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+            metrics.EMBEDDING_BATCH_SIZE.observe(len(batch))
+            for _, _, queued_at in batch:
+                metrics.STAGE_SECONDS.observe(started - queued_at, stage="embedding_queue_wait")
+            with self._stats_lock:
+                self._batch_sizes[len(batch)] += 1
+                self._images += len(batch)
+                self._errors += sum(1 for embedding in embeddings if embedding is None)
+                self._inference_seconds += elapsed
+                self._queue_wait_seconds += sum(started - queued_at for _, _, queued_at in batch)
+
+    def stats(self):
+        """Profondeur de file, distribution des tailles de lot et temps moyens."""
+        with self._stats_lock:
+            batches = sum(self._batch_sizes.values())
+            return {
+                "queue_depth": self._queue.qsize(),
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000,
+                "batches": batches,
+                "images": self._images,
+                "errors": self._errors,
+                "mean_batch_size": self._images / batches if batches else 0.0,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "mean_inference_ms": 1000 * self._inference_seconds / batches if batches else 0.0,
+                "mean_queue_wait_ms": 1000 * self._queue_wait_seconds / self._images if self._images else 0.0,
+            }
+
+
+def service_from_env():
+    """EmbeddingService configuré par EMBEDDING_MAX_BATCH et EMBEDDING_MAX_WAIT_MS."""
+    return EmbeddingService(
+        max_batch_size=int(os.environ.get("EMBEDDING_MAX_BATCH", 16)),
+        max_wait_ms=float(os.environ.get("EMBEDDING_MAX_WAIT_MS", 10)),
+    )
+
+
+def check_parity(images, mode, channels_last=False, num_threads=None, batch_size=16, onnx_path="resnet18_embedding.onnx",
+                 weights_path=None, reference_weights_path=None):
+    """Compare les embeddings d'un mode optimisé à ceux du modèle eager float32 de référence.
+
+    reference_weights_path : poids float32 de la référence ; par défaut weights_path, sauf en
+    mode quantized (poids int8) où la référence prend les poids torchvision.
+    Retourne la similarité cosinus (min / moyenne) entre les deux versions et le temps
+    d'inférence moyen par image de chacune."""
+    tensors = [tensor for tensor in (load_image_tensor(image) for image in images) if tensor is not None]
+    if not tensors:
+        raise ValueError("No decodable image in the parity sample")
+    if reference_weights_path is None and mode != "quantized":
+        reference_weights_path = weights_path
+    reference = build_embedding_runner("eager", num_threads=num_threads, weights_path=reference_weights_path)
+    optimized = build_embedding_runner(mode, channels_last=channels_last, num_threads=num_threads, onnx_path=onnx_path,
+                                       weights_path=weights_path)
+
+    def timed_embeddings(runner):
+        runner(torch.stack(tensors[:1]))  # warm-up
+        started = time.perf_counter()
+        outputs = [runner(torch.stack(tensors[i:i + batch_size])) for i in range(0, len(tensors), batch_size)]
+        return np.concatenate(outputs), (time.perf_counter() - started) / len(tensors)
+
+    expected, reference_seconds = timed_embeddings(reference)
+    actual, optimized_seconds = timed_embeddings(optimized)
+    cosine = np.sum(expected * actual, axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1) + 1e-12)
+    return {
+        "mode": mode,
+        "images": len(tensors),
+        "cosine_min": float(cosine.min()),
+        "cosine_mean": float(cosine.mean()),
+        "reference_ms_per_image": 1000 * reference_seconds,
+        "optimized_ms_per_image": 1000 * optimized_seconds,
+        "speedup": reference_seconds / optimized_seconds if optimized_seconds else float("inf"),
+    }
+
+
+if __name__ == '__main__':
+    # Vérification de parité d'un mode optimisé sur un échantillon de posters :
+    #   python embedding_service.py --mode quantized --images posters/
+    #   python embedding_service.py --mode onnx --from-mongo 200 --threads 4
+    # Copie locale des poids pour un démarrage hors ligne (EMBEDDING_WEIGHTS_PATH) :
+    #   python embedding_service.py --mode eager --export-weights resnet18.pth
+    parser = argparse.ArgumentParser(description="Check optimized embedding inference against the float32 reference")
+    parser.add_argument("--mode", choices=EMBEDDING_MODES, required=True)
+    parser.add_argument("--images", help="directory of sample poster images")
+    parser.add_argument("--from-mongo", type=int, default=0, help="sample N posters from GridFS instead")
+    parser.add_argument("--channels-last", action="store_true")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--onnx-path", default="resnet18_embedding.onnx")
+    parser.add_argument("--weights", default=_runner_config["weights_path"], help="local weights file (state_dict)")
+    parser.add_argument("--reference-weights", help="float32 weights of the reference (default: --weights, "
+                                                    "or torchvision's for --mode quantized)")
+    parser.add_argument("--export-weights", metavar="PATH", help="save the weights used by --mode to PATH and exit")
+    args = parser.parse_args()
+
+    if args.export_weights:
+        if args.mode == "quantized":
+            model = build_quantized_model(args.weights)
+        else:
+            model = models.resnet18(pretrained=True)
+        torch.save(model.state_dict(), args.export_weights)
+        print(f"Saved {args.mode} weights to {args.export_weights}")
+        raise SystemExit(0)
+
+    if args.images:
+        samples = []
+        for name in sorted(os.listdir(args.images)):
+            with open(os.path.join(args.images, name), "rb") as f:
+                samples.append(f.read())
+    elif args.from_mongo:
+        import gridfs
+        from bson.objectid import ObjectId
+        from pymongo import MongoClient
+
+        client = MongoClient("mongodb://localhost:27017/")
+        db = client["movie_database"]
+        fs = gridfs.GridFS(db)
+        movies = db["movies"].aggregate([{"$match": {"image_id": {"$ne": None}}}, {"$sample": {"size": args.from_mongo}}])
+        samples = [fs.get(ObjectId(str(movie["image_id"]))).read() for movie in movies]
+        client.close()
+    else:
+        parser.error("one of --images or --from-mongo is required")
+
+    report = check_parity(samples, args.mode, args.channels_last, args.threads, args.batch_size, args.onnx_path,
+                          args.weights, args.reference_weights)
+    for key, value in report.items():
+        print(f"{key:>24}: {value:.4f}" if isinstance(value, float) else f"{key:>24}: {value}")
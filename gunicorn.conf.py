@@ -0,0 +1,25 @@
+# Configuration gunicorn :  gunicorn -c gunicorn.conf.py
+#
+# L'application (et le modèle ResNet, et les index) est construite une seule fois dans le
+# processus maître puis les workers sont forkés : les poids et les matrices d'index sont
+# partagés en copy-on-write au lieu d'être rechargés par chaque worker.
+import multiprocessing
+import os
+
+os.environ.setdefault("PRELOAD_MODEL", "1")
+
+wsgi_app = "app:create_app()"
+preload_app = True
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", max(multiprocessing.cpu_count() // 2, 1)))
+# Plusieurs threads par worker pour que le service d'embeddings forme des micro-lots
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+
+
+def post_fork(server, worker):
+    # Un MongoClient ne doit pas être partagé entre processus : chaque worker ouvre le sien
+    import app
+
+    app.connect_mongo(server.app.wsgi().config)
@@ -0,0 +1,287 @@
+"""Mesures de latence des chemins chauds, exposées au format texte Prometheus.
+
+    with metrics.stage("mongo_find"):
+        movies = list(collection.find(...))
+
+Chaque étape alimente l'histogramme cinematch_stage_seconds{stage=...}. Si une trace est
+ouverte pour la requête en cours (start_trace), ses durées y sont aussi ajoutées pour
+l'en-tête Server-Timing. Les valeurs sont propres à chaque processus : avec plusieurs
+workers gunicorn, chacun expose ses propres compteurs.
+"""
+import bisect
+import contextlib
+import contextvars
+import os
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bornes (secondes) des histogrammes de latence : de 0,5 ms à 30 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            # Même nom = même série (create_app peut être appelé plusieurs fois)
+            _registry[name] = self
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}" for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """Valeur lue au moment du scrape (profondeur de file, taille d'index...)."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def _samples(self):
+        try:
+            return [f"{self.name} {_number(self.function())}"]
+        except Exception as e:
+            print(f"Error reading gauge {self.name}: {e}")
+            return []
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [compte par intervalle (le dernier = +Inf), somme, nombre]
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def totals(self):
+        """{valeurs des labels: (nombre, somme)}."""
+        with self._lock:
+            return {key: (series[2], series[1]) for key, series in self._series.items()}
+
+    def _samples(self):
+        with self._lock:
+            snapshot = {key: ([*series[0]], series[1], series[2]) for key, series in self._series.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket_count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == "+Inf" else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {repr(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+
+def render():
+    """Toutes les métriques du processus au format d'exposition texte de Prometheus."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram("cinematch_stage_seconds", "Duration of each hot-path stage.", labels=("stage",))
+REQUEST_SECONDS = Histogram("cinematch_request_seconds", "Duration of HTTP requests (until the handler returns).",
+                            labels=("endpoint", "method", "status"))
+EMBEDDING_BATCH_SIZE = Histogram("cinematch_embedding_batch_size", "Images per inference micro-batch.",
+                                 buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+EMBEDDING_TIMEOUTS = Counter("cinematch_embedding_timeouts_total",
+                             "Poster searches answered 503 because inference did not finish in time.",
+                             labels=("endpoint",))
+
+# --- Traces par requête ---
+_trace = contextvars.ContextVar("cinematch_trace", default=None)
+
+
+def start_trace():
+    """Ouvre une trace pour la requête (ou la tâche) en cours."""
+    _trace.set([])
+
+
+def end_trace():
+    """Ferme la trace en cours et retourne ses étapes [(nom, secondes), ...]."""
+    trace = _trace.get()
+    _trace.set(None)
+    return trace or []
+
+
+def server_timing(trace, total=None):
+    """Valeur d'en-tête Server-Timing : durée cumulée de chaque étape, en millisecondes."""
+    durations = {}
+    for name, seconds in trace:
+        durations[name] = durations.get(name, 0.0) + seconds
+    if total is not None:
+        durations["total"] = total
+    return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in durations.items())
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Chronomètre un bloc (ou une fonction, en décorateur) sous le nom d'étape donné."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((name, elapsed))
+
+
+def stage_summary():
+    """{étape: (nombre, secondes cumulées)} du processus, pour un résumé en fin de script."""
+    return {key[0]: totals for key, totals in sorted(STAGE_SECONDS.totals().items())}
+
+
+def serve(port, host="0.0.0.0"):
+    """Expose /metrics sur un petit serveur HTTP en arrière-plan (scripts sans Flask, comme scrap.py)."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+class SamplingProfiler:
+    """Profileur par échantillonnage, activable à chaud sur un serveur en production.
+
+    Un thread relève toutes les interval secondes la pile de chaque thread du processus
+    (sys._current_frames) et compte les piles identiques. Le résultat est au format
+    « piles repliées » (fichier:fonction;...;fichier:fonction N), lisible par flamegraph.pl
+    ou speedscope. Le coût est proportionnel à la fréquence, pas au nombre de requêtes.
+    """
+
+    def __init__(self, interval=0.01, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self._stacks = _Tally()
+        self._samples = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        with self._lock:
+            self._stacks.clear()
+            self._samples = 0
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _stack(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            stacks = [self._stack(frame) for thread_id, frame in sys._current_frames().items() if thread_id != own_id]
+            with self._lock:
+                self._stacks.update(stacks)
+                self._samples += 1
+
+    def collapsed(self):
+        """Piles repliées, de la plus fréquente à la moins fréquente."""
+        with self._lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self._stacks.most_common())
+
+    def stats(self):
+        with self._lock:
+            return {"running": self.running, "samples": self._samples, "interval_ms": self.interval * 1000,
+                    "distinct_stacks": len(self._stacks), "started_at": self.started_at}
@@ -0,0 +1,220 @@
+import argparse
+import datetime
+import os
+import time
+
+import numpy as np
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, UpdateOne
+
+from embedding_codec import decode_embedding
+from vector_index import EmbeddingIndex
+
+# Listes de films similaires précalculées, une par film, dans la collection movie_neighbors :
+#   {_id: id du film, neighbors: [{id, score, title, poster_id}, ...]}
+# Titre et poster sont recopiés pour que la page détail n'ait qu'une lecture indexée à faire.
+NEIGHBOR_COUNT = int(os.environ.get("NEIGHBOR_COUNT", 12))
+NEIGHBOR_PROJECTION = {"embedding": 1, "title": 1, "image_id": 1, "poster_variants.thumb": 1}
+
+
+def enqueue_neighbor_update(queue, movie_id):
+    """Signale au job de voisinage qu'un film a été édité ou supprimé (les insertions sont détectées seules)."""
+    queue.insert_one({"movie_id": ObjectId(movie_id), "queued_at": datetime.datetime.utcnow()})
+
+
+def movie_summary(movie):
+    poster_id = (movie.get("poster_variants") or {}).get("thumb") or movie.get("image_id")
+    return {"title": movie.get("title", "No title"), "poster_id": str(poster_id) if poster_id else None}
+
+
+class NeighborGraph:
+    """Top-N des voisins de poster de chaque film, tenu à jour sans recalculer les N² paires.
+
+    rebuild() calcule toutes les listes par blocs de lignes (produit matriciel bloc x catalogue).
+    Ensuite, un film inséré ou modifié coûte un produit matrice-vecteur : sa propre liste, plus
+    l'insertion dans les listes dont il dépasse le score minimal. Seules les listes qui le
+    contenaient déjà (index inverse _referrers) sont recalculées, une à une.
+    """
+
+    def __init__(self, movies, neighbors, queue, n=NEIGHBOR_COUNT, dim=512, block_size=1024):
+        self.movies = movies
+        self.neighbors = neighbors
+        self.queue = queue
+        self.n = n
+        self.block_size = block_size
+        self.index = EmbeddingIndex(dim)
+        self._summaries = {}
+        self._lists = {}
+        self._referrers = {}
+
+    def _track(self, movie):
+        movie_id = str(movie["_id"])
+        self._summaries[movie_id] = movie_summary(movie)
+        return self.index.add(movie_id, decode_embedding(movie.get("embedding")))
+
+    def load(self):
+        """Charge embeddings, titres et listes existantes ; retourne les films sans liste."""
+        last_id = None
+        for movie in self.movies.find({"embedding": {"$ne": None}}, NEIGHBOR_PROJECTION).sort("_id", 1):
+            self._track(movie)
+            last_id = movie["_id"]
+        self.index._last_object_id = last_id
+        for doc in self.neighbors.find({}, {"neighbors.id": 1, "neighbors.score": 1}):
+            movie_id = str(doc["_id"])
+            if movie_id in self.index:
+                self._set_list(movie_id, [(entry["score"], str(entry["id"])) for entry in doc["neighbors"]])
+        return [movie_id for movie_id in self.index._ids if movie_id not in self._lists]
+
+    def _set_list(self, movie_id, entries):
+        for _, neighbor_id in self._lists.get(movie_id, []):
+            self._referrers.get(neighbor_id, set()).discard(movie_id)
+        self._lists[movie_id] = entries
+        for _, neighbor_id in entries:
+            self._referrers.setdefault(neighbor_id, set()).add(movie_id)
+
+    def _top(self, scores, row):
+        """Top-n d'une ligne de scores (alignée sur les lignes de l'index), sans le film lui-même."""
+        scores[row] = -np.inf
+        k = min(self.n, len(scores) - 1)
+        if k <= 0:
+            return []
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(float(scores[i]), self.index._ids[i]) for i in top]
+
+    def _recompute(self, movie_id):
+        row = self.index._positions[movie_id]
+        matrix = self.index._matrix[:len(self.index)]
+        self._set_list(movie_id, self._top(matrix @ matrix[row], row))
+
+    def _threshold(self, movie_id):
+        entries = self._lists.get(movie_id, [])
+        return entries[-1][0] if len(entries) >= self.n else -np.inf
+
+    def _write(self, movie_ids, deleted=()):
+        operations = [DeleteOne({"_id": ObjectId(movie_id)}) for movie_id in deleted]
+        now = datetime.datetime.utcnow()
+        for movie_id in movie_ids:
+            if movie_id not in self._lists:
+                continue
+            entries = [
+                {"id": ObjectId(neighbor_id), "score": score, **self._summaries[neighbor_id]}
+                for score, neighbor_id in self._lists[movie_id]
+            ]
+            operations.append(UpdateOne({"_id": ObjectId(movie_id)},
+                                        {"$set": {"neighbors": entries, "updated_at": now}}, upsert=True))
+        if operations:
+            self.neighbors.bulk_write(operations, ordered=False)
+
+    def rebuild(self):
+        """Recalcule toutes les listes : un produit (bloc x catalogue) par bloc de block_size films."""
+        size = len(self.index)
+        matrix = self.index._matrix[:size]
+        for start in range(0, size, self.block_size):
+            scores = matrix[start:start + self.block_size] @ matrix.T
+            block_ids = self.index._ids[start:start + self.block_size]
+            for offset, movie_id in enumerate(block_ids):
+                self._set_list(movie_id, self._top(scores[offset], start + offset))
+            self._write(block_ids)
+            print(f"Neighbors computed for {min(start + self.block_size, size)}/{size} movies")
+        return size
+
+    def update(self, movie_ids):
+        """Applique les insertions/éditions/suppressions des films donnés en relisant leur état en base."""
+        movie_ids = list(dict.fromkeys(str(movie_id) for movie_id in movie_ids))
+        docs = {str(doc["_id"]): doc for doc in self.movies.find(
+            {"_id": {"$in": [ObjectId(movie_id) for movie_id in movie_ids]}}, NEIGHBOR_PROJECTION)}
+        # Les listes qui contenaient ces films (ancien vecteur, ancien titre) sont à revoir
+        stale = set()
+        for movie_id in movie_ids:
+            stale |= self._referrers.get(movie_id, set())
+        deleted, upserted = [], []
+        for movie_id in movie_ids:
+            if movie_id in docs and self._track(docs[movie_id]):
+                upserted.append(movie_id)
+            else:
+                # Supprimé, ou plus d'embedding : plus de liste à lui
+                self.index.remove(movie_id)
+                self._summaries.pop(movie_id, None)
+                self._set_list(movie_id, [])
+                del self._lists[movie_id]
+                self._referrers.pop(movie_id, None)
+                deleted.append(movie_id)
+        stale -= set(deleted)
+        changed = set(upserted)
+        for movie_id in stale:
+            if movie_id in self.index:
+                self._recompute(movie_id)
+                changed.add(movie_id)
+
+        if upserted:
+            matrix = self.index._matrix[:len(self.index)]
+            rows = [self.index._positions[movie_id] for movie_id in upserted]
+            scores = matrix @ matrix[rows].T
+            thresholds = np.array([self._threshold(movie_id) for movie_id in self.index._ids], dtype=np.float32)
+            for column, (movie_id, row) in enumerate(zip(upserted, rows)):
+                column_scores = scores[:, column]
+                self._set_list(movie_id, self._top(column_scores.copy(), row))
+                # Le film entre dans les listes dont il bat le plus faible voisin
+                for i in np.flatnonzero(column_scores > thresholds):
+                    other_id = self.index._ids[i]
+                    if other_id == movie_id or other_id in stale:
+                        continue
+                    entries = [entry for entry in self._lists.get(other_id, []) if entry[1] != movie_id]
+                    entries.append((float(column_scores[i]), movie_id))
+                    entries.sort(reverse=True)
+                    self._set_list(other_id, entries[:self.n])
+                    thresholds[i] = self._threshold(other_id)
+                    changed.add(other_id)
+        self._write(changed, deleted)
+        return len(changed) + len(deleted)
+
+    def poll(self):
+        """Traite la file des éditions/suppressions et les films insérés depuis le dernier passage."""
+        movie_ids = []
+        query = {"embedding": {"$ne": None}}
+        if self.index._last_object_id is not None:
+            query["_id"] = {"$gt": self.index._last_object_id}
+        for movie in self.movies.find(query, {"_id": 1}).sort("_id", 1):
+            movie_ids.append(movie["_id"])
+            self.index._last_object_id = movie["_id"]
+        jobs = list(self.queue.find().sort("_id", 1).limit(10000))
+        movie_ids += [job["movie_id"] for job in jobs]
+        updated = self.update(movie_ids) if movie_ids else 0
+        if jobs:
+            self.queue.delete_many({"_id": {"$in": [job["_id"] for job in jobs]}})
+        return updated
+
+
+if __name__ == '__main__':
+    #   python neighbors.py --rebuild            calcul complet
+    #   python neighbors.py --watch --interval 30  mise à jour incrémentale en continu
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Precompute similar-movie neighbor lists")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--rebuild", action="store_true", help="recompute every list from scratch")
+    parser.add_argument("--watch", action="store_true", help="keep applying inserts, edits and deletes")
+    parser.add_argument("--interval", type=float, default=30)
+    parser.add_argument("--neighbors", type=int, default=NEIGHBOR_COUNT)
+    parser.add_argument("--block-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    db = client["movie_database"]
+    db["movie_neighbors"].create_index("neighbors.id")
+    graph = NeighborGraph(db["movies"], db["movie_neighbors"], db["neighbor_updates"],
+                          n=args.neighbors, block_size=args.block_size)
+    missing = graph.load()
+    start = time.perf_counter()
+    if args.rebuild or len(missing) == len(graph.index):
+        graph.rebuild()
+    elif missing:
+        graph.update(missing)
+    print(f"Neighbor lists ready for {len(graph.index)} movies in {time.perf_counter() - start:.1f}s")
+    while args.watch:
+        time.sleep(args.interval)
+        updated = graph.poll()
+        if updated:
+            print(f"Updated {updated} neighbor lists")
+    client.close()
@@ -0,0 +1,357 @@
+import argparse
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from bson.objectid import ObjectId
+from PIL import Image
+from pymongo import UpdateOne
+
+from embedding_codec import decode_embedding
+from poster_derivatives import ensure_poster_indexes, release_poster
+from vector_index import changed_documents, normalize
+
+# Empreintes perceptuelles des posters, stockées sur chaque film (hexadécimal, 64 bits) :
+#   poster_phash : DCT 32x32, robuste au redimensionnement et à la recompression JPEG
+#   poster_dhash : gradients horizontaux 9x8, sert à confirmer une correspondance pHash
+# Deux affiches sont considérées identiques si les deux distances de Hamming sont <= au seuil.
+DUPLICATE_DISTANCE = int(os.environ.get("POSTER_DUPLICATE_DISTANCE", 2))  # fusion des fichiers GridFS
+MATCH_DISTANCE = int(os.environ.get("POSTER_MATCH_DISTANCE", 4))  # réponse directe de search_by_poster
+HASH_FIELDS = ("poster_phash", "poster_dhash")
+# Énergie moyenne des coefficients DCT basse fréquence (hors continu) sous laquelle l'image est
+# quasi uniforme (affiche noire, placeholder) : son pHash ne dépend que du bruit, elle n'est pas hachée
+MIN_DCT_ENERGY = float(os.environ.get("POSTER_MIN_DCT_ENERGY", 2.0))
+# Deux affiches proches en pHash mais pas identiques octet pour octet ne partagent un fichier
+# que si leurs embeddings le confirment
+SHARE_MIN_COSINE = float(os.environ.get("POSTER_SHARE_MIN_COSINE", 0.98))
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+_DCT = _dct_matrix(32)
+
+
+def _bits(values):
+    return int.from_bytes(np.packbits(values.reshape(-1)).tobytes(), "big")
+
+
+def image_hashes(image):
+    """(pHash, dHash) 64 bits d'une image PIL, ou None si elle est quasi uniforme."""
+    gray = image.convert("L")
+    pixels = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float32)
+    # Coefficients basse fréquence 8x8 comparés à leur médiane (hors composante continue)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].reshape(-1)
+    if np.abs(low[1:]).mean() < MIN_DCT_ENERGY:
+        return None
+    phash = _bits(low > np.median(low[1:]))
+    small = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    dhash = _bits(small[:, 1:] > small[:, :-1])
+    return phash, dhash
+
+
+def poster_hashes(image_bytes):
+    """{poster_phash, poster_dhash} d'une affiche, ou {} si elle est absente, illisible ou uniforme."""
+    if not image_bytes:
+        return {}
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            # JPEG : décodage directement à une fraction de la taille, il ne faut que 32x32 pixels
+            image.draft("L", (64, 64))
+            hashes = image_hashes(image)
+    except Exception as e:
+        print(f"Error hashing poster: {e}")
+        return {}
+    if hashes is None:
+        return {}
+    phash, dhash = hashes
+    return {"poster_phash": f"{phash:016x}", "poster_dhash": f"{dhash:016x}"}
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Arbre BK sur la distance de Hamming : recherche des clés à distance <= d sans tout parcourir.
+
+    Chaque nœud est [clé, {distance: enfant}, ensemble de valeurs]. Retirer une valeur ne
+    supprime pas le nœud, qui reste un point de passage pour ses enfants."""
+
+    def __init__(self):
+        self._root = None
+
+    def add(self, key, value):
+        if self._root is None:
+            self._root = [key, {}, {value}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[2].add(value)
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [key, {}, {value}]
+                return
+            node = child
+
+    def discard(self, key, value):
+        node = self._root
+        while node is not None:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[2].discard(value)
+                return
+            node = node[1].get(distance)
+
+    def find(self, key, max_distance):
+        """[(distance, valeur), ...] pour toutes les clés à distance <= max_distance."""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance:
+                found.extend((distance, value) for value in node[2])
+            # Inégalité triangulaire : seuls ces sous-arbres peuvent contenir des clés assez proches
+            for child_distance, child in node[1].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return found
+
+
+class PosterHashIndex:
+    """Index des empreintes de posters du catalogue (BK-tree sur le pHash, confirmé par le dHash).
+
+    Chargé et rafraîchi depuis MongoDB comme les index vectoriel et texte."""
+
+    def __init__(self):
+        self._tree = BKTree()
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._last_object_id = None
+        self._last_updated_at = None
+        self._last_refresh = 0.0
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, movie_id, hashes):
+        if not hashes or not hashes.get("poster_phash"):
+            return self.remove(movie_id)
+        movie_id = str(movie_id)
+        phash, dhash = int(hashes["poster_phash"], 16), int(hashes["poster_dhash"], 16)
+        with self._lock:
+            previous = self._hashes.get(movie_id)
+            if previous is not None:
+                self._tree.discard(previous[0], movie_id)
+            self._hashes[movie_id] = (phash, dhash)
+            self._tree.add(phash, movie_id)
+        return True
+
+    def remove(self, movie_id):
+        movie_id = str(movie_id)
+        with self._lock:
+            previous = self._hashes.pop(movie_id, None)
+            if previous is None:
+                return False
+            self._tree.discard(previous[0], movie_id)
+        return True
+
+    def match(self, hashes, max_distance=MATCH_DISTANCE):
+        """Films dont le poster est à distance <= max_distance (pHash et dHash) : [(movie_id, distance pHash)]."""
+        if not hashes or not hashes.get("poster_phash"):
+            return []
+        phash, dhash = int(hashes["poster_phash"], 16), int(hashes["poster_dhash"], 16)
+        with self._lock:
+            candidates = self._tree.find(phash, max_distance)
+            matches = [(movie_id, distance) for distance, movie_id in candidates
+                       if hamming(dhash, self._hashes[movie_id][1]) <= max_distance]
+        return sorted(matches, key=lambda match: match[1])
+
+    def load_from_collection(self, collection, batch_size=1000):
+        """Charge (ou complète) l'index avec les films insérés ou modifiés depuis le dernier chargement."""
+        loaded = 0
+        query = {"poster_phash": {"$ne": None}}
+        for movie in changed_documents(self, collection, query, dict.fromkeys(HASH_FIELDS, 1), batch_size):
+            # add retire le film si son affiche n'a plus d'empreinte
+            loaded += self.add(movie["_id"], movie)
+        self._last_refresh = time.monotonic()
+        return loaded
+
+    def refresh_if_stale(self, collection, interval):
+        if interval is None or time.monotonic() - self._last_refresh < interval:
+            return 0
+        return self.load_from_collection(collection)
+
+
+# Champs repris d'un film dont on réutilise le poster
+DUPLICATE_PROJECTION = {"image_id": 1, "poster_variants": 1, "embedding": 1, "poster_sha256": 1}
+
+
+def same_poster(embedding, other):
+    """Confirme une correspondance pHash : cosinus des deux embeddings >= SHARE_MIN_COSINE."""
+    if embedding is None or other is None:
+        return False
+    embedding, other = normalize(embedding), normalize(other)
+    return embedding is not None and other is not None and float(embedding @ other) >= SHARE_MIN_COSINE
+
+
+def resolve_duplicates(hashes_list, hash_index, collection, digests, max_distance=DUPLICATE_DISTANCE):
+    """Pour chaque affiche d'un lot (empreintes et sha256), d'où prendre son poster.
+
+    Retourne (sources, confirmed). Une source est None pour une nouvelle affiche à stocker,
+    la position d'une affiche proche plus tôt dans le même lot, ou le document (image_id,
+    poster_variants, embedding) du film du catalogue qui a une affiche proche.
+    confirmed[i] est vrai si la source a le même sha256 : sinon le pHash seul ne suffit pas
+    (collisions), l'appelant encode l'affiche et garde la source si same_poster le confirme."""
+    batch = PosterHashIndex()
+    sources = []
+    for position, hashes in enumerate(hashes_list):
+        source = None
+        if hashes:
+            earlier = batch.match(hashes, max_distance)
+            if earlier:
+                source = int(earlier[0][0])
+            elif hash_index is not None:
+                existing = hash_index.match(hashes, max_distance)
+                source = existing[0][0] if existing else None
+            if source is None:
+                batch.add(position, hashes)
+        sources.append(source)
+
+    movie_ids = [ObjectId(source) for source in sources if isinstance(source, str)]
+    docs = {}
+    if movie_ids:
+        query = {"_id": {"$in": movie_ids}, "image_id": {"$ne": None}, "embedding": {"$ne": None}}
+        docs = {str(doc["_id"]): doc for doc in collection.find(query, DUPLICATE_PROJECTION)}
+    # Un film source supprimé entre-temps : l'affiche est stockée normalement
+    sources = [docs.get(source) if isinstance(source, str) else source for source in sources]
+    confirmed = []
+    for position, source in enumerate(sources):
+        if isinstance(source, int):
+            source_digest = digests[source]
+        else:
+            source_digest = source.get("poster_sha256") if source is not None else None
+        confirmed.append(source is not None and source_digest is not None and source_digest == digests[position])
+    return sources, confirmed
+
+
+def confirm_duplicates(sources, confirmed, embeddings):
+    """Écarte les sources non confirmées par sha256 dont l'embedding diffère (voir same_poster).
+
+    embeddings[i] est l'embedding de l'affiche i si elle a été encodée (source None ou non
+    confirmée), None sinon. Retourne les sources mises à jour."""
+    checked = list(sources)
+    for position, source in enumerate(sources):
+        if source is None or confirmed[position]:
+            continue
+        other = embeddings[source] if isinstance(source, int) else decode_embedding(source["embedding"])
+        if not same_poster(embeddings[position], other):
+            checked[position] = None
+    return checked
+
+
+def backfill_hashes(collection, fs, batch_size=200, workers=4):
+    """Calcule les empreintes des posters déjà en base qui n'en ont pas encore."""
+    done = 0
+    last_id = None
+
+    def process(movie):
+        try:
+            return poster_hashes(fs.get(ObjectId(movie["image_id"])).read())
+        except Exception as e:
+            print(f"Error reading poster {movie['image_id']} of movie {movie['_id']}: {e}")
+            return {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            query = {"image_id": {"$ne": None}, "poster_phash": {"$exists": False}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            movies = list(collection.find(query, {"image_id": 1}).sort("_id", 1).limit(batch_size))
+            if not movies:
+                break
+            last_id = movies[-1]["_id"]
+            operations = [UpdateOne({"_id": movie["_id"]}, {"$set": hashes, "$currentDate": {"updated_at": True}})
+                          for movie, hashes in zip(movies, pool.map(process, movies)) if hashes]
+            if operations:
+                collection.bulk_write(operations, ordered=False)
+            done += len(operations)
+            print(f"Hashed {done} posters")
+    return done
+
+
+def dedupe_catalog(collection, fs, max_distance=DUPLICATE_DISTANCE):
+    """Fait pointer les films aux affiches identiques vers un seul fichier GridFS (le plus ancien).
+
+    Une correspondance pHash/dHash n'est retenue que si le sha256 des deux affiches est le
+    même ou, à défaut, si leurs embeddings sont assez proches (same_poster). Chaque film
+    garde son embedding ; les fichiers qui ne sont plus référencés sont supprimés."""
+    canonical = PosterHashIndex()
+    posters = {}
+    repointed = freed = 0
+    query = {"image_id": {"$ne": None}, "poster_phash": {"$ne": None}}
+    projection = {"image_id": 1, "poster_variants": 1, "poster_sha256": 1, **dict.fromkeys(HASH_FIELDS, 1)}
+
+    def embedding_of(movie_id):
+        # Lu seulement pour confirmer une correspondance sans sha256 commun
+        doc = collection.find_one({"_id": ObjectId(movie_id)}, {"embedding": 1})
+        return decode_embedding(doc.get("embedding")) if doc else None
+
+    for movie in collection.find(query, projection).sort("_id", 1):
+        source = None
+        for match_id, _ in canonical.match(movie, max_distance):
+            digest = posters[match_id][2]
+            if (digest is not None and digest == movie.get("poster_sha256")) or \
+                    same_poster(embedding_of(movie["_id"]), embedding_of(match_id)):
+                source = match_id
+                break
+        if source is None:
+            canonical.add(movie["_id"], movie)
+            posters[str(movie["_id"])] = (movie["image_id"], movie.get("poster_variants"), movie.get("poster_sha256"))
+            continue
+        image_id, variants, _ = posters[source]
+        if str(image_id) == str(movie["image_id"]):
+            continue
+        collection.update_one({"_id": movie["_id"]}, {"$set": {"image_id": image_id, "poster_variants": variants}})
+        repointed += 1
+        freed += release_poster(collection, fs, movie["image_id"], movie.get("poster_variants"))
+    return repointed, freed
+
+
+if __name__ == '__main__':
+    #   python perceptual_hash.py --backfill   empreintes des posters existants
+    #   python perceptual_hash.py --dedupe     fusion des fichiers GridFS des affiches identiques
+    from gridfs import GridFS
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Perceptual hashes and duplicate poster removal")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--backfill", action="store_true", help="hash the posters that have no hash yet")
+    parser.add_argument("--dedupe", action="store_true", help="share one GridFS file between identical posters")
+    parser.add_argument("--max-distance", type=int, default=DUPLICATE_DISTANCE)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    db = client["movie_database"]
+    fs = GridFS(db)
+    # Les suppressions vérifient qu'aucun autre film ne référence encore le fichier
+    ensure_poster_indexes(db["movies"])
+    if args.backfill:
+        print(f"Done: {backfill_hashes(db['movies'], fs, args.batch_size, args.workers)} posters hashed")
+    if args.dedupe:
+        repointed, freed = dedupe_catalog(db["movies"], fs, args.max_distance)
+        print(f"Done: {repointed} movies now share a poster, {freed} GridFS posters deleted")
+    client.close()
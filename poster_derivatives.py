@@ -0,0 +1,165 @@
+import argparse
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.objectid import ObjectId
+from PIL import Image
+from pymongo import UpdateOne
+
+# Déclinaisons stockées à côté de chaque poster original : largeur cible et format.
+# Les listes affichent les vignettes (~15-25 Ko) au lieu de l'original (~500 Ko).
+DERIVATIVES = {
+    "thumb": (185, "JPEG"),
+    "thumb_webp": (185, "WEBP"),
+    "medium": (342, "JPEG"),
+    "medium_webp": (342, "WEBP"),
+}
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+SAVE_OPTIONS = {"JPEG": {"quality": 82, "optimize": True, "progressive": True}, "WEBP": {"quality": 78, "method": 4}}
+
+
+def render_derivatives(poster_bytes, names=None):
+    """Redimensionne un poster vers chaque déclinaison demandée : {nom: (octets, content_type)}.
+
+    Le redimensionnement n'agrandit jamais l'image et n'est fait qu'une fois par largeur."""
+    names = list(names or DERIVATIVES)
+    try:
+        with Image.open(io.BytesIO(poster_bytes)) as image:
+            image = image.convert("RGB")
+    except Exception as e:
+        print(f"Error reading poster for derivatives: {e}")
+        return {}
+    resized = {}
+    rendered = {}
+    for name in names:
+        width, image_format = DERIVATIVES[name]
+        if width not in resized:
+            copy = image.copy()
+            copy.thumbnail((width, width * 3), Image.LANCZOS)
+            resized[width] = copy
+        buffer = io.BytesIO()
+        resized[width].save(buffer, image_format, **SAVE_OPTIONS[image_format])
+        rendered[name] = (buffer.getvalue(), CONTENT_TYPES[image_format])
+    return rendered
+
+
+def store_derivatives(fs, poster_bytes, filename, names=None):
+    """Génère et écrit les déclinaisons dans GridFS ; retourne {nom: id GridFS}."""
+    return {
+        name: fs.put(data, filename=f"{filename}_{name}", content_type=content_type)
+        for name, (data, content_type) in render_derivatives(poster_bytes, names).items()
+    }
+
+
+def delete_derivatives(fs, variants):
+    for name, file_id in (variants or {}).items():
+        try:
+            fs.delete(file_id)
+        except Exception as e:
+            print(f"Error deleting poster derivative {name} {file_id}: {e}")
+
+
+def ensure_poster_indexes(collection):
+    """Index des références aux fichiers GridFS, lus par release_poster avant chaque suppression."""
+    collection.create_index("image_id")
+    for name in DERIVATIVES:
+        collection.create_index(f"poster_variants.{name}")
+
+
+def release_variants(collection, fs, variants):
+    """Supprime les déclinaisons qu'aucun film ne référence plus."""
+    variants = {name: file_id for name, file_id in (variants or {}).items() if file_id}
+    if not variants:
+        return
+    referenced = set()
+    query = {"$or": [{f"poster_variants.{name}": file_id} for name, file_id in variants.items()]}
+    for movie in collection.find(query, {"poster_variants": 1}):
+        referenced.update((movie.get("poster_variants") or {}).values())
+    delete_derivatives(fs, {name: file_id for name, file_id in variants.items() if file_id not in referenced})
+
+
+def release_poster(collection, fs, image_id, variants=None):
+    """Supprime un poster et ses déclinaisons de GridFS si plus aucun film ne les référence.
+
+    Les affiches identiques partagent le même fichier (voir perceptual_hash.py), mais
+    backfill_derivatives crée les déclinaisons film par film : elles sont vérifiées une à une.
+    À appeler après la mise à jour ou la suppression du film. Retourne True si le poster a été supprimé."""
+    release_variants(collection, fs, variants)
+    if not image_id:
+        return False
+    # image_id est un ObjectId (scrap.py) ou une chaîne (édition depuis l'admin)
+    if collection.find_one({"image_id": {"$in": [ObjectId(image_id), str(image_id)]}}, {"_id": 1}):
+        return False
+    try:
+        fs.delete(ObjectId(image_id))
+    except Exception as e:
+        print(f"Error deleting poster {image_id}: {e}")
+    return True
+
+
+def missing_derivatives_query():
+    """Films ayant un poster mais au moins une déclinaison manquante."""
+    return {
+        "image_id": {"$ne": None},
+        "$or": [{f"poster_variants.{name}": {"$exists": False}} for name in DERIVATIVES],
+    }
+
+
+def backfill_derivatives(collection, fs, batch_size=100, workers=4):
+    """Génère par lots les déclinaisons manquantes des posters déjà en base.
+
+    Seules les tailles absentes sont créées ($set champ par champ), on peut donc relancer
+    la commande après l'ajout d'une nouvelle déclinaison ou une interruption."""
+    done = 0
+    last_id = None
+
+    def process(movie):
+        missing = [name for name in DERIVATIVES if name not in (movie.get("poster_variants") or {})]
+        try:
+            # image_id est un ObjectId (scrap.py) ou sa forme texte (edit_movie)
+            poster_bytes = fs.get(ObjectId(movie["image_id"])).read()
+        except Exception as e:
+            print(f"Error reading poster {movie['image_id']} of movie {movie['_id']}: {e}")
+            return None
+        return store_derivatives(fs, poster_bytes, f"{movie.get('title', 'movie')}_poster", missing)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            query = missing_derivatives_query()
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            movies = list(collection.find(query, {"image_id": 1, "poster_variants": 1, "title": 1})
+                          .sort("_id", 1).limit(batch_size))
+            if not movies:
+                break
+            last_id = movies[-1]["_id"]
+            operations = []
+            for movie, variants in zip(movies, pool.map(process, movies)):
+                if variants:
+                    operations.append(UpdateOne(
+                        {"_id": movie["_id"]},
+                        {"$set": {f"poster_variants.{name}": file_id for name, file_id in variants.items()}},
+                    ))
+            if operations:
+                collection.bulk_write(operations, ordered=False)
+            done += len(operations)
+            print(f"Generated derivatives for {done} posters")
+    return done
+
+
+if __name__ == '__main__':
+    #   python poster_derivatives.py --batch-size 100 --workers 4
+    from gridfs import GridFS
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Backfill missing poster thumbnails / WebP derivatives")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    db = client["movie_database"]
+    total = backfill_derivatives(db["movies"], GridFS(db), args.batch_size, args.workers)
+    print(f"Done: {total} posters updated")
+    client.close()
@@ -0,0 +1,145 @@
+import argparse
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from embedding_codec import decode_embedding
+
+# Projection PCA des embeddings ResNet (512-d) vers out_dim dimensions, apprise hors ligne
+# sur le catalogue. Chaque ajustement produit une version (hash du contenu) ; un index
+# construit avec une version refuse de se recharger avec une autre.
+
+
+class Projection:
+    """x -> (x - mean) @ components.T, divisé par l'écart-type de chaque axe si whiten."""
+
+    def __init__(self, mean, components, explained_variance, whiten=False, n_samples=0, fitted_at=None):
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.explained_variance = np.asarray(explained_variance, dtype=np.float32)
+        self.whiten = whiten
+        self.n_samples = n_samples
+        self.fitted_at = fitted_at
+        self._scale = 1 / np.sqrt(self.explained_variance + 1e-8) if whiten else None
+        digest = hashlib.sha256(self.mean.tobytes() + self.components.tobytes() + bytes([whiten]))
+        self.version = digest.hexdigest()[:12]
+
+    @property
+    def in_dim(self):
+        return self.components.shape[1]
+
+    @property
+    def out_dim(self):
+        return self.components.shape[0]
+
+    def apply(self, vectors):
+        """Projette un vecteur [in_dim] ou une matrice [N, in_dim] (float32)."""
+        projected = (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+        if self._scale is not None:
+            projected *= self._scale
+        return projected
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components, explained_variance=self.explained_variance)
+        with open(f"{path}.meta.json", "w") as f:
+            json.dump(self.metadata(), f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(f"{path}.meta.json") as f:
+            meta = json.load(f)
+        data = np.load(path if path.endswith(".npz") else f"{path}.npz")
+        projection = cls(data["mean"], data["components"], data["explained_variance"], whiten=meta["whiten"],
+                         n_samples=meta["n_samples"], fitted_at=meta["fitted_at"])
+        if projection.version != meta["version"]:
+            raise ValueError(f"Projection file {path} does not match its version {meta['version']}")
+        return projection
+
+    def metadata(self):
+        return {
+            "version": self.version,
+            "in_dim": self.in_dim,
+            "out_dim": self.out_dim,
+            "whiten": self.whiten,
+            "n_samples": self.n_samples,
+            "fitted_at": self.fitted_at,
+        }
+
+
+def fit_projection(embeddings, out_dim, whiten=False):
+    """Ajuste la PCA sur une matrice d'embeddings [N, dim], normalisés comme dans l'index."""
+    data = np.asarray(embeddings, dtype=np.float32)
+    data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+    mean = data.mean(axis=0)
+    centered = data - mean
+    # Covariance dim x dim (512 x 512) : la décomposition ne dépend pas de la taille du catalogue
+    covariance = (centered.T @ centered) / max(len(data) - 1, 1)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance.astype(np.float64))
+    order = np.argsort(eigenvalues)[::-1][:out_dim]
+    return Projection(mean, eigenvectors[:, order].T, eigenvalues[order], whiten=whiten, n_samples=len(data),
+                      fitted_at=datetime.datetime.utcnow().isoformat(timespec="seconds"))
+
+
+def explained_ratio(projection, embeddings):
+    """Part de la variance totale des embeddings conservée par la projection."""
+    data = np.asarray(embeddings, dtype=np.float32)
+    data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+    total = float(np.sum(np.var(data, axis=0, ddof=1)))
+    return float(np.sum(projection.explained_variance)) / total if total else 0.0
+
+
+def projection_recall(projection, embeddings, queries=200, k=10, seed=0):
+    """recall@k du top-k cosinus après projection, par rapport au top-k exact en 512-d (sans re-ranking)."""
+    data = np.asarray(embeddings, dtype=np.float32)
+    data = data / np.maximum(np.linalg.norm(data, axis=1, keepdims=True), 1e-12)
+    projected = projection.apply(data)
+    projected /= np.maximum(np.linalg.norm(projected, axis=1, keepdims=True), 1e-12)
+    picks = np.random.default_rng(seed).choice(len(data), size=min(queries, len(data)), replace=False)
+    recalls = []
+    for i in picks:
+        exact = data @ data[i]
+        approx = projected @ projected[i]
+        exact[i] = approx[i] = -np.inf  # le film lui-même n'est pas un voisin
+        top_exact = np.argpartition(exact, -k)[-k:]
+        top_approx = np.argpartition(approx, -k)[-k:]
+        recalls.append(len(set(top_exact.tolist()) & set(top_approx.tolist())) / k)
+    return float(np.mean(recalls))
+
+
+def sample_embeddings(collection, size):
+    """Échantillon aléatoire d'embeddings du catalogue ($sample côté serveur)."""
+    docs = collection.aggregate([
+        {"$match": {"embedding": {"$ne": None}}},
+        {"$sample": {"size": size}},
+        {"$project": {"embedding": 1}},
+    ])
+    return np.vstack([decode_embedding(doc["embedding"]).astype(np.float32) for doc in docs])
+
+
+if __name__ == '__main__':
+    # Ajuste et enregistre une projection, puis SEARCH_BACKEND=compressed EMBEDDING_PROJECTION_PATH=<fichier>
+    #   python projection.py --dim 128 --sample 200000
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Fit a PCA projection of the poster embeddings")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--whiten", action="store_true")
+    parser.add_argument("--sample", type=int, default=200000, help="embeddings used for the fit")
+    parser.add_argument("--output-dir", default="projections")
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo_uri)
+    embeddings = sample_embeddings(client["movie_database"]["movies"], args.sample)
+    client.close()
+    projection = fit_projection(embeddings, args.dim, whiten=args.whiten)
+    os.makedirs(args.output_dir, exist_ok=True)
+    path = os.path.join(args.output_dir, f"pca{args.dim}{'w' if args.whiten else ''}-{projection.version}.npz")
+    projection.save(path)
+    print(f"Projection {projection.version}: {projection.in_dim} -> {projection.out_dim} dims fitted on "
+          f"{len(embeddings)} embeddings, {explained_ratio(projection, embeddings):.1%} of the variance kept, "
+          f"recall@10 without re-ranking {projection_recall(projection, embeddings):.3f}")
+    print(f"Saved to {path}")
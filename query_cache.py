@@ -0,0 +1,136 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from embedding_codec import decode_embedding, encode_embedding
+
+
+class QueryCache:
+    """Cache LRU des requêtes /search_by_poster, indexé par le sha256 de l'image envoyée.
+
+    Chaque entrée garde l'embedding de la requête et, optionnellement, les identifiants
+    du top-k calculé pour une version donnée de l'index : si l'index a changé depuis
+    (ajout, édition, suppression), les résultats sont ignorés mais l'embedding reste valable.
+
+    Avec disk_path, les embeddings sont aussi écrits dans une base SQLite partagée par
+    les processus workers. Les résultats, liés à la version de l'index de chaque
+    processus, restent en mémoire.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = dict.fromkeys(
+            ["embedding_hits", "embedding_misses", "disk_hits", "result_hits", "result_misses", "evictions"], 0)
+        if disk_path:
+            with self._disk() as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, expires REAL, embedding BLOB)")
+                db.execute("DELETE FROM embeddings WHERE expires < ?", (time.time(),))
+
+    @staticmethod
+    def key(image_bytes):
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def _disk(self):
+        # Une connexion SQLite par thread, jamais réutilisée après un fork
+        if getattr(self._local, "db", None) is None or self._local.pid != os.getpid():
+            self._local.db = sqlite3.connect(self.disk_path, timeout=5)
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def _count(self, name):
+        self._counters[name] += 1
+
+    def _entry(self, key):
+        """Entrée mémoire valide (remontée en tête de LRU) ou None ; à appeler sous self._lock."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, embedding=None):
+        """Entrée de key, créée si besoin et complétée par l'embedding ; à appeler sous self._lock.
+
+        Une entrée peut n'avoir que des résultats (affiche reconnue par son pHash, sans embedding)."""
+        entry = self._entry(key)
+        if entry is None:
+            entry = {"expires": time.monotonic() + self.ttl, "embedding": None, "results": None}
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._count("evictions")
+        if embedding is not None:
+            entry["embedding"] = embedding
+        return entry
+
+    def get_embedding(self, key):
+        with self._lock:
+            entry = self._entry(key)
+            if entry is not None and entry["embedding"] is not None:
+                self._count("embedding_hits")
+                return entry["embedding"]
+        if self.disk_path:
+            row = self._disk().execute(
+                "SELECT embedding FROM embeddings WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+            if row is not None:
+                embedding = decode_embedding(row[0])
+                with self._lock:
+                    self._count("disk_hits")
+                    self._store(key, embedding)
+                return embedding
+        with self._lock:
+            self._count("embedding_misses")
+        return None
+
+    def put_embedding(self, key, embedding):
+        with self._lock:
+            self._store(key, embedding)
+        if self.disk_path:
+            db = self._disk()
+            with db:
+                db.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                           (key, time.time() + self.ttl, bytes(encode_embedding(embedding, "float32"))))
+
+    def get_results(self, key, index_version, k):
+        """Top-k mis en cache pour cette image, si l'index n'a pas changé depuis."""
+        with self._lock:
+            entry = self._entry(key)
+            results = entry and entry["results"]
+            if results and results[0] == index_version and results[1] >= k:
+                self._count("result_hits")
+                return results[2][:k]
+            self._count("result_misses")
+            return None
+
+    def put_results(self, key, index_version, k, hits):
+        with self._lock:
+            self._store(key)["results"] = (index_version, k, list(hits))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["entries"] = len(self._entries)
+        lookups = stats["embedding_hits"] + stats["disk_hits"] + stats["embedding_misses"]
+        stats["embedding_hit_rate"] = (stats["embedding_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+def cache_from_env():
+    """QueryCache configuré par QUERY_CACHE_SIZE, QUERY_CACHE_TTL et QUERY_CACHE_PATH (tier disque optionnel)."""
+    return QueryCache(
+        max_entries=int(os.environ.get("QUERY_CACHE_SIZE", 1024)),
+        ttl=float(os.environ.get("QUERY_CACHE_TTL", 3600)),
+        disk_path=os.environ.get("QUERY_CACHE_PATH") or None,
+    )
@@ -1,59 +1,122 @@
-from flask import Flask, request, jsonify
-from pymongo import MongoClient
-from bson.objectid import ObjectId
+import os
+
 import numpy as np
-# Autres imports nécessaires (par exemple, pour le traitement des données et la comparaison des embeddings)
-# Exemple :
-# from sklearn.metrics.pairwise import cosine_similarity
+from bson.objectid import ObjectId
 
-app = Flask(__name__)
+from embedding_codec import decode_embedding
 
-# Configuration de la connexion à MongoDB
-client = MongoClient('mongodb://localhost:27017/', replicaSet='<nom_du_replica_set>') # Remplacez <nom_du_replica_set> par le nom de votre replica set
-db = client.nom_de_la_base_de_donnees # Remplacez nom_de_la_base_de_donnees par le nom de votre base de données
+# Champs renvoyés pour chaque recommandation : jamais l'embedding
+RECOMMENDATION_PROJECTION = {"embedding": 0}
+MAX_RECOMMENDATIONS = 100
+# Au-delà de ce nombre de films filtrés, les identifiants ne sont plus chargés en mémoire :
+# le filtre est vérifié après la recherche, sur les seuls résultats de l'index
+MAX_CANDIDATES = int(os.environ.get("RECOMMENDATION_MAX_CANDIDATES", 50000))
 
-@app.route('/recommendations', methods=['POST'])
-def get_recommendations():
-    """
-    Recommande des films basés sur un embedding donné.
+
+def parse_embedding(value, dim):
+    """Embedding envoyé par le client : liste JSON de dim nombres, ou "0.1,0.2,..." en query string.
+
+    Lève ValueError si la valeur n'est pas un vecteur de dim nombres finis."""
+    if isinstance(value, str):
+        try:
+            value = [float(x) for x in value.split(",")]
+        except ValueError:
+            raise ValueError("embedding must be a list of numbers")
+    if not isinstance(value, (list, tuple)) or len(value) != dim:
+        raise ValueError(f"embedding must be a list of {dim} numbers")
+    if not all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in value):
+        raise ValueError("embedding must be a list of numbers")
+    vector = np.asarray(value, dtype=np.float32)
+    if not np.isfinite(vector).all():
+        raise ValueError("embedding values must be finite")
+    return vector
+
+
+def build_filter(genres=None, year_min=None, year_max=None, original_language=None):
+    """Construit le filtre MongoDB des métadonnées (None si aucun critère)."""
+    query = {}
+    if genres:
+        query["genres"] = {"$in": list(genres)}
+    if year_min is not None or year_max is not None:
+        # release_year est la clé de sharding : la plage ne touche que les shards concernés
+        query["release_year"] = {}
+        if year_min is not None:
+            query["release_year"]["$gte"] = int(year_min)
+        if year_max is not None:
+            query["release_year"]["$lte"] = int(year_max)
+    if original_language:
+        query["original_language"] = original_language
+    return query or None
+
+
+def seed_embedding(collection, movie_id):
+    """Embedding du film de départ, lu seul (projection sur le champ embedding)."""
+    movie = collection.find_one({"_id": ObjectId(movie_id)}, {"embedding": 1})
+    if movie is None:
+        return None
+    return decode_embedding(movie.get("embedding"))
+
+
+def candidate_ids(collection, filters, limit=MAX_CANDIDATES):
+    """Identifiants des films respectant les filtres, lus via une projection sur _id uniquement.
+
+    None si plus de limit films les respectent (voir post_filtered_search)."""
+    ids = {str(doc["_id"]) for doc in collection.find(filters, {"_id": 1}).limit(limit + 1)}
+    return ids if len(ids) <= limit else None
+
+
+def post_filtered_search(collection, index, embedding, k, filters, exclude=None):
+    """Top-k respectant un filtre trop large pour lister ses candidats.
+
+    L'index est parcouru par fenêtres croissantes ; seuls les résultats de chaque fenêtre
+    sont vérifiés dans MongoDB. Un filtre aussi large en garde une bonne part, la première
+    fenêtre suffit en général."""
+    fetch = 4 * k + 1
+    while True:
+        hits = [hit for hit in index.search(embedding, k=fetch) if hit[0] != exclude]
+        query = {**filters, "_id": {"$in": [ObjectId(hit_id) for hit_id, _ in hits]}}
+        matching = {str(doc["_id"]) for doc in collection.find(query, {"_id": 1})}
+        kept = [hit for hit in hits if hit[0] in matching]
+        if len(kept) >= k or fetch >= len(index):
+            return kept[:k]
+        fetch *= 4
+
+
+def year_range_only(index, filters):
+    """Filtre limité à release_year, que l'index réparti sait appliquer lui-même."""
+    return index.partitioned and set(filters) == {"release_year"}
+
+
+def recommend(collection, index, movie_id=None, embedding=None, k=10, filters=None):
+    """Top-k des films les plus proches d'un film (movie_id) ou d'un embedding.
+
+    Les filtres de métadonnées restreignent les candidats avant le parcours de l'index,
+    le film de départ est exclu, puis les résultats sont hydratés en une seule requête $in.
+    Retourne une liste de (document, similarité) triée par similarité décroissante.
     """
-    try:
-        # 1. Récupérer l'embedding depuis la requête POST
-        data = request.get_json()
-        target_embedding = data.get('embedding')
-
-        # Vérifier si l'embedding est fourni
-        if not target_embedding:
-            return jsonify({'error': 'Embedding is required'}), 400
-
-        target_embedding = np.array(target_embedding) # Convertir la liste en un tableau numpy
-
-        # 2. Récupérer tous les films depuis MongoDB
-        movies = list(db.movies.find({}, {'_id': 1, 'embedding': 1}))
-
-        # 3. Comparer l'embedding cible avec les embeddings des films
-        # (Vous pouvez utiliser la similarité cosinus ou une autre métrique)
-        # similarities = cosine_similarity([target_embedding], [movie['embedding'] for movie in movies])
-        # Exemple (remplacer par votre implémentation)
-        similarities = [np.dot(target_embedding, movie['embedding']) for movie in movies] # Produit scalaire pour l'exemple
-
-        # 4. Récupérer les films les plus similaires (recommandations)
-        # (Trier les films par similarité et récupérer les plus pertinents)
-        similar_movies_indices = np.argsort(similarities)[::-1]  # Indices triés par similarité décroissante
-        recommended_movies = [movies[i] for i in similar_movies_indices]
-
-        # 5. Récupérer les informations complètes des films recommandés depuis MongoDB
-        # (Vous pouvez récupérer les informations complètes en utilisant les IDs des films recommandés)
-        # Exemple :
-        results = []
-        for movie in recommended_movies:
-            full_movie_data = db.movies.find_one({'_id': movie['_id']})
-            results.append(full_movie_data)
-
-        return jsonify({'recommendations': results}), 200
-
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-if __name__ == '__main__':
-    app.run(debug=True)
+    if movie_id is not None:
+        movie_id = str(movie_id)
+        embedding = seed_embedding(collection, movie_id)
+    if embedding is None:
+        return []
+    embedding = np.asarray(embedding, dtype=np.float32)
+
+    indexed_filter = filters and year_range_only(index, filters)
+    allowed = candidate_ids(collection, filters) if filters and not indexed_filter else None
+    if allowed is not None:
+        allowed.discard(movie_id)
+        hits = index.search(embedding, k=k, allowed=allowed)
+    elif filters and not indexed_filter:
+        hits = post_filtered_search(collection, index, embedding, k, filters, exclude=movie_id)
+    elif filters:
+        # Index partitionné par année (sharded_search.py) : les partitions hors plage sont
+        # écartées directement, sans lire les identifiants des candidats dans MongoDB
+        years = (filters["release_year"].get("$gte"), filters["release_year"].get("$lte"))
+        hits = [hit for hit in index.search(embedding, k=k + 1, years=years) if hit[0] != movie_id][:k]
+    else:
+        # Un résultat de plus au cas où le film de départ en fasse partie
+        hits = [hit for hit in index.search(embedding, k=k + 1) if hit[0] != movie_id][:k]
+
+    movies = collection.find({"_id": {"$in": [ObjectId(hit_id) for hit_id, _ in hits]}}, RECOMMENDATION_PROJECTION)
+    movies_by_id = {str(movie["_id"]): movie for movie in movies}
+    return [(movies_by_id[hit_id], similarity) for hit_id, similarity in hits if hit_id in movies_by_id]
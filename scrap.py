@@ -1,45 +1,29 @@
 import gridfs
-from pymongo import MongoClient
 import requests
 from bs4 import BeautifulSoup
 import time
 import datetime
-import io
-
-# Pour la génération d'embeddings
-import torch
-import torchvision.models as models
-import torchvision.transforms as transforms
-from PIL import Image
-import numpy as np
-
-# --- Initialisation du modèle ResNet pour générer les embeddings ---
-# Utilisons resnet18 dont la couche finale (après pooling) produit un vecteur de 512 dimensions.
-model = models.resnet18(pretrained=True)
-model.eval()  # Mode évaluation
-# On retire la dernière couche fully-connected pour récupérer le vecteur avant classification
-embedding_model = torch.nn.Sequential(*list(model.children())[:-1])
-# Définir la transformation pour les images
-preprocess = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-])
-
-def generate_embedding(image_bytes):
-    """Génère un embedding (liste de 512 floats) à partir des bytes d'une image."""
-    try:
-        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
-        input_tensor = preprocess(image).unsqueeze(0)  # Ajouter la dimension batch
-        with torch.no_grad():
-            embedding = embedding_model(input_tensor)
-        # Le vecteur de sortie est de taille [1, 512, 1, 1] que nous aplatissons en 1D
-        embedding = embedding.squeeze().numpy().flatten().tolist()
-        return embedding
-    except Exception as e:
-        print(f"Error generating embedding: {e}")
-        return None
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+
+from config import config_dict, mongo_client
+from crawler import Crawler
+
+# Pour la génération d'embeddings (modèle ResNet partagé avec app.py)
+from embedding_service import configure_embedding_model, load_image_tensor, generate_embeddings_batch
+from embedding_codec import decode_embedding, encode_embedding
+import metrics
+from neighbors import enqueue_neighbor_update
+from perceptual_hash import PosterHashIndex, confirm_duplicates, poster_hashes, resolve_duplicates
+from poster_derivatives import ensure_poster_indexes, release_poster, store_derivatives
 
 def extract_release_year(release_date_str):
     """Extrait l'année de la date de sortie au format 'YYYY-MM-DD'."""
@@ -50,70 +34,169 @@ def extract_release_year(release_date_str):
         print(f"Error extracting year from {release_date_str}: {e}")
         return None
 
-# --- Connexion MongoDB ---
-try:
-    # Ici, adaptez la chaine de connexion pour vous connecter à votre cluster sharded
-    client = MongoClient("mongodb://localhost:27017/")  
-    db = client["movie_database"]  # Nom de la base
-    movies_collection = db["movies"]
-    fs = gridfs.GridFS(db)
+def connect_mongo(config):
+    """Client MongoDB, collection movies et GridFS du scraper (MONGO_URI / MONGO_DB, voir config.py)."""
+    # Pour un cluster sharded, adaptez MONGO_URI
+    client = mongo_client(config)
+    db = client[config["MONGO_DB"]]
     print("Connected to MongoDB")
-except Exception as e:
-    print(f"Error connecting to MongoDB: {e}")
-    exit()
+    return client, db["movies"], gridfs.GridFS(db)
 
-def insert_movies_to_mongodb(movie_data_list, collection, fs):
+def download_poster(session, url):
+    """Télécharge un poster ; retourne les bytes ou None en cas d'erreur."""
+    try:
+        with metrics.stage("poster_download"):
+            response = session.get(url, timeout=30)
+            response.raise_for_status()
+            return response.content
+    except requests.exceptions.RequestException as e:
+        print(f"Error downloading poster {url}: {e}")
+        return None
+
+def embed_posters(posters, preprocess_pool, batch_size):
+    """Décode les posters en parallèle puis calcule leurs embeddings par lots de batch_size."""
+    tensors = list(preprocess_pool.map(lambda b: load_image_tensor(b) if b else None, posters))
+    embeddings = [None] * len(posters)
+    valid = [i for i, tensor in enumerate(tensors) if tensor is not None]
+    for start in range(0, len(valid), batch_size):
+        positions = valid[start:start + batch_size]
+        batch = generate_embeddings_batch([tensors[i] for i in positions])
+        for i, embedding in zip(positions, batch):
+            embeddings[i] = embedding
+    return embeddings
+
+def poster_session(workers):
+    """Session HTTP dont le pool de connexions suit le nombre de threads de téléchargement."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+    session.mount("http://", HTTPAdapter(pool_connections=workers, pool_maxsize=workers))
+    return session
+
+def insert_movies_to_mongodb(movie_data_list, collection, fs, index=None, hash_index=None,
+                             batch_size=32, download_workers=8, preprocess_workers=4, chunk_size=200):
     """Insère une liste de films dans la collection MongoDB en enregistrant le poster dans GridFS,
-    en générant l'embedding et en ajoutant release_year."""
+    en générant l'embedding et en ajoutant release_year.
+
+    Les films sont traités par paquets de chunk_size : les posters du paquet suivant se
+    téléchargent (download_workers threads) pendant que le paquet courant est décodé
+    (preprocess_workers threads), passé dans ResNet par lots de batch_size puis écrit
+    avec un insert_many. Si un EmbeddingIndex est fourni, les nouveaux embeddings y sont
+    ajoutés directement.
+
+    Une affiche proche (pHash/dHash) d'un poster du paquet ou de hash_index, et confirmée
+    par sha256 ou par l'embedding (same_poster), n'est pas réécrite : le film reprend le
+    fichier GridFS, les vignettes et l'embedding. Seul le même sha256 évite aussi ResNet."""
     if not movie_data_list:
         print("No movie data to insert.")
         return
 
-    movies_to_insert = []
-    for movie in movie_data_list:
-        # Téléchargement et enregistrement du poster via GridFS
-        if movie.get("poster"):
-            try:
-                response = requests.get(movie["poster"])
-                response.raise_for_status()
-                poster_bytes = response.content
-                poster_id = fs.put(poster_bytes, filename=f"{movie['title']}_poster")
-                movie["image_id"] = poster_id  # Nom plus explicite
-                # Génération de l'embedding du poster
-                embedding = generate_embedding(poster_bytes)
-                movie["embedding"] = embedding
-                del movie["poster"]  # On ne stocke plus l'URL
-            except requests.exceptions.RequestException as e:
-                print(f"Error downloading poster for {movie['title']}: {e}")
-                movie["image_id"] = None
-                movie["embedding"] = None
-        else:
-            movie["image_id"] = None
-            movie["embedding"] = None
+    start_time = time.perf_counter()
+    session = poster_session(download_workers)
+    chunks = [movie_data_list[i:i + chunk_size] for i in range(0, len(movie_data_list), chunk_size)]
+    inserted = 0
+    posters_done = 0
+    duplicates = 0
+    persisted_urls = []
 
-        # Ajout d'un champ release_year pour servir de clé de sharding (par exemple)
-        if movie.get("release_date"):
-            movie["release_year"] = extract_release_year(movie["release_date"])
-        else:
-            movie["release_year"] = None
+    def submit_downloads(download_pool, chunk):
+        return [download_pool.submit(download_poster, session, movie["poster"]) if movie.get("poster") else None
+                for movie in chunk]
 
-        # Vous pouvez restructurer ou ajouter d'autres champs pour coller au modèle demandé (ex: additional_info, cast, etc.)
-        movies_to_insert.append(movie)
+    def store_poster(movie, poster_bytes):
+        if poster_bytes is None:
+            return None, None
+        filename = f"{movie['title']}_poster"  # Nom plus explicite
+        with metrics.stage("gridfs_write"):
+            return fs.put(poster_bytes, filename=filename), store_derivatives(fs, poster_bytes, filename)
 
-    try:
-        result = collection.insert_many(movies_to_insert)
-        print(f"Inserted {len(result.inserted_ids)} movies into MongoDB.")
-    except Exception as e:
-        print(f"Error inserting movies into MongoDB: {e}")
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+            ThreadPoolExecutor(max_workers=preprocess_workers) as preprocess_pool:
+        pending = submit_downloads(download_pool, chunks[0])
+        for chunk_number, chunk in enumerate(chunks):
+            posters = [future.result() if future else None for future in pending]
+            # Le paquet suivant se télécharge pendant l'inférence de celui-ci
+            if chunk_number + 1 < len(chunks):
+                pending = submit_downloads(download_pool, chunks[chunk_number + 1])
+            with metrics.stage("perceptual_hash"):
+                hashes = list(preprocess_pool.map(poster_hashes, posters))
+                digests = [hashlib.sha256(poster_bytes).hexdigest() if poster_bytes else None for poster_bytes in posters]
+                sources, confirmed = resolve_duplicates(hashes, hash_index, collection, digests)
+            # Les affiches nouvelles et les correspondances pHash sans sha256 commun passent dans ResNet
+            to_embed = [poster_bytes if source is None or not same_file else None
+                        for poster_bytes, source, same_file in zip(posters, sources, confirmed)]
+            embeddings = embed_posters(to_embed, preprocess_pool, batch_size)
+            sources = confirm_duplicates(sources, confirmed, embeddings)
+            fresh = [poster_bytes if source is None else None for poster_bytes, source in zip(posters, sources)]
+            # GridFS n'a pas d'écriture groupée : les posters du paquet sont écrits en parallèle
+            stored = list(preprocess_pool.map(store_poster, chunk, fresh))
+            for position, source in enumerate(sources):
+                if isinstance(source, int):
+                    stored[position], embeddings[position] = stored[source], embeddings[source]
+                elif source is not None:
+                    # image_id est une chaîne si le film source a été édité depuis l'admin
+                    stored[position] = (ObjectId(source["image_id"]), source.get("poster_variants") or {})
+                    embeddings[position] = decode_embedding(source["embedding"])
+            duplicates += sum(1 for source in sources if source is not None)
+
+            movies_to_insert = []
+            for movie, (image_id, variants), embedding, poster_hash, digest in zip(chunk, stored, embeddings, hashes, digests):
+                if image_id is not None:
+                    movie["image_id"] = image_id
+                    movie["poster_variants"] = variants
+                    movie["embedding"] = encode_embedding(embedding)
+                    movie["poster_sha256"] = digest
+                    movie.update(poster_hash)
+                    del movie["poster"]  # On ne stocke plus l'URL
+                    posters_done += 1
+                else:
+                    movie["image_id"] = None
+                    movie["embedding"] = None
+
+                # Ajout d'un champ release_year pour servir de clé de sharding (par exemple)
+                if movie.get("release_date"):
+                    movie["release_year"] = extract_release_year(movie["release_date"])
+                else:
+                    movie["release_year"] = None
+
+                # Vous pouvez restructurer ou ajouter d'autres champs pour coller au modèle demandé (ex: additional_info, cast, etc.)
+                movies_to_insert.append(movie)
 
-def scrape_movie_details(movie_url):
-    """Scrape les détails d'un film à partir d'une page TMDb."""
+            try:
+                with metrics.stage("mongo_write"):
+                    result = collection.insert_many(movies_to_insert)
+                inserted += len(result.inserted_ids)
+                persisted_urls.extend(movie["tmdb_url"] for movie in movies_to_insert if movie.get("tmdb_url"))
+                if index is not None:
+                    for movie, embedding in zip(movies_to_insert, embeddings):
+                        if movie.get("embedding") is not None:
+                            index.add(movie["_id"], embedding)
+                if hash_index is not None:
+                    for movie in movies_to_insert:
+                        hash_index.add(movie["_id"], movie)
+            except Exception as e:
+                print(f"Error inserting movies into MongoDB: {e}")
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Inserted {inserted} movies into MongoDB "
+          f"({posters_done} posters in {elapsed:.1f}s, {posters_done / elapsed if elapsed else 0:.1f} posters/s, "
+          f"{duplicates} duplicate posters shared).")
+    return {"inserted": inserted, "posters": posters_done, "duplicates": duplicates, "seconds": elapsed,
+            "persisted_urls": persisted_urls}
+
+def scrape_movie_details(movie_url, crawler):
+    """Scrape les détails d'un film à partir d'une page TMDb.
+
+    Retourne None si la page n'a pas changé depuis le dernier passage (réponse 304)."""
     try:
-        response = requests.get(movie_url)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
+        with metrics.stage("tmdb_fetch"):
+            content = crawler.fetch(movie_url)
+        if content is None:
+            print(f"Unchanged since last crawl: {movie_url}")
+            return None
+        with metrics.stage("html_parse"):
+            soup = BeautifulSoup(content, "html.parser")
 
-        details = {}
+        details = {"tmdb_url": movie_url}
         # Exemple pour récupérer le poster et d'autres infos
         poster_tag = soup.find("img", class_="poster")
         if poster_tag and poster_tag.get("src"):
@@ -156,40 +239,275 @@ def scrape_movie_details(movie_url):
         print(f"Error parsing HTML: {e}")
         return None
 
-def scrape_movie_links(base_url, pages_to_scrape=1):
-    """Scrape les liens des films sur plusieurs pages d'une liste TMDb."""
-    movie_links = []
-    for page_num in range(1, pages_to_scrape + 1):
+def scrape_movie_links(base_url, crawler, pages_to_scrape=1, first_page=1):
+    """Scrape les liens des films sur plusieurs pages d'une liste TMDb (pages récupérées en parallèle)."""
+    def scrape_page(page_num):
         url = f"{base_url}?page={page_num}"
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, "html.parser")
+            # Pas de requête conditionnelle : une liste inchangée peut pointer vers des films modifiés
+            with metrics.stage("tmdb_fetch"):
+                content = crawler.fetch(url, conditional=False)
+            soup = BeautifulSoup(content, "html.parser")
             movie_cards = soup.find_all("div", class_="card style_1")
-            for movie_card in movie_cards:
-                movie_element = movie_card.find("a")
-                link = movie_element["href"]
-                full_link = f"https://www.themoviedb.org{link}"
-                movie_links.append(full_link)
-            time.sleep(1)  # Pause pour ne pas surcharger le serveur
+            return [urljoin(url, movie_card.find("a")["href"]) for movie_card in movie_cards]
         except requests.exceptions.RequestException as e:
             print(f"Error fetching page {page_num}: {e}")
+            return []
+
+    movie_links = []
+    for page_links in crawler.map(scrape_page, range(first_page, first_page + pages_to_scrape)):
+        movie_links.extend(page_links)
     return movie_links
 
-# --- Exemple d'utilisation ---
-base_url = "https://www.themoviedb.org/movie"
-movie_links = scrape_movie_links(base_url, pages_to_scrape=1)
-movie_data_list = []
-for movie_link in movie_links:
-    movie_data = scrape_movie_details(movie_link)
-    if movie_data:
-        movie_data_list.append(movie_data)
-        print(f"Scraped: {movie_data.get('title', 'No title')}")
-    time.sleep(1)
-
-# Afficher les films scrappés (pour vérification)
-for movie in movie_data_list:
-    print(movie)
-
-insert_movies_to_mongodb(movie_data_list, movies_collection, fs)
-client.close()
+# --- Synchronisation incrémentale ---
+TMDB_ID_PATTERN = re.compile(r"/movie/(\d+)")
+
+def extract_tmdb_id(movie_url):
+    """Extrait l'identifiant numérique TMDb d'une URL de film (ex: /movie/550-fight-club)."""
+    match = TMDB_ID_PATTERN.search(movie_url)
+    return int(match.group(1)) if match else None
+
+def load_checkpoint(path, base_url):
+    """Retourne la prochaine page à synchroniser (1 sans checkpoint ou pour une autre liste)."""
+    if not path or not os.path.exists(path):
+        return 1
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading checkpoint {path}: {e}")
+        return 1
+    return checkpoint["next_page"] if checkpoint.get("base_url") == base_url else 1
+
+def save_checkpoint(path, base_url, next_page):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"base_url": base_url, "next_page": next_page}, f)
+    os.replace(tmp_path, path)
+
+def upsert_movies(movies, collection, fs, session, download_pool, preprocess_pool, index=None, batch_size=32,
+                  hash_index=None):
+    """Met à jour (ou crée) un lot de films en un seul bulk_write, clé = tmdb_url.
+
+    Un poster n'est retéléchargé que si son URL a changé, et n'est ré-enregistré et
+    ré-encodé par ResNet que si son contenu (sha256) a changé et qu'aucun autre film
+    n'a déjà le même fichier. Une affiche seulement proche (pHash/dHash) d'un autre film
+    n'en reprend le fichier que si les embeddings le confirment (voir perceptual_hash.py)."""
+    stats = {"movies": len(movies), "downloaded": 0, "embedded": 0, "unchanged_posters": 0, "duplicate_posters": 0}
+    if not movies:
+        return stats
+    projection = {"tmdb_url": 1, "title": 1, "poster_url": 1, "poster_sha256": 1, "image_id": 1,
+                  "poster_variants": 1, "release_year": 1}
+    with metrics.stage("mongo_find"):
+        existing = {
+            doc["tmdb_url"]: doc
+            for doc in collection.find({"tmdb_url": {"$in": [movie["tmdb_url"] for movie in movies]}}, projection)
+        }
+        # Films chargés avant la synchronisation (sans tmdb_url) : rapprochés par titre et année,
+        # l'upsert leur ajoute tmdb_url au lieu de créer un doublon
+        unmatched = [movie for movie in movies if movie["tmdb_url"] not in existing and movie.get("title")]
+        if unmatched:
+            legacy = {}
+            query = {"tmdb_url": None, "title": {"$in": [movie["title"] for movie in unmatched]}}
+            for doc in collection.find(query, projection).sort("_id", 1):
+                legacy.setdefault((doc["title"], doc.get("release_year")), doc)
+            for movie in unmatched:
+                release_year = extract_release_year(movie["release_date"]) if movie.get("release_date") else None
+                doc = legacy.pop((movie["title"], release_year), None)
+                if doc is not None:
+                    existing[movie["tmdb_url"]] = doc
+
+    # 1. Téléchargement des seuls posters nouveaux ou dont l'URL a changé
+    to_download = [
+        i for i, movie in enumerate(movies)
+        if movie.get("poster") and movie["poster"] != existing.get(movie["tmdb_url"], {}).get("poster_url")
+    ]
+    downloads = list(download_pool.map(lambda i: download_poster(session, movies[i]["poster"]), to_download))
+    stats["downloaded"] = sum(1 for poster_bytes in downloads if poster_bytes is not None)
+
+    # 2. Comparaison du contenu : même hash = même affiche, on garde fichier GridFS et embedding
+    same_poster, changed = set(), {}
+    for i, poster_bytes in zip(to_download, downloads):
+        if poster_bytes is None:
+            continue
+        digest = hashlib.sha256(poster_bytes).hexdigest()
+        if digest == existing.get(movies[i]["tmdb_url"], {}).get("poster_sha256"):
+            same_poster.add(i)
+        else:
+            changed[i] = (poster_bytes, digest)
+    stats["unchanged_posters"] = len(same_poster)
+
+    # Affiche déjà présente ailleurs (catalogue ou plus tôt dans le lot) : fichier et embedding partagés
+    positions = list(changed)
+    with metrics.stage("perceptual_hash"):
+        hashes = dict(zip(positions, preprocess_pool.map(lambda i: poster_hashes(changed[i][0]), positions)))
+        found, confirmed = resolve_duplicates([hashes[i] for i in positions], hash_index, collection,
+                                              [changed[i][1] for i in positions])
+    # Les affiches nouvelles et les correspondances pHash sans sha256 commun passent dans ResNet
+    to_embed = [n for n, source in enumerate(found) if source is None or not confirmed[n]]
+    encoded = [None] * len(positions)
+    for n, embedding in zip(to_embed, embed_posters([changed[positions[n]][0] for n in to_embed], preprocess_pool, batch_size)):
+        encoded[n] = embedding
+    found = confirm_duplicates(found, confirmed, encoded)
+    sources = dict(zip(positions, found))
+    fresh = [i for i in positions if sources[i] is None]
+    embeddings = [encoded[n] for n, source in enumerate(found) if source is None]
+
+    def store_poster(i):
+        filename = f"{movies[i].get('title', 'movie')}_poster"
+        with metrics.stage("gridfs_write"):
+            return fs.put(changed[i][0], filename=filename), store_derivatives(fs, changed[i][0], filename)
+
+    stored = list(preprocess_pool.map(store_poster, fresh))
+    stats["embedded"] = sum(1 for embedding in encoded if embedding is not None)
+    new_posters = {i: (image_id, variants, embedding)
+                   for i, (image_id, variants), embedding in zip(fresh, stored, embeddings)}
+    for i, source in sources.items():
+        if isinstance(source, int):
+            new_posters[i] = new_posters[positions[source]]
+        elif source is not None:
+            new_posters[i] = (ObjectId(source["image_id"]), source.get("poster_variants") or {},
+                              decode_embedding(source["embedding"]))
+    stats["duplicate_posters"] = len(positions) - len(fresh)
+
+    # 3. Un seul bulk_write pour tout le lot
+    operations, replaced_images = [], []
+    for i, movie in enumerate(movies):
+        url = movie["tmdb_url"]
+        previous = existing.get(url)
+        fields = {key: value for key, value in movie.items() if key != "poster"}
+        fields["tmdb_id"] = extract_tmdb_id(url)
+        fields["synced_at"] = datetime.datetime.utcnow()
+        release_year = extract_release_year(movie["release_date"]) if movie.get("release_date") else None
+        if i in new_posters:
+            fields["image_id"] = new_posters[i][0]
+            fields["poster_variants"] = new_posters[i][1]
+            fields["embedding"] = encode_embedding(new_posters[i][2])
+            fields["poster_sha256"] = changed[i][1]
+            fields.update(hashes[i])
+            fields["poster_url"] = movie["poster"]
+            if previous and previous.get("image_id"):
+                replaced_images.append((previous["image_id"], previous.get("poster_variants")))
+        elif i in same_poster:
+            fields["poster_url"] = movie["poster"]
+        elif previous is None:
+            fields["image_id"] = None
+            fields["embedding"] = None
+
+        # release_year sert de clé de sharding : il fait partie du filtre et n'est fixé qu'à la création
+        if previous:
+            query = {"_id": previous["_id"], "release_year": previous.get("release_year")}
+        else:
+            query = {"tmdb_url": url, "release_year": release_year}
+        fields.pop("release_year", None)
+        # updated_at (horloge du serveur) permet aux index des autres processus de relire le film
+        operations.append(UpdateOne(query, {"$set": fields, "$currentDate": {"updated_at": True}}, upsert=True))
+
+    with metrics.stage("mongo_write"):
+        result = collection.bulk_write(operations, ordered=False)
+
+    for i, (image_id, variants, embedding) in new_posters.items():
+        movie_id = existing[movies[i]["tmdb_url"]]["_id"] if movies[i]["tmdb_url"] in existing else result.upserted_ids.get(i)
+        if movie_id is None:
+            continue
+        if index is not None and embedding is not None:
+            index.add(movie_id, embedding)
+        if hash_index is not None:
+            hash_index.add(movie_id, hashes[i])
+
+    # Nouveau poster d'un film existant : ses listes de voisins sont à recalculer (neighbors.py)
+    for i in new_posters:
+        if movies[i]["tmdb_url"] in existing:
+            enqueue_neighbor_update(collection.database["neighbor_updates"], existing[movies[i]["tmdb_url"]]["_id"])
+
+    # Les anciens posters ne sont supprimés qu'une fois les documents mis à jour, et seulement
+    # si aucun autre film ne partage encore le fichier
+    for image_id, variants in replaced_images:
+        release_poster(collection, fs, image_id, variants)
+    return stats
+
+def sync_catalog(base_url, collection, fs, crawler, pages_to_scrape=1, checkpoint_path=None, index=None,
+                 batch_size=32, download_workers=8, preprocess_workers=4, hash_index=None):
+    """Synchronise la liste TMDb page par page : scraping, upsert groupé puis checkpoint.
+
+    Seule la page courante est gardée en mémoire, et un passage interrompu reprend à la
+    page suivant la dernière page enregistrée."""
+    collection.create_index("tmdb_url")
+    # Rafraîchissement des index de recherche (vector_index.changed_documents)
+    collection.create_index("updated_at")
+    # release_poster vérifie qu'un fichier GridFS n'est plus référencé avant de le supprimer
+    ensure_poster_indexes(collection)
+    first_page = load_checkpoint(checkpoint_path, base_url)
+    if first_page > 1:
+        print(f"Resuming sync of {base_url} at page {first_page}")
+
+    totals = {"movies": 0, "downloaded": 0, "embedded": 0, "unchanged_posters": 0, "duplicate_posters": 0}
+    start_time = time.perf_counter()
+    session = poster_session(download_workers)
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+            ThreadPoolExecutor(max_workers=preprocess_workers) as preprocess_pool:
+        for page in range(first_page, pages_to_scrape + 1):
+            movie_links = scrape_movie_links(base_url, crawler, pages_to_scrape=1, first_page=page)
+            movies = [movie for movie in crawler.map(lambda link: scrape_movie_details(link, crawler), movie_links) if movie]
+            stats = upsert_movies(movies, collection, fs, session, download_pool, preprocess_pool, index, batch_size,
+                                  hash_index)
+            for key in totals:
+                totals[key] += stats[key]
+            # bulk_write a réussi (sinon l'exception interrompt la synchronisation) : les validateurs
+            # HTTP de la page peuvent être enregistrés avec le checkpoint
+            crawler.confirm(movie["tmdb_url"] for movie in movies)
+            save_checkpoint(checkpoint_path, base_url, page + 1)
+            crawler.save()
+            print(f"Page {page}: {stats['movies']} movies synced, {stats['embedded']} posters embedded, "
+                  f"{stats['unchanged_posters']} unchanged posters skipped, "
+                  f"{stats['duplicate_posters']} duplicate posters shared")
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    elapsed = time.perf_counter() - start_time
+    print(f"Sync finished in {elapsed:.1f}s: {totals}")
+    return totals
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scrape TMDb and load the movies into MongoDB")
+    parser.add_argument("--base-url", default="https://www.themoviedb.org/movie")
+    parser.add_argument("--pages", type=int, default=1)
+    parser.add_argument("--mode", choices=["sync", "insert"], default="sync",
+                        help="sync: incremental upsert with checkpoint (default); insert: one-shot insert_many")
+    parser.add_argument("--checkpoint", default="sync_checkpoint.json")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port while running")
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    config = config_dict()
+    client, movies_collection, fs = connect_mongo(config)
+    # Le modèle n'est chargé qu'au premier lot de posters à encoder
+    configure_embedding_model(weights_path=config["EMBEDDING_WEIGHTS_PATH"])
+    # Empreintes des posters déjà en base, pour ne pas stocker deux fois la même affiche
+    hash_index = PosterHashIndex()
+    print(f"Loaded {hash_index.load_from_collection(movies_collection)} poster hashes")
+
+    # Débit global et concurrence par hôte bornés par le crawler, plus de pause fixe entre les pages
+    crawler = Crawler(rate=4.0, max_per_host=4, cache_path="crawler_cache.json")
+    if args.mode == "sync":
+        sync_catalog(args.base_url, movies_collection, fs, crawler, pages_to_scrape=args.pages,
+                     checkpoint_path=args.checkpoint, hash_index=hash_index)
+    else:
+        movie_links = scrape_movie_links(args.base_url, crawler, pages_to_scrape=args.pages)
+        movie_data_list = []
+        for movie_data in crawler.map(lambda movie_link: scrape_movie_details(movie_link, crawler), movie_links):
+            if movie_data:
+                movie_data_list.append(movie_data)
+                print(f"Scraped: {movie_data.get('title', 'No title')}")
+
+        stats = insert_movies_to_mongodb(movie_data_list, movies_collection, fs, hash_index=hash_index)
+        # Les validateurs HTTP ne sont gardés que pour les films effectivement insérés
+        crawler.confirm(stats["persisted_urls"] if stats else [])
+    crawler.close()
+    client.close()
+    # Temps passé dans chaque étape (threads cumulés) : indique quelle étape paralléliser
+    for name, (count, seconds) in metrics.stage_summary().items():
+        print(f"{name:<20} {count:>7} calls {seconds:>9.1f}s total {1000 * seconds / count:>8.1f} ms/call")
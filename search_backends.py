@@ -0,0 +1,620 @@
+import argparse
+import os
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from embedding_codec import decode_embedding
+from projection import Projection
+from sharded_search import ShardedSearch, parse_shards
+from vector_index import EmbeddingIndex, SearchBackend, normalize
+
+try:
+    import faiss
+except ImportError:  # faiss-cpu n'est nécessaire que pour les backends approchés
+    faiss = None
+
+
+class FaissBackend(SearchBackend):
+    """Base commune des index FAISS.
+
+    Les vecteurs sont normalisés : le produit scalaire (METRIC_INNER_PRODUCT) est donc
+    la similarité cosinus. FAISS ne connaît que des labels int64, on garde la
+    correspondance label <-> identifiant du film à côté de l'index.
+    """
+
+    def __init__(self, dim=512):
+        if faiss is None:
+            raise ImportError("faiss-cpu is required for the FAISS search backends")
+        super().__init__(dim)
+        self._labels = {}
+        self._movie_ids = {}
+        self._next_label = 0
+        self._index = self._build_index()
+        self._configure()
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, movie_id):
+        return str(movie_id) in self._labels
+
+    def _build_index(self):
+        raise NotImplementedError
+
+    def _configure(self):
+        """Applique les paramètres de recherche (nprobe, efSearch...) à l'index courant."""
+
+    def _remove_label(self, label):
+        self._index.remove_ids(np.array([label], dtype=np.int64))
+
+    def _fetch_size(self, k):
+        return k
+
+    def _live_selector(self):
+        """Sélecteur à appliquer sans filtre allowed (None : tous les labels de l'index sont valides)."""
+        return None
+
+    def _search_params(self, selector):
+        """Paramètres de recherche restreignant FAISS aux labels du sélecteur."""
+        return faiss.SearchParameters(sel=selector)
+
+    def _discard(self, movie_id):
+        label = self._labels.pop(movie_id, None)
+        if label is None:
+            return False
+        del self._movie_ids[label]
+        self._remove_label(label)
+        self.version += 1
+        return True
+
+    def _valid_vectors(self, movie_ids, embeddings):
+        # Un dict pour qu'un même film présent deux fois dans le lot ne garde que son dernier vecteur
+        vectors = {}
+        for movie_id, embedding in zip(movie_ids, embeddings):
+            movie_id = str(movie_id)
+            vector = normalize(embedding)
+            if vector is None or vector.shape[0] != self.dim:
+                vectors.pop(movie_id, None)
+                self.remove(movie_id)
+                continue
+            vectors[movie_id] = vector
+        return vectors
+
+    def _add_vectors(self, ids, matrix):
+        for movie_id in ids:
+            self._discard(movie_id)
+        labels = np.arange(self._next_label, self._next_label + len(ids), dtype=np.int64)
+        self._next_label += len(ids)
+        self._index.add_with_ids(matrix, labels)
+        for label, movie_id in zip(labels.tolist(), ids):
+            self._labels[movie_id] = label
+            self._movie_ids[label] = movie_id
+        self.version += 1
+
+    def add_many(self, movie_ids, embeddings):
+        vectors = self._valid_vectors(movie_ids, embeddings)
+        if not vectors:
+            return 0
+        with self._lock:
+            self._add_vectors(list(vectors), np.vstack(list(vectors.values())))
+        return len(vectors)
+
+    def add(self, movie_id, embedding):
+        return self.add_many([movie_id], [embedding]) == 1
+
+    def remove(self, movie_id):
+        with self._lock:
+            return self._discard(str(movie_id))
+
+    def search(self, query_embedding, k=5, allowed=None):
+        query = normalize(query_embedding)
+        if query is None or query.shape[0] != self.dim:
+            return []
+        with self._lock:
+            if not self._labels or k <= 0:
+                return []
+            fetch_size = self._fetch_size(k)
+            params = None
+            if allowed is None:
+                selector = self._live_selector()
+                if selector is not None:
+                    params = self._search_params(selector)
+            else:
+                # Le filtre est appliqué pendant le parcours de l'index, pas après coup
+                candidates = np.array([self._labels[m] for m in map(str, allowed) if m in self._labels], dtype=np.int64)
+                if not len(candidates):
+                    return []
+                selector = faiss.IDSelectorBatch(candidates)
+                params = self._search_params(selector)
+                fetch_size = min(k, len(candidates))
+            scores, labels = self._index.search(query.reshape(1, -1), fetch_size, params=params)
+            results = []
+            for score, label in zip(scores[0].tolist(), labels[0].tolist()):
+                movie_id = self._movie_ids.get(label)
+                if movie_id is None:
+                    continue
+                results.append((movie_id, score))
+                if len(results) == k:
+                    break
+            return results
+
+    def _save_data(self, path):
+        faiss.write_index(self._index, path)
+        labels = sorted(self._movie_ids)
+        np.savez(
+            f"{path}.ids.npz",
+            labels=np.array(labels, dtype=np.int64),
+            movie_ids=np.array([self._movie_ids[label] for label in labels]),
+            next_label=self._next_label,
+        )
+
+    def _load_data(self, path):
+        self._index = faiss.read_index(path)
+        data = np.load(f"{path}.ids.npz")
+        self._movie_ids = {int(label): str(movie_id) for label, movie_id in zip(data["labels"], data["movie_ids"])}
+        self._labels = {movie_id: label for label, movie_id in self._movie_ids.items()}
+        self._next_label = int(data["next_label"])
+        self._configure()
+        self.version += 1
+
+
+class FaissFlatBackend(FaissBackend):
+    """Recherche exacte FAISS (IndexFlatIP), utile comme référence optimisée BLAS."""
+
+    kind = "flat"
+
+    def _build_index(self):
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+
+
+class FaissIVFPQBackend(FaissBackend):
+    """Index IVF-PQ : vecteurs compressés en m sous-quantificateurs de nbits bits.
+
+    L'entraînement des centroïdes demande assez de vecteurs ; tant que le catalogue
+    n'a pas atteint train_size, les films sont servis par un EmbeddingIndex exact.
+    """
+
+    kind = "ivfpq"
+
+    def __init__(self, dim=512, nlist=1024, m=64, nbits=8, nprobe=16, train_size=None):
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.nprobe = nprobe
+        self.train_size = train_size or max(39 * nlist, 39 * 2 ** nbits)
+        super().__init__(dim)
+        self._staging = EmbeddingIndex(dim)
+
+    def _build_index(self):
+        quantizer = faiss.IndexFlatIP(self.dim)
+        index = faiss.IndexIVFPQ(quantizer, self.dim, self.nlist, self.m, self.nbits, faiss.METRIC_INNER_PRODUCT)
+        # Le quantizer doit vivre aussi longtemps que l'index
+        self._quantizer = quantizer
+        return index
+
+    def _configure(self):
+        self._index.nprobe = self.nprobe
+
+    def _search_params(self, selector):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+
+    @property
+    def is_trained(self):
+        return self._index.is_trained
+
+    def __len__(self):
+        return len(self._staging) if self._staging is not None else len(self._labels)
+
+    def __contains__(self, movie_id):
+        if self._staging is not None:
+            return movie_id in self._staging
+        return str(movie_id) in self._labels
+
+    def train(self, sample):
+        """Entraîne les centroïdes sur un échantillon puis bascule les films en attente dans l'index."""
+        sample = np.ascontiguousarray(sample, dtype=np.float32)
+        sample = sample / np.maximum(np.linalg.norm(sample, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self._index.train(sample)
+            staging, self._staging = self._staging, None
+            if staging is not None and len(staging):
+                size = len(staging)
+                self._add_vectors(list(staging._ids[:size]), staging._matrix[:size])
+
+    def add_many(self, movie_ids, embeddings):
+        with self._lock:
+            if self._staging is None:
+                return super().add_many(movie_ids, embeddings)
+            added = self._staging.add_many(movie_ids, embeddings)
+            self.version += 1
+            if len(self._staging) >= self.train_size:
+                self.train(self._staging._matrix[:len(self._staging)])
+            return added
+
+    def remove(self, movie_id):
+        with self._lock:
+            if self._staging is not None:
+                removed = self._staging.remove(movie_id)
+                self.version += removed
+                return removed
+            return super().remove(movie_id)
+
+    def search(self, query_embedding, k=5, allowed=None):
+        with self._lock:
+            if self._staging is not None:
+                return self._staging.search(query_embedding, k, allowed)
+        return super().search(query_embedding, k, allowed)
+
+    def _save_data(self, path):
+        if self._staging is not None:
+            raise ValueError(f"IVF-PQ index is not trained yet ({len(self._staging)}/{self.train_size} vectors)")
+        super()._save_data(path)
+
+    def _load_data(self, path):
+        super()._load_data(path)
+        self._staging = None
+
+
+class FaissHNSWBackend(FaissBackend):
+    """Graphe HNSW (IndexHNSWFlat).
+
+    HNSW ne sait pas supprimer de nœud : les films retirés deviennent des labels
+    orphelins, exclus pendant le parcours du graphe par un IDSelector (le top-k reste
+    de taille k quel que soit leur nombre). Le graphe est reconstruit quand ils
+    dépassent une fraction compact_ratio de l'index, pour libérer la mémoire.
+    """
+
+    kind = "hnsw"
+
+    def __init__(self, dim=512, m=32, ef_construction=200, ef_search=64, compact_ratio=0.2):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.compact_ratio = compact_ratio
+        self._orphan_labels = set()
+        self._selector = None
+        super().__init__(dim)
+
+    def _build_index(self):
+        hnsw = faiss.IndexHNSWFlat(self.dim, self.m, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = self.ef_construction
+        return faiss.IndexIDMap2(hnsw)
+
+    def _configure(self):
+        faiss.downcast_index(self._index.index).hnsw.efSearch = self.ef_search
+
+    @property
+    def _orphans(self):
+        return len(self._orphan_labels)
+
+    def _live_selector(self):
+        if not self._orphan_labels:
+            return None
+        if self._selector is None:
+            # IDSelectorNot ne garde qu'un pointeur : le lot d'orphelins est conservé à côté
+            orphans = faiss.IDSelectorBatch(np.fromiter(self._orphan_labels, dtype=np.int64))
+            self._selector = (faiss.IDSelectorNot(orphans), orphans)
+        return self._selector[0]
+
+    def _search_params(self, selector):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=self.ef_search)
+
+    def _remove_label(self, label):
+        self._orphan_labels.add(label)
+        self._selector = None
+        if self._orphans > self.compact_ratio * max(self._index.ntotal, 1):
+            self._compact()
+
+    def _compact(self):
+        labels = np.array(sorted(self._movie_ids), dtype=np.int64)
+        vectors = np.vstack([self._index.reconstruct(int(label)) for label in labels]) if len(labels) else None
+        self._index = self._build_index()
+        self._configure()
+        if vectors is not None:
+            self._index.add_with_ids(vectors, labels)
+        self._orphan_labels = set()
+        self._selector = None
+
+    def _load_data(self, path):
+        super()._load_data(path)
+        stored = faiss.vector_to_array(self._index.id_map).tolist()
+        self._orphan_labels = set(stored) - set(self._movie_ids)
+        self._selector = None
+
+
+class CompressedIndex(EmbeddingIndex):
+    """Index résident compressé : projection PCA optionnelle puis quantification scalaire.
+
+    Chaque vecteur est (éventuellement) projeté en out_dim dimensions, renormalisé puis
+    stocké en float32, float16 ou int8 (avec une échelle float32 par ligne). Le parcours
+    reconvertit la matrice en float32 par blocs de block_size lignes qui restent dans le cache
+    du CPU : la mémoire lue par requête est divisée par 4 en int8, et par dim / out_dim avec une
+    projection. numpy n'a pas de noyau float16 rapide : float16 divise la mémoire par 2 mais
+    parcourt plus lentement que float32.
+
+    Les rerank meilleurs candidats sont ensuite re-classés par le cosinus exact en float32
+    sur les embeddings d'origine, lus par défaut dans la collection liée à l'index
+    (rerank_from="mongo", rien de plus en mémoire, scores quantifiés gardés si aucune
+    collection n'est liée). rerank_from="memory" garde une copie float32 résidente, aussi
+    grosse qu'un EmbeddingIndex : elle annule le gain de mémoire et ne sert qu'à mesurer.
+    """
+
+    kind = "compressed"
+    DTYPES = ("float32", "float16", "int8")
+
+    def __init__(self, dim=512, dtype="int8", projection=None, rerank=64, rerank_from="mongo",
+                 block_size=1024, initial_capacity=1024):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"Unsupported index dtype '{dtype}' (expected one of: {', '.join(self.DTYPES)})")
+        if rerank_from not in ("memory", "mongo"):
+            raise ValueError(f"Unsupported rerank source '{rerank_from}' (expected memory or mongo)")
+        if projection is not None and projection.in_dim != dim:
+            raise ValueError(f"Projection expects {projection.in_dim}-d embeddings, index is {dim}-d")
+        self.dtype = dtype
+        self.projection = projection
+        self.rerank = rerank
+        self.rerank_from = rerank_from
+        self.block_size = block_size
+        self.code_dim = projection.out_dim if projection is not None else dim
+        super().__init__(dim, initial_capacity)
+        self._matrix = np.zeros((initial_capacity, self.code_dim), dtype=dtype)
+        self._scales = np.ones(initial_capacity, dtype=np.float32)
+        self._full = np.zeros((initial_capacity, dim), dtype=np.float32) if self._keeps_full else None
+
+    @property
+    def _keeps_full(self):
+        return self.rerank > 0 and self.rerank_from == "memory"
+
+    def resident_bytes(self):
+        """Mémoire parcourue à chaque requête : codes (et échelles int8) des films indexés."""
+        size = len(self._ids)
+        return self._matrix[:size].nbytes + (self._scales[:size].nbytes if self.dtype == "int8" else 0)
+
+    def rerank_bytes(self):
+        """Mémoire de la copie float32 gardée pour le re-ranking (0 avec rerank_from="mongo")."""
+        return self._full[:len(self._ids)].nbytes if self._full is not None else 0
+
+    def _code(self, vector):
+        """Projection, renormalisation et quantification d'un vecteur normalisé : (code, échelle)."""
+        if self.projection is not None:
+            vector = normalize(self.projection.apply(vector))
+            if vector is None:
+                return None, None
+        if self.dtype == "int8":
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            return np.round(vector / scale).astype(np.int8), scale
+        return vector.astype(self.dtype), 1.0
+
+    def _grow(self, needed):
+        capacity = self._matrix.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2)
+        size = len(self._ids)
+        matrix = np.zeros((new_capacity, self.code_dim), dtype=self.dtype)
+        matrix[:size] = self._matrix[:size]
+        self._matrix = matrix
+        scales = np.ones(new_capacity, dtype=np.float32)
+        scales[:size] = self._scales[:size]
+        self._scales = scales
+        if self._full is not None:
+            full = np.zeros((new_capacity, self.dim), dtype=np.float32)
+            full[:size] = self._full[:size]
+            self._full = full
+
+    def load_from_collection(self, collection, batch_size=1000):
+        # Les vecteurs float32 du re-ranking "mongo" sont relus dans cette collection
+        self.bind_collection(collection)
+        return super().load_from_collection(collection, batch_size)
+
+    def add(self, movie_id, embedding):
+        vector = normalize(embedding)
+        code, scale = (None, None) if vector is None or vector.shape[0] != self.dim else self._code(vector)
+        if code is None:
+            self.remove(movie_id)
+            return False
+        movie_id = str(movie_id)
+        with self._lock:
+            row = self._positions.get(movie_id)
+            if row is None:
+                row = len(self._ids)
+                self._grow(row + 1)
+                self._ids.append(movie_id)
+                self._positions[movie_id] = row
+            self._matrix[row] = code
+            self._scales[row] = scale
+            if self._full is not None:
+                self._full[row] = vector
+            self.version += 1
+        return True
+
+    def remove(self, movie_id):
+        movie_id = str(movie_id)
+        with self._lock:
+            row = self._positions.pop(movie_id, None)
+            if row is None:
+                return False
+            last = len(self._ids) - 1
+            if row != last:
+                last_id = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._scales[row] = self._scales[last]
+                if self._full is not None:
+                    self._full[row] = self._full[last]
+                self._ids[row] = last_id
+                self._positions[last_id] = row
+            self._ids.pop()
+            self.version += 1
+        return True
+
+    def _approximate_scores(self, query, rows):
+        """Scores quantifiés de toutes les lignes (ou des lignes rows), bloc par bloc en float32."""
+        count = len(self._ids) if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, self.block_size):
+            stop = min(start + self.block_size, count)
+            selection = slice(start, stop) if rows is None else rows[start:stop]
+            scores[start:stop] = self._matrix[selection].astype(np.float32, copy=False) @ query
+            if self.dtype == "int8":
+                scores[start:stop] *= self._scales[selection]
+        return scores
+
+    def _fetch_vectors(self, movie_ids):
+        """Embeddings float32 d'origine des candidats, relus dans MongoDB ({movie_id: vecteur})."""
+        if self._collection is None:
+            return {}
+        docs = self._collection.find({"_id": {"$in": [ObjectId(movie_id) for movie_id in movie_ids]}}, {"embedding": 1})
+        return {str(doc["_id"]): normalize(decode_embedding(doc.get("embedding"))) for doc in docs}
+
+    def search(self, query_embedding, k=5, allowed=None):
+        """Top-k (movie_id, similarité) : parcours quantifié puis re-ranking float32 des candidats."""
+        query = normalize(query_embedding)
+        if query is None or query.shape[0] != self.dim or k <= 0:
+            return []
+        code_query = normalize(self.projection.apply(query)) if self.projection is not None else query
+        if code_query is None:
+            return []
+        with self._lock:
+            rows = None
+            if allowed is not None:
+                rows = np.array([self._positions[m] for m in map(str, allowed) if m in self._positions], dtype=np.int64)
+            scores = self._approximate_scores(code_query, rows)
+            size = len(scores)
+            if size == 0:
+                return []
+            fetch = min(max(k, self.rerank), size)
+            top = np.argpartition(scores, -fetch)[-fetch:] if fetch < size else np.arange(size)
+            top_rows = top if rows is None else rows[top]
+            candidates = [self._ids[row] for row in top_rows]
+            full = self._full[top_rows] if self._full is not None else None
+        if self.rerank <= 0:
+            exact = scores[top]
+        elif full is not None:
+            exact = full @ query
+        else:
+            # Lecture MongoDB hors du verrou : les autres recherches ne l'attendent pas
+            vectors = self._fetch_vectors(candidates)
+            exact = np.array([float(vectors[m] @ query) if vectors.get(m) is not None else scores[i]
+                              for m, i in zip(candidates, top)], dtype=np.float32)
+        order = np.argsort(exact)[::-1][:k]
+        return [(candidates[i], float(exact[i])) for i in order]
+
+    def _save_data(self, path):
+        size = len(self._ids)
+        np.savez(
+            f"{path}.npz",
+            matrix=self._matrix[:size],
+            scales=self._scales[:size],
+            full=self._full[:size] if self._full is not None else np.zeros((0, self.dim), dtype=np.float32),
+            ids=np.array(self._ids),
+            dtype=self.dtype,
+            projection_version=self.projection.version if self.projection is not None else "",
+        )
+
+    def _load_data(self, path):
+        data = np.load(f"{path}.npz")
+        projection_version = self.projection.version if self.projection is not None else ""
+        if str(data["projection_version"]) != projection_version or str(data["dtype"]) != self.dtype:
+            raise ValueError(f"Index file {path} was built with projection '{data['projection_version']}' "
+                             f"and dtype {data['dtype']}, expected '{projection_version}' and {self.dtype}")
+        if self._keeps_full and len(data["full"]) != len(data["ids"]):
+            raise ValueError(f"Index file {path} has no float32 vectors for in-memory re-ranking")
+        self._ids = [str(movie_id) for movie_id in data["ids"]]
+        self._positions = {movie_id: row for row, movie_id in enumerate(self._ids)}
+        self._matrix = np.ascontiguousarray(data["matrix"], dtype=self.dtype)
+        self._scales = np.ascontiguousarray(data["scales"], dtype=np.float32)
+        self._full = np.ascontiguousarray(data["full"], dtype=np.float32) if self._keeps_full else None
+        self._grow(len(self._ids) + 1)
+        self.version += 1
+
+
+BACKENDS = {
+    EmbeddingIndex.kind: EmbeddingIndex,
+    FaissFlatBackend.kind: FaissFlatBackend,
+    FaissIVFPQBackend.kind: FaissIVFPQBackend,
+    FaissHNSWBackend.kind: FaissHNSWBackend,
+    CompressedIndex.kind: CompressedIndex,
+    ShardedSearch.kind: ShardedSearch,
+}
+
+# Paramètres configurables par variable d'environnement, par type d'index
+ENV_PARAMS = {
+    "ivfpq": [
+        ("nlist", "FAISS_NLIST", int),
+        ("m", "FAISS_PQ_M", int),
+        ("nbits", "FAISS_PQ_NBITS", int),
+        ("nprobe", "FAISS_NPROBE", int),
+        ("train_size", "FAISS_TRAIN_SIZE", int),
+    ],
+    "hnsw": [
+        ("m", "FAISS_HNSW_M", int),
+        ("ef_construction", "FAISS_EF_CONSTRUCTION", int),
+        ("ef_search", "FAISS_EF_SEARCH", int),
+    ],
+    "compressed": [
+        ("dtype", "INDEX_DTYPE", str),
+        ("projection", "EMBEDDING_PROJECTION_PATH", Projection.load),
+        ("rerank", "INDEX_RERANK", int),
+        ("rerank_from", "INDEX_RERANK_FROM", str),
+        ("block_size", "INDEX_BLOCK_SIZE", int),
+    ],
+    "sharded": [
+        ("shards", "SEARCH_SHARDS", parse_shards),
+        ("timeout", "SEARCH_SHARD_TIMEOUT", float),
+    ],
+}
+
+
+def create_backend(kind="exact", dim=512, **params):
+    """Instancie un backend de recherche par son nom (exact, flat, ivfpq, hnsw, compressed, sharded)."""
+    try:
+        backend_class = BACKENDS[kind]
+    except KeyError:
+        raise ValueError(f"Unknown search backend '{kind}' (expected one of: {', '.join(BACKENDS)})")
+    return backend_class(dim=dim, **params)
+
+
+def env_params(kind):
+    """Paramètres du backend kind définis dans l'environnement (voir ENV_PARAMS)."""
+    return {
+        name: cast(os.environ[variable])
+        for name, variable, cast in ENV_PARAMS.get(kind, [])
+        if os.environ.get(variable)
+    }
+
+
+def backend_from_env(dim=512):
+    """Construit le backend décrit par SEARCH_BACKEND et recharge SEARCH_INDEX_PATH s'il existe."""
+    kind = os.environ.get("SEARCH_BACKEND", "exact")
+    params = env_params(kind)
+    backend = create_backend(kind, dim, **params)
+    path = os.environ.get("SEARCH_INDEX_PATH")
+    if path and os.path.exists(f"{path}.meta.json"):
+        try:
+            backend.load(path)
+            print(f"Loaded {kind} search index from {path} ({len(backend)} movies)")
+        except Exception as e:
+            print(f"Error loading search index from {path}: {e}")
+            backend = create_backend(kind, dim, **params)
+    return backend
+
+
+if __name__ == '__main__':
+    # Construit (ou complète) l'index persistant à partir de MongoDB :
+    #   SEARCH_BACKEND=hnsw SEARCH_INDEX_PATH=posters.index python search_backends.py
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description="Build the persisted poster search index")
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017/")
+    parser.add_argument("--output", default=os.environ.get("SEARCH_INDEX_PATH"))
+    args = parser.parse_args()
+    if not args.output:
+        parser.error("--output (or SEARCH_INDEX_PATH) is required")
+
+    client = MongoClient(args.mongo_uri)
+    backend = backend_from_env()
+    loaded = backend.load_from_collection(client["movie_database"]["movies"])
+    backend.save(args.output)
+    print(f"Indexed {loaded} new embeddings, {len(backend)} movies saved to {args.output}")
+    client.close()
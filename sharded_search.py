@@ -0,0 +1,432 @@
+"""Recherche par similarité répartie sur plusieurs processus (scatter-gather).
+
+Les embeddings sont partitionnés par plages de release_year, la clé de sharding de la
+collection movies. Chaque partition est servie par un processus worker (serve_shard), qui
+charge ses films depuis MongoDB dans un index local (SHARD_BACKEND : exact, hnsw...).
+ShardedSearch a la même interface que les autres backends : il envoie la requête aux
+workers des partitions concernées et fusionne leurs top-k.
+
+    python sharded_search.py local --partitions :1989,1990:2009,2010: --base-port 6101
+    SEARCH_BACKEND=sharded SEARCH_SHARDS=":1989@localhost:6101,1990:2009@localhost:6102,2010:@localhost:6103"
+
+Les films sans release_year sont rangés dans la dernière partition de SEARCH_SHARDS.
+
+Coordinateur et workers partagent la clé SEARCH_SHARD_AUTHKEY (obligatoire). Les messages
+sont un en-tête JSON suivi du vecteur float32 brut : rien n'est désérialisé avec pickle,
+mais les workers doivent rester sur un réseau privé.
+"""
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import struct
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from embedding_codec import decode_embedding
+from vector_index import SearchBackend, changed_documents
+
+SHARD_TIMEOUT = float(os.environ.get("SEARCH_SHARD_TIMEOUT", 5))
+# Taille maximale d'un message (liste allowed de MAX_CANDIDATES ids comprise)
+MAX_MESSAGE_BYTES = 64 * 2 ** 20
+
+
+def shard_authkey(authkey=None):
+    """Clé partagée entre le coordinateur et les workers : SEARCH_SHARD_AUTHKEY, sans valeur par défaut."""
+    authkey = authkey or os.environ.get("SEARCH_SHARD_AUTHKEY")
+    if not authkey:
+        raise ValueError("SEARCH_SHARD_AUTHKEY is required: shard workers only accept clients holding this key")
+    return authkey if isinstance(authkey, bytes) else authkey.encode()
+
+
+def encode_message(message, vector=None):
+    """Message -> octets : longueur de l'en-tête JSON, en-tête, puis vecteur float32 brut éventuel."""
+    header = json.dumps(message, default=lambda value: value.item()).encode()  # scalaires numpy
+    payload = b"" if vector is None else np.asarray(vector, dtype="<f4").tobytes()
+    return struct.pack("<I", len(header)) + header + payload
+
+
+def decode_message(data):
+    """Octets -> (message, vecteur float32 ou None)."""
+    (size,) = struct.unpack_from("<I", data)
+    message = json.loads(data[4:4 + size])
+    payload = data[4 + size:]
+    return message, np.frombuffer(payload, dtype="<f4").copy() if payload else None
+
+
+def parse_partitions(spec):
+    """":1989,1990:2009,2010:" -> [(None, 1989), (1990, 2009), (2010, None)] (bornes incluses)."""
+    partitions = []
+    for item in spec.split(","):
+        low, _, high = item.strip().partition(":")
+        partitions.append((int(low) if low else None, int(high) if high else None))
+    return partitions
+
+
+def format_partition(partition):
+    low, high = partition
+    return f"{'' if low is None else low}:{'' if high is None else high}"
+
+
+def parse_shards(spec):
+    """":1989@host:6101,1990:@host:6102" -> [((None, 1989), ("host", 6101)), ((1990, None), ("host", 6102))]."""
+    shards = []
+    for item in spec.split(","):
+        years, _, address = item.strip().partition("@")
+        host, _, port = address.rpartition(":")
+        shards.append((parse_partitions(years)[0], (host or "localhost", int(port))))
+    return shards
+
+
+def in_range(year, years):
+    year_min, year_max = years
+    return year is not None and (year_min is None or year >= year_min) and (year_max is None or year <= year_max)
+
+
+def overlaps(partition, years):
+    """La partition recoupe-t-elle la plage years=(min, max) ? (None = borne ouverte)"""
+    if years is None:
+        return True
+    (low, high), (year_min, year_max) = partition, years
+    return (high is None or year_min is None or high >= year_min) and (low is None or year_max is None or low <= year_max)
+
+
+def partition_query(partition, holds_undated=False):
+    """Filtre MongoDB des films d'une partition."""
+    low, high = partition
+    bounds = {}
+    if low is not None:
+        bounds["$gte"] = low
+    if high is not None:
+        bounds["$lte"] = high
+    query = {"release_year": bounds or {"$ne": None}}
+    if holds_undated:
+        return {"$or": [query, {"release_year": None}]}
+    return query
+
+
+class ShardWorker:
+    """Une partition : index local de ses embeddings, et année de chaque film pour les filtres."""
+
+    def __init__(self, partition, backend, collection, holds_undated=False):
+        self.partition = partition
+        self.backend = backend
+        self.collection = collection
+        self.holds_undated = holds_undated
+        self._years = {}
+        self._by_year = {}
+        self._last_object_id = None
+        self._last_updated_at = None
+        self._lock = threading.Lock()
+
+    def _set_year(self, movie_id, year):
+        with self._lock:
+            self._drop_year(movie_id)
+            self._years[movie_id] = year
+            self._by_year.setdefault(year, set()).add(movie_id)
+
+    def _drop_year(self, movie_id):
+        if movie_id in self._years:
+            year = self._years.pop(movie_id)
+            self._by_year[year].discard(movie_id)
+
+    def load(self, batch_size=1000):
+        """Charge (ou complète) la partition avec les films insérés ou modifiés depuis le dernier chargement."""
+        scope = partition_query(self.partition, self.holds_undated)
+        documents = changed_documents(self, self.collection, {"embedding": {"$ne": None}, **scope},
+                                      {"embedding": 1, "release_year": 1}, batch_size, scope)
+        loaded = 0
+        ids, embeddings = [], []
+        for doc in documents:
+            if doc.get("embedding") is None:
+                self.remove(str(doc["_id"]))
+                continue
+            ids.append(doc["_id"])
+            embeddings.append(decode_embedding(doc["embedding"]))
+            self._set_year(str(doc["_id"]), doc.get("release_year"))
+            if len(ids) >= batch_size:
+                loaded += self.backend.add_many(ids, embeddings)
+                ids, embeddings = [], []
+        if ids:
+            loaded += self.backend.add_many(ids, embeddings)
+        return loaded
+
+    def add(self, movie_id, embedding, year):
+        self._set_year(movie_id, year)
+        return self.backend.add(movie_id, embedding)
+
+    def remove(self, movie_id):
+        with self._lock:
+            self._drop_year(movie_id)
+        return self.backend.remove(movie_id)
+
+    def _ids_in(self, years):
+        """Films de la partition dans la plage years, ou None si la plage couvre toute la partition."""
+        (low, high), (year_min, year_max) = self.partition, years
+        covered = ((year_min is None or (low is not None and low >= year_min))
+                   and (year_max is None or (high is not None and high <= year_max)))
+        with self._lock:
+            if covered and not self._by_year.get(None):
+                return None
+            return set().union(*(ids for year, ids in self._by_year.items() if in_range(year, years)))
+
+    def search(self, query, k, allowed=None, years=None):
+        if years is not None:
+            in_years = self._ids_in(years)
+            if in_years is not None:
+                allowed = in_years if allowed is None else in_years & allowed
+        if allowed is not None and not allowed:
+            return []
+        return self.backend.search(query, k=k, allowed=allowed)
+
+    def stats(self):
+        return {"partition": format_partition(self.partition), "kind": self.backend.kind,
+                "undated": len(self._by_year.get(None, ()))}
+
+    def handle(self, request, vector=None):
+        """Exécute une requête décodée : dict JSON et, pour search et add, le vecteur float32."""
+        operation = request.get("op")
+        if operation in ("search", "add") and vector is None:
+            raise ValueError(f"Shard operation '{operation}' requires a vector")
+        if operation == "search":
+            allowed, years = request.get("allowed"), request.get("years")
+            return self.search(vector, int(request["k"]), None if allowed is None else set(allowed),
+                               None if years is None else tuple(years))
+        if operation == "load":
+            return self.load(int(request["batch_size"]))
+        if operation == "add":
+            return self.add(str(request["movie_id"]), vector, request.get("year"))
+        if operation == "remove":
+            return self.remove(str(request["movie_id"]))
+        if operation == "stats":
+            return self.stats()
+        raise ValueError(f"Unknown shard operation '{operation}'")
+
+
+def _serve_connection(worker, connection):
+    with connection:
+        while True:
+            try:
+                data = connection.recv_bytes(MAX_MESSAGE_BYTES)
+            except (EOFError, OSError):
+                return
+            operation = None
+            try:
+                request, vector = decode_message(data)
+                operation = request.get("op")
+                reply = {"status": "ok", "result": worker.handle(request, vector),
+                         "version": worker.backend.version, "size": len(worker.backend)}
+            except Exception as e:
+                print(f"Error handling shard request {operation}: {e}")
+                reply = {"status": "error", "error": str(e)}
+            connection.send_bytes(encode_message(reply))
+
+
+def serve_shard(partition, port, host="127.0.0.1", kind=None, holds_undated=False, authkey=None):
+    """Processus worker : charge sa partition depuis MongoDB puis répond au coordinateur (un thread par connexion).
+
+    Refuse de démarrer sans SEARCH_SHARD_AUTHKEY ; n'écoute que localhost sauf host explicite.
+    """
+    from config import config_dict, mongo_client
+    from search_backends import create_backend, env_params
+
+    authkey = shard_authkey(authkey)
+    config = config_dict()
+    client = mongo_client(config)
+    kind = kind or os.environ.get("SHARD_BACKEND", "exact")
+    worker = ShardWorker(partition, create_backend(kind, **env_params(kind)), client[config["MONGO_DB"]]["movies"],
+                         holds_undated)
+    started = time.perf_counter()
+    loaded = worker.load()
+    name = format_partition(partition)
+    print(f"Shard {name}: loaded {loaded} embeddings into a {kind} index in {time.perf_counter() - started:.1f}s")
+    listener = Listener((host, port), authkey=authkey)
+    print(f"Shard {name} listening on {host}:{port}")
+    while True:
+        try:
+            connection = listener.accept()
+        except Exception as e:  # mauvaise clé d'authentification, connexion coupée...
+            print(f"Error accepting shard connection: {e}")
+            continue
+        threading.Thread(target=_serve_connection, args=(worker, connection), daemon=True).start()
+
+
+class ShardedSearch(SearchBackend):
+    """Coordinateur de la recherche répartie : les vecteurs vivent dans les workers.
+
+    Les requêtes partent vers tous les workers concernés avant d'attendre la première
+    réponse : les partitions sont parcourues en parallèle. Un worker injoignable ou trop
+    lent (timeout) est signalé et ignoré, les résultats sont alors ceux des autres partitions.
+    """
+
+    kind = "sharded"
+    partitioned = True
+
+    def __init__(self, dim=512, shards=None, timeout=SHARD_TIMEOUT, authkey=None):
+        if not shards:
+            raise ValueError("SEARCH_SHARDS is required for the sharded search backend")
+        super().__init__(dim)
+        self.shards = list(shards)
+        self.timeout = timeout
+        self.authkey = shard_authkey(authkey)
+        # (version, taille) rapportées par chaque worker à sa dernière réponse
+        self._states = [(None, 0)] * len(self.shards)
+        self._idle = [[] for _ in self.shards]
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return sum(size for _, size in self._states)
+
+    def _describe(self, shard):
+        partition, (host, port) = self.shards[shard]
+        return f"{format_partition(partition)}@{host}:{port}"
+
+    def _connect(self, shard):
+        with self._lock:
+            # Connexions héritées d'un fork (gunicorn --preload) : propres au processus parent
+            if self._pid != os.getpid():
+                self._idle = [[] for _ in self.shards]
+                self._pid = os.getpid()
+            if self._idle[shard]:
+                return self._idle[shard].pop()
+        return Client(self.shards[shard][1], authkey=self.authkey)
+
+    def _update_state(self, shard, version, size):
+        with self._lock:
+            if self._states[shard] != (version, size):
+                self._states[shard] = (version, size)
+                self.version += 1
+
+    def _call_many(self, requests):
+        """{shard: requête encodée} -> {shard: résultat} pour les workers qui ont répondu."""
+        sent = {}
+        for shard, request in requests.items():
+            try:
+                connection = self._connect(shard)
+                connection.send_bytes(request)
+                sent[shard] = connection
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                print(f"Error reaching search shard {self._describe(shard)}: {e}")
+        results = {}
+        deadline = time.monotonic() + self.timeout
+        for shard, connection in sent.items():
+            try:
+                if not connection.poll(max(deadline - time.monotonic(), 0)):
+                    raise TimeoutError(f"no reply after {self.timeout}s")
+                reply, _ = decode_message(connection.recv_bytes(MAX_MESSAGE_BYTES))
+            except (OSError, EOFError, ValueError) as e:
+                # Une réponse en retard arriverait sur la requête suivante : la connexion est abandonnée
+                print(f"Error querying search shard {self._describe(shard)}: {str(e) or 'connection closed'}")
+                connection.close()
+                continue
+            with self._lock:
+                self._idle[shard].append(connection)
+            if reply.get("status") != "ok":
+                print(f"Search shard {self._describe(shard)} failed: {reply.get('error')}")
+                continue
+            self._update_state(shard, reply["version"], reply["size"])
+            results[shard] = reply["result"]
+        return results
+
+    def _shard_of(self, year):
+        if year is None:
+            return len(self.shards) - 1
+        for shard, (partition, _) in enumerate(self.shards):
+            if in_range(year, partition):
+                return shard
+        return None
+
+    def load_from_collection(self, collection, batch_size=1000):
+        """Chaque worker complète sa partition depuis MongoDB ; la collection sert à router les ajouts."""
+        self.bind_collection(collection)
+        request = encode_message({"op": "load", "batch_size": batch_size})
+        results = self._call_many({shard: request for shard in range(len(self.shards))})
+        self._last_refresh = time.monotonic()
+        return sum(results.values())
+
+    def add(self, movie_id, embedding):
+        """Envoie l'embedding au worker de la partition du film (release_year lu dans MongoDB)."""
+        if self._collection is None:
+            return False
+        movie = self._collection.find_one({"_id": ObjectId(movie_id)}, {"release_year": 1})
+        shard = self._shard_of(movie.get("release_year")) if movie else None
+        if shard is None:
+            return False
+        request = encode_message({"op": "add", "movie_id": str(movie_id), "year": movie.get("release_year")},
+                                 embedding)
+        return bool(self._call_many({shard: request}).get(shard))
+
+    def remove(self, movie_id):
+        # La partition du film n'est pas connue ici : tous les workers reçoivent la suppression
+        request = encode_message({"op": "remove", "movie_id": str(movie_id)})
+        results = self._call_many({shard: request for shard in range(len(self.shards))})
+        return any(results.values())
+
+    def search(self, query_embedding, k=5, allowed=None, years=None):
+        """Top-k fusionné des workers ; years=(min, max) écarte les partitions hors de la plage."""
+        if allowed is not None:
+            allowed = {str(movie_id) for movie_id in allowed}
+            if not allowed:
+                return []
+        request = encode_message({"op": "search", "k": k, "allowed": None if allowed is None else sorted(allowed),
+                                  "years": None if years is None else list(years)}, query_embedding)
+        targets = [shard for shard, (partition, _) in enumerate(self.shards) if overlaps(partition, years)]
+        results = self._call_many({shard: request for shard in targets})
+        hits = ((movie_id, score) for shard_hits in results.values() for movie_id, score in shard_hits)
+        return heapq.nlargest(k, hits, key=lambda hit: hit[1])
+
+    def stats(self):
+        """État de chaque worker (None s'il ne répond pas)."""
+        request = encode_message({"op": "stats"})
+        results = self._call_many({shard: request for shard in range(len(self.shards))})
+        return [{"shard": self._describe(shard), "size": self._states[shard][1], **results[shard]}
+                if shard in results else None for shard in range(len(self.shards))]
+
+
+def launch_local(partitions, base_port, kind=None):
+    """Démarre un worker par partition sur cette machine ; retourne (processus, valeur de SEARCH_SHARDS)."""
+    shard_authkey()  # échoue ici plutôt que dans chaque worker
+    context = multiprocessing.get_context("spawn")
+    processes, shards = [], []
+    for position, partition in enumerate(partitions):
+        port = base_port + position
+        process = context.Process(target=serve_shard, args=(partition, port),
+                                  kwargs={"host": "127.0.0.1", "kind": kind,
+                                          "holds_undated": position == len(partitions) - 1},
+                                  name=f"shard-{format_partition(partition)}", daemon=True)
+        process.start()
+        processes.append(process)
+        shards.append(f"{format_partition(partition)}@127.0.0.1:{port}")
+    return processes, ",".join(shards)
+
+
+if __name__ == '__main__':
+    #   python sharded_search.py serve --partition 1990:2009 --port 6102     un worker (une machine par partition)
+    #   python sharded_search.py local --partitions :1989,1990:2009,2010:    tous les workers sur cette machine
+    parser = argparse.ArgumentParser(description="Scatter-gather poster search workers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="serve one release_year partition")
+    serve.add_argument("--partition", required=True, help="release_year range, e.g. 1990:2009, :1989 or 2010:")
+    serve.add_argument("--port", type=int, required=True)
+    serve.add_argument("--host", default="127.0.0.1",
+                       help="listening address (default: localhost); only expose it on a private network")
+    serve.add_argument("--undated", action="store_true", help="also hold movies without release_year (last shard)")
+    local = commands.add_parser("local", help="start one worker process per partition on this machine")
+    local.add_argument("--partitions", required=True, help="comma-separated ranges, e.g. :1989,1990:2009,2010:")
+    local.add_argument("--base-port", type=int, default=6101)
+    for command in (serve, local):
+        command.add_argument("--backend", help="index kind of each worker (default: SHARD_BACKEND or exact)")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve_shard(parse_partitions(args.partition)[0], args.port, args.host, args.backend, args.undated)
+    else:
+        processes, spec = launch_local(parse_partitions(args.partitions), args.base_port, args.backend)
+        print(f"SEARCH_BACKEND=sharded SEARCH_SHARDS={spec}")
+        for process in processes:
+            process.join()
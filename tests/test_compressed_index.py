@@ -0,0 +1,144 @@
+"""Index compressé (int8 / float16, projection PCA) : erreur des codes, save/load et re-ranking."""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from projection import Projection, explained_ratio, fit_projection  # noqa: E402
+from search_backends import CompressedIndex  # noqa: E402
+from vector_index import EmbeddingIndex, normalize  # noqa: E402
+
+DIM = 64
+N = 2000
+K = 10
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    """Vecteurs groupés autour de centres vivant dans un sous-espace de 16 dimensions."""
+    rng = np.random.default_rng(0)
+    basis = rng.normal(size=(16, DIM))
+    centers = rng.normal(size=(40, 16)) @ basis
+    vectors = centers[rng.integers(0, len(centers), size=N)] + 0.4 * rng.normal(size=(N, DIM))
+    queries = centers[rng.integers(0, len(centers), size=50)] + 0.4 * rng.normal(size=(50, DIM))
+    return [f"movie{i}" for i in range(N)], vectors.astype(np.float32), queries.astype(np.float32)
+
+
+def build(ids, vectors, **params):
+    index = CompressedIndex(dim=DIM, **params)
+    index.add_many(ids, vectors)
+    return index
+
+
+def recall(index, exact, queries):
+    found = []
+    for query in queries:
+        expected = {movie_id for movie_id, _ in exact.search(query, K)}
+        found.append(len({movie_id for movie_id, _ in index.search(query, K)} & expected) / K)
+    return float(np.mean(found))
+
+
+@pytest.mark.parametrize("dtype, max_error", [("int8", 1 / 254), ("float16", 2 ** -11), ("float32", 0)])
+def test_code_round_trip_error_is_bounded(dtype, max_error, catalog):
+    _, vectors, _ = catalog
+    index = CompressedIndex(dim=DIM, dtype=dtype, rerank=0)
+    for vector in vectors[:200]:
+        vector = normalize(vector)
+        code, scale = index._code(vector)
+        assert code.dtype == np.dtype(dtype)
+        decoded = code.astype(np.float32) * scale
+        # int8 : demi-pas de quantification de la ligne ; float16 : demi-ulp relatif
+        assert np.max(np.abs(decoded - vector)) <= max_error * np.max(np.abs(vector)) + 1e-7
+        assert float(decoded @ vector) / np.linalg.norm(decoded) > 0.999
+
+
+def test_quantized_scores_stay_close_to_exact_scores(catalog):
+    ids, vectors, queries = catalog
+    index = build(ids, vectors, dtype="int8", rerank=0)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    for query in queries[:10]:
+        query = normalize(query)
+        approximate = index._approximate_scores(query, None)
+        exact = normalized[[index._positions[movie_id] for movie_id in index._ids]] @ query
+        assert np.max(np.abs(approximate - exact)) < 0.01
+
+
+def test_projection_keeps_the_variance_of_the_subspace(catalog, tmp_path):
+    _, vectors, _ = catalog
+    projection = fit_projection(vectors, 16)
+    assert (projection.in_dim, projection.out_dim) == (DIM, 16)
+    assert explained_ratio(projection, vectors) > 0.8
+    assert projection.apply(vectors[:5]).shape == (5, 16)
+
+    path = str(tmp_path / "pca16")
+    projection.save(path)
+    loaded = Projection.load(path)
+    assert loaded.version == projection.version
+    assert np.allclose(loaded.apply(vectors[:5]), projection.apply(vectors[:5]))
+    assert fit_projection(vectors, 16, whiten=True).version != projection.version
+    assert fit_projection(vectors[:1000], 16).version != projection.version
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_save_and_load_preserve_the_projection_version(dtype, catalog, tmp_path):
+    ids, vectors, queries = catalog
+    projection = fit_projection(vectors, 16)
+    index = build(ids, vectors, dtype=dtype, projection=projection, rerank=32, rerank_from="memory")
+    index.remove(ids[0])
+    path = str(tmp_path / "compressed.index")
+    index.save(path)
+
+    loaded = CompressedIndex(dim=DIM, dtype=dtype, projection=projection, rerank=32, rerank_from="memory").load(path)
+    assert len(loaded) == len(index) == N - 1
+    assert ids[0] not in loaded
+    for query in queries[:10]:
+        assert loaded.search(query, K) == index.search(query, K)
+    assert loaded.add("new", queries[0])
+    assert loaded.search(queries[0], 1)[0][0] == "new"
+
+    # Une autre projection, aucune projection ou un autre dtype : l'index refuse de se charger
+    other = fit_projection(vectors[:1000], 16)
+    for params in ({"dtype": dtype, "projection": other}, {"dtype": dtype},
+                   {"dtype": "float32", "projection": projection}):
+        with pytest.raises(ValueError):
+            CompressedIndex(dim=DIM, rerank=32, rerank_from="memory", **params).load(path)
+    # Sauvé avec sa copie float32 : rechargeable sans, pour un re-ranking depuis MongoDB
+    assert len(CompressedIndex(dim=DIM, dtype=dtype, projection=projection).load(path)) == N - 1
+
+
+def test_memory_rerank_reaches_exact_recall(catalog):
+    ids, vectors, queries = catalog
+    exact = EmbeddingIndex(dim=DIM)
+    exact.add_many(ids, vectors)
+    projection = fit_projection(vectors, 8)
+    quantized_only = build(ids, vectors, dtype="int8", projection=projection, rerank=0)
+    reranked = build(ids, vectors, dtype="int8", projection=projection, rerank=128, rerank_from="memory")
+    assert recall(reranked, exact, queries) == 1.0
+    # Les scores sont alors les cosinus exacts en float32
+    for query in queries[:10]:
+        assert np.allclose([score for _, score in reranked.search(query, K)],
+                           [score for _, score in exact.search(query, K)], atol=1e-5)
+    assert recall(quantized_only, exact, queries) < 1.0
+    assert reranked.rerank_bytes() == N * DIM * 4
+    assert quantized_only.rerank_bytes() == 0
+
+
+def test_mongo_rerank_without_collection_keeps_quantized_scores(catalog):
+    ids, vectors, queries = catalog
+    index = build(ids, vectors, dtype="int8", rerank=64)
+    assert index.rerank_from == "mongo" and index.rerank_bytes() == 0
+    assert index.resident_bytes() == N * DIM + N * 4
+    assert len(index.search(queries[0], K)) == K
+
+
+def test_invalid_parameters_are_rejected(catalog):
+    _, vectors, _ = catalog
+    with pytest.raises(ValueError):
+        CompressedIndex(dim=DIM, dtype="int4")
+    with pytest.raises(ValueError):
+        CompressedIndex(dim=DIM, rerank_from="disk")
+    with pytest.raises(ValueError):
+        CompressedIndex(dim=32, projection=fit_projection(vectors, 16))
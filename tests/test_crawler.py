@@ -0,0 +1,165 @@
+"""Crawler contre un serveur HTTP local : requêtes conditionnelles, retries et limites de débit."""
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crawler import Crawler, TokenBucket  # noqa: E402
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+class FixtureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.lock = threading.Lock()
+        self.requests = []  # (chemin, en-têtes de la requête)
+        self.failures = {}  # chemin -> nombre de 503 restant à renvoyer
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_port}{path}"
+
+    def hits(self, path):
+        return [headers for request_path, headers in self.requests if request_path == path]
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """/etag et /dated : validateurs ETag ou Last-Modified ; /flaky : 503 puis 200 ; /slow/* : 200 après 0,2 s."""
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, dict(self.headers)))
+            failures = server.failures.get(self.path, 0)
+            if failures:
+                server.failures[self.path] = failures - 1
+        if self.path == "/etag":
+            if self.headers.get("If-None-Match") == ETAG:
+                return self.reply(304)
+            return self.reply(200, b"etag page", {"ETag": ETAG})
+        if self.path == "/dated":
+            if self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                return self.reply(304)
+            return self.reply(200, b"dated page", {"Last-Modified": LAST_MODIFIED})
+        if self.path == "/flaky":
+            if failures:
+                return self.reply(503)
+            return self.reply(200, b"recovered")
+        if self.path.startswith("/slow/"):
+            with server.lock:
+                server.in_flight += 1
+                server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            time.sleep(0.2)
+            with server.lock:
+                server.in_flight -= 1
+            return self.reply(200, self.path.encode())
+        self.reply(404)
+
+
+@pytest.fixture
+def server():
+    server = FixtureServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_etag_returns_304_once_confirmed(server, tmp_path):
+    cache_path = str(tmp_path / "crawler_cache.json")
+    crawler = Crawler(rate=100, burst=10, cache_path=cache_path)
+    url = server.url("/etag")
+    assert crawler.fetch(url) == b"etag page"
+    # Validateurs non confirmés (films de la page non enregistrés) : la page est retéléchargée
+    assert crawler.fetch(url) == b"etag page"
+    assert "If-None-Match" not in server.hits("/etag")[1]
+    crawler.confirm([url])
+    crawler.close()
+
+    # Passage suivant : les validateurs sont relus depuis cache_path
+    crawler = Crawler(rate=100, burst=10, cache_path=cache_path)
+    assert crawler.fetch(url) is None
+    assert server.hits("/etag")[-1]["If-None-Match"] == ETAG
+    assert crawler.fetch(url, conditional=False) == b"etag page"
+    crawler.close()
+
+
+def test_if_modified_since_returns_304(server):
+    crawler = Crawler(rate=100, burst=10)
+    url = server.url("/dated")
+    assert crawler.fetch(url) == b"dated page"
+    crawler.confirm([url])
+    assert crawler.fetch(url) is None
+    assert server.hits("/dated")[-1]["If-Modified-Since"] == LAST_MODIFIED
+    crawler.close()
+
+
+def test_503_is_retried_with_backoff(server):
+    server.failures["/flaky"] = 2
+    crawler = Crawler(rate=100, burst=10, retries=3, backoff_factor=0.1)
+    started = time.monotonic()
+    assert crawler.fetch(server.url("/flaky")) == b"recovered"
+    # urllib3 : pas d'attente avant le premier retry, puis backoff_factor * 2 avant le second
+    assert time.monotonic() - started >= 0.2
+    assert len(server.hits("/flaky")) == 3
+    crawler.close()
+
+
+def test_503_beyond_retries_raises(server):
+    server.failures["/flaky"] = 5
+    crawler = Crawler(rate=100, burst=10, retries=2, backoff_factor=0.01)
+    with pytest.raises(requests.exceptions.RequestException):
+        crawler.fetch(server.url("/flaky"))
+    assert len(server.hits("/flaky")) == 3
+    crawler.close()
+
+
+def test_concurrency_is_bounded_per_host(server):
+    crawler = Crawler(rate=100, burst=10, max_per_host=2, concurrency=8)
+    urls = [server.url(f"/slow/{i}") for i in range(8)]
+    assert crawler.map(crawler.fetch, urls) == [f"/slow/{i}".encode() for i in range(8)]
+    assert server.max_in_flight == 2
+    crawler.close()
+
+
+def test_rate_is_limited_by_token_bucket(server):
+    crawler = Crawler(rate=20, burst=2, concurrency=8)
+    started = time.monotonic()
+    crawler.map(crawler.fetch, [server.url("/etag")] * 8)
+    # 2 jetons de rafale, puis 6 requêtes à 20/s
+    assert time.monotonic() - started >= 6 / 20 - 0.05
+    crawler.close()
+
+
+def test_token_bucket_allows_burst_then_rate():
+    bucket = TokenBucket(rate=50, burst=5)
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - started < 0.05
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - started >= 5 / 50 - 0.01
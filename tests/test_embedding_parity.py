@@ -0,0 +1,76 @@
+"""Parité du modèle int8 (EMBEDDING_MODE=quantized) avec le modèle float32 de référence.
+
+Les poids sont initialisés aléatoirement (aucun téléchargement) : le ResNet-18 float est
+quantifié statiquement après calibration sur des images générées, puis les deux fichiers
+de poids sont relus par check_parity comme en production.
+"""
+import copy
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+quantization = pytest.importorskip("torchvision.models.quantization")
+from PIL import Image, ImageDraw  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_service import check_parity, load_image_tensor  # noqa: E402
+
+
+def generated_posters(count, seed):
+    """Affiches synthétiques : dégradé de fond, rectangles et ellipses de couleurs aléatoires."""
+    rng = np.random.default_rng(seed)
+    posters = []
+    for _ in range(count):
+        top, bottom = rng.integers(0, 256, size=(2, 3))
+        gradient = np.linspace(top, bottom, 300)[:, None, :].repeat(200, axis=1)
+        image = Image.fromarray(gradient.astype(np.uint8))
+        draw = ImageDraw.Draw(image)
+        for _ in range(6):
+            x0, y0 = rng.integers(0, 150), rng.integers(0, 250)
+            box = (x0, y0, x0 + rng.integers(10, 60), y0 + rng.integers(10, 60))
+            fill = tuple(int(value) for value in rng.integers(0, 256, size=3))
+            (draw.rectangle if rng.random() < 0.5 else draw.ellipse)(box, fill=fill)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG")
+        posters.append(buffer.getvalue())
+    return posters
+
+
+@pytest.fixture(scope="module")
+def weights(tmp_path_factory):
+    """(poids float32, poids int8) d'un même ResNet-18 initialisé aléatoirement."""
+    engines = torch.backends.quantized.supported_engines
+    engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+    if engine not in engines:
+        pytest.skip("no quantized engine available")
+    torch.backends.quantized.engine = engine
+    torch.manual_seed(0)
+    model = quantization.resnet18(weights=None, quantize=False).eval()
+    directory = tmp_path_factory.mktemp("weights")
+    reference_path, quantized_path = directory / "resnet18.pth", directory / "resnet18_int8.pth"
+    torch.save(model.state_dict(), reference_path)
+
+    quantized = copy.deepcopy(model)
+    quantized.fuse_model()
+    quantized.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    torch.ao.quantization.prepare(quantized, inplace=True)
+    with torch.no_grad():
+        quantized(torch.stack([load_image_tensor(poster) for poster in generated_posters(32, seed=1)]))
+    torch.ao.quantization.convert(quantized, inplace=True)
+    quantized.fc = torch.nn.Identity()  # même structure que build_quantized_model
+    torch.save(quantized.state_dict(), quantized_path)
+    return reference_path, quantized_path
+
+
+def test_quantized_embeddings_agree_with_float_model(weights):
+    reference_path, quantized_path = weights
+    report = check_parity(generated_posters(8, seed=2), "quantized", batch_size=4, weights_path=str(quantized_path),
+                          reference_weights_path=str(reference_path))
+    assert report["images"] == 8
+    assert report["cosine_mean"] > 0.99
+    assert report["cosine_min"] > 0.99
@@ -0,0 +1,141 @@
+"""Empreintes de posters : BK-tree, affiches uniformes et confirmation des doublons (sha256 ou embedding)."""
+import hashlib
+import io
+import os
+import sys
+
+import numpy as np
+from bson.objectid import ObjectId
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_codec import encode_embedding  # noqa: E402
+from perceptual_hash import (BKTree, DUPLICATE_DISTANCE, PosterHashIndex, confirm_duplicates, hamming,  # noqa: E402
+                             poster_hashes, resolve_duplicates)
+
+
+def jpeg(image, quality=90):
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def poster(seed, size=(200, 300)):
+    """Affiche synthétique : dégradé de fond et formes de couleurs tirées au hasard."""
+    rng = np.random.default_rng(seed)
+    top, bottom = rng.integers(0, 256, size=(2, 3))
+    gradient = np.linspace(top, bottom, size[1])[:, None, :].repeat(size[0], axis=1)
+    image = Image.fromarray(gradient.astype(np.uint8))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x0, y0 = int(rng.integers(0, size[0] - 40)), int(rng.integers(0, size[1] - 40))
+        box = (x0, y0, x0 + int(rng.integers(20, 80)), y0 + int(rng.integers(20, 80)))
+        fill = tuple(int(value) for value in rng.integers(0, 256, size=3))
+        (draw.rectangle if rng.random() < 0.5 else draw.ellipse)(box, fill=fill)
+    return image
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class Collection:
+    """Collection minimale pour resolve_duplicates : find sur une liste de _id."""
+
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: doc for doc in docs}
+
+    def find(self, query, projection=None):
+        return [self.docs[movie_id] for movie_id in query["_id"]["$in"] if movie_id in self.docs]
+
+
+def test_bk_tree_radius_queries_match_brute_force():
+    rng = np.random.default_rng(0)
+    keys = [int(key) for key in rng.integers(0, 2 ** 63, size=300, dtype=np.int64)]
+    # Des clés proches les unes des autres, pour que les petits rayons trouvent quelque chose
+    keys += [key ^ (1 << int(bit)) for key in keys[:50] for bit in rng.integers(0, 64, size=2)]
+    tree = BKTree()
+    for value, key in enumerate(keys):
+        tree.add(key, value)
+    for query in keys[:20] + [int(rng.integers(0, 2 ** 63))]:
+        for radius in (0, 1, 3, 10, 30):
+            expected = sorted((hamming(query, key), value) for value, key in enumerate(keys)
+                              if hamming(query, key) <= radius)
+            assert sorted(tree.find(query, radius)) == expected
+
+
+def test_bk_tree_shared_keys_and_discard():
+    tree = BKTree()
+    tree.add(0b1010, "a")
+    tree.add(0b1010, "b")
+    tree.add(0b1011, "c")
+    assert sorted(tree.find(0b1010, 0)) == [(0, "a"), (0, "b")]
+    tree.discard(0b1010, "a")
+    # Le nœud reste un point de passage : son enfant est toujours trouvé
+    assert sorted(tree.find(0b1010, 1)) == [(0, "b"), (1, "c")]
+    assert BKTree().find(0, 64) == []
+
+
+def test_hashes_survive_resize_and_recompression():
+    # Graine fixe : sur les bords nets de certaines affiches générées, le dHash 9x8 perd plus de 2 bits
+    original = poster(3)
+    hashes = poster_hashes(jpeg(original))
+    resized = poster_hashes(jpeg(original.resize((150, 225)), quality=60))
+    other = poster_hashes(jpeg(poster(2)))
+    index = PosterHashIndex()
+    index.add("original", hashes)
+    index.add("other", other)
+    assert [movie_id for movie_id, _ in index.match(resized, DUPLICATE_DISTANCE)] == ["original"]
+
+
+def test_flat_posters_are_not_hashed():
+    black = jpeg(Image.new("RGB", (200, 300)))
+    noisy_gray = np.full((300, 200, 3), 128, dtype=np.uint8) + np.random.default_rng(0).integers(0, 2, (300, 200, 3),
+                                                                                                  dtype=np.uint8)
+    assert poster_hashes(black) == {}
+    assert poster_hashes(jpeg(Image.fromarray(noisy_gray))) == {}
+    assert poster_hashes(b"not an image") == {}
+    assert set(poster_hashes(jpeg(poster(4)))) == {"poster_phash", "poster_dhash"}
+
+
+def test_duplicates_in_a_batch_are_confirmed_by_sha256_or_embedding():
+    original = jpeg(poster(3))
+    recompressed = jpeg(poster(3), quality=60)
+    flat = jpeg(Image.new("RGB", (200, 300), (20, 20, 20)))
+    posters = [original, original, recompressed, flat, flat, jpeg(poster(2))]
+    sources, confirmed = resolve_duplicates([poster_hashes(p) for p in posters], None, Collection([]),
+                                            [sha256(p) for p in posters])
+    # Les affiches uniformes n'ont pas d'empreinte : jamais fusionnées, même identiques
+    assert sources == [None, 0, 0, None, None, None]
+    assert confirmed == [False, True, False, False, False, False]
+
+    # Seule la recompression (sha256 différent) dépend des embeddings
+    rng = np.random.default_rng(0)
+    embedding = rng.normal(size=512)
+    embeddings = [embedding, None, embedding + 0.01 * rng.normal(size=512), None, None, None]
+    assert confirm_duplicates(sources, confirmed, embeddings) == sources
+    embeddings[2] = rng.normal(size=512)
+    assert confirm_duplicates(sources, confirmed, embeddings) == [None, 0, None, None, None, None]
+
+
+def test_catalog_duplicates_are_confirmed_by_sha256_or_embedding():
+    original, recompressed = jpeg(poster(3)), jpeg(poster(3), quality=60)
+    embedding = np.random.default_rng(0).normal(size=512)
+    movie_id = ObjectId()
+    catalog = {"_id": movie_id, "image_id": ObjectId(), "poster_variants": {},
+               "embedding": encode_embedding(embedding), "poster_sha256": sha256(original)}
+    hash_index = PosterHashIndex()
+    hash_index.add(movie_id, poster_hashes(original))
+    posters = [original, recompressed]
+    sources, confirmed = resolve_duplicates([poster_hashes(p) for p in posters], hash_index, Collection([catalog]),
+                                            [sha256(p) for p in posters])
+    assert [source["_id"] for source in sources] == [movie_id, movie_id]
+    assert confirmed == [True, False]
+    # L'embedding de la recompression est comparé à celui stocké sur le film du catalogue
+    assert confirm_duplicates(sources, confirmed, [None, embedding * 1.5]) == sources
+    assert confirm_duplicates(sources, confirmed, [None, -embedding]) == [sources[0], None]
+
+    # Film source supprimé entre-temps : l'affiche est stockée comme une nouvelle
+    sources, confirmed = resolve_duplicates([poster_hashes(original)], hash_index, Collection([]), [sha256(original)])
+    assert sources == [None] and confirmed == [False]
@@ -0,0 +1,153 @@
+"""Backends FAISS (flat, hnsw, ivfpq) comparés à l'index exact : recall, suppressions, filtres et save/load."""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from search_backends import create_backend  # noqa: E402
+from vector_index import EmbeddingIndex  # noqa: E402
+
+DIM = 64
+N = 3000
+K = 10
+PARAMS = {
+    "flat": {},
+    "hnsw": {"m": 16, "ef_construction": 100, "ef_search": 64},
+    # nbits=6 : 39 * 2^6 vecteurs suffisent à l'entraînement, le catalogue de test y passe
+    "ivfpq": {"nlist": 16, "m": 32, "nbits": 6, "nprobe": 16, "train_size": 2500},
+}
+MIN_RECALL = {"flat": 1.0, "hnsw": 0.95, "ivfpq": 0.6}
+
+
+def clustered(n, rng, centers):
+    """Vecteurs tirés autour de centres (plus proches de vrais embeddings qu'un bruit uniforme)."""
+    vectors = centers[rng.integers(0, len(centers), size=n)] + 0.6 * rng.normal(size=(n, DIM))
+    return vectors.astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(40, DIM))
+    ids = [f"movie{i}" for i in range(N)]
+    return ids, clustered(N, rng, centers), clustered(50, rng, centers)
+
+
+def build(kind, ids, vectors):
+    backend = create_backend(kind, dim=DIM, **PARAMS[kind])
+    for start in range(0, len(ids), 500):
+        backend.add_many(ids[start:start + 500], vectors[start:start + 500])
+    return backend
+
+
+def exact_index(ids, vectors):
+    index = EmbeddingIndex(dim=DIM)
+    index.add_many(ids, vectors)
+    return index
+
+
+def recall(backend, exact, queries, allowed=None):
+    found = []
+    for query in queries:
+        expected = {movie_id for movie_id, _ in exact.search(query, K, allowed)}
+        hits = {movie_id for movie_id, _ in backend.search(query, K, allowed)}
+        found.append(len(hits & expected) / len(expected))
+    return float(np.mean(found))
+
+
+@pytest.mark.parametrize("kind", list(PARAMS))
+def test_recall_against_exact_search(kind, catalog):
+    ids, vectors, queries = catalog
+    backend = build(kind, ids, vectors)
+    assert len(backend) == N
+    if kind == "ivfpq":
+        assert backend.is_trained
+    assert recall(backend, exact_index(ids, vectors), queries) >= MIN_RECALL[kind]
+
+
+@pytest.mark.parametrize("kind", list(PARAMS))
+def test_allowed_filter(kind, catalog):
+    ids, vectors, queries = catalog
+    backend = build(kind, ids, vectors)
+    allowed = set(ids[::7])
+    for query in queries[:10]:
+        hits = backend.search(query, K, allowed)
+        assert len(hits) == K
+        assert {movie_id for movie_id, _ in hits} <= allowed
+    assert recall(backend, exact_index(ids, vectors), queries, allowed) >= MIN_RECALL[kind]
+    assert backend.search(queries[0], K, allowed={"unknown"}) == []
+
+
+@pytest.mark.parametrize("kind", list(PARAMS))
+def test_removed_movies_are_excluded(kind, catalog):
+    ids, vectors, queries = catalog
+    backend = build(kind, ids, vectors)
+    # Les voisins de chaque requête sont retirés : la recherche doit remonter les suivants
+    removed = {movie_id for query in queries for movie_id, _ in backend.search(query, 3)}
+    for movie_id in removed:
+        assert backend.remove(movie_id)
+    assert not backend.remove(next(iter(removed)))
+    assert len(backend) == N - len(removed)
+    kept = [i for i, movie_id in enumerate(ids) if movie_id not in removed]
+    exact = exact_index([ids[i] for i in kept], vectors[kept])
+    for query in queries:
+        hits = backend.search(query, K)
+        assert len(hits) == K
+        assert not {movie_id for movie_id, _ in hits} & removed
+    assert recall(backend, exact, queries) >= MIN_RECALL[kind]
+
+
+def test_hnsw_compacts_orphans(catalog):
+    ids, vectors, queries = catalog
+    backend = build("hnsw", ids, vectors)
+    removed = ids[:int(0.25 * N)]
+    for movie_id in removed[:100]:
+        backend.remove(movie_id)
+    assert backend._orphans == 100
+    for movie_id in removed[100:]:
+        backend.remove(movie_id)
+    # Passé compact_ratio (20 %) d'orphelins, le graphe est reconstruit sans eux
+    assert backend._orphans < 0.2 * N
+    assert backend._index.ntotal < N
+    assert backend._index.ntotal == len(backend) + backend._orphans
+    exact = exact_index(ids[len(removed):], vectors[len(removed):])
+    assert recall(backend, exact, queries) >= MIN_RECALL["hnsw"]
+
+
+@pytest.mark.parametrize("kind", list(PARAMS))
+def test_save_and_load_round_trip(kind, catalog, tmp_path):
+    ids, vectors, queries = catalog
+    backend = build(kind, ids, vectors)
+    removed = {movie_id for movie_id, _ in backend.search(queries[0], 5)}
+    for movie_id in removed:
+        backend.remove(movie_id)
+    path = str(tmp_path / f"{kind}.index")
+    backend.save(path)
+
+    loaded = create_backend(kind, dim=DIM, **PARAMS[kind]).load(path)
+    assert len(loaded) == len(backend)
+    for query in queries:
+        assert loaded.search(query, K) == backend.search(query, K)
+    assert not {movie_id for movie_id, _ in loaded.search(queries[0], K)} & removed
+    # Les labels continuent après ceux de l'index relu
+    assert loaded._next_label == backend._next_label
+    assert loaded.add("new", queries[1])
+    assert loaded.search(queries[1], 1)[0][0] == "new"
+
+    with pytest.raises(ValueError):
+        create_backend("flat" if kind != "flat" else "hnsw", dim=DIM).load(path)
+
+
+def test_ivfpq_serves_exact_results_until_trained(catalog):
+    ids, vectors, queries = catalog
+    backend = build("ivfpq", ids[:1000], vectors[:1000])
+    assert not backend.is_trained
+    exact = exact_index(ids[:1000], vectors[:1000])
+    assert [hit[0] for hit in backend.search(queries[0], K)] == [hit[0] for hit in exact.search(queries[0], K)]
+    with pytest.raises(ValueError):
+        backend.save("unused")
@@ -0,0 +1,151 @@
+"""Recherche répartie : workers locaux (launch_local) comparés à l'index exact.
+
+Nécessite un MongoDB joignable à MONGO_URI : la base cinematch_test_shards y est recréée
+à chaque exécution. Sans MongoDB, les tests des workers sont ignorés.
+
+    python -m pytest tests
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embedding_codec import encode_embedding  # noqa: E402
+from sharded_search import (ShardedSearch, decode_message, encode_message, launch_local,  # noqa: E402
+                            parse_partitions, parse_shards)
+from vector_index import EmbeddingIndex  # noqa: E402
+
+TEST_DB = "cinematch_test_shards"
+PARTITIONS = ":1979,1980:1999,2000:"
+BASE_PORT = 6301
+N_MOVIES = 600
+DIM = 512
+
+
+def seed_catalog(collection, rng):
+    """Films d'années réparties sur toutes les partitions, un sur cinquante sans release_year."""
+    collection.insert_many([
+        {"title": f"Movie {i}", "release_year": None if i % 50 == 0 else int(rng.integers(1950, 2025)),
+         "embedding": encode_embedding(rng.normal(size=DIM).astype(np.float32))}
+        for i in range(N_MOVIES)
+    ])
+
+
+def allowed_in(collection, years):
+    """Films de la plage years selon MongoDB (référence du filtre par année)."""
+    year_min, year_max = years
+    bounds = {}
+    if year_min is not None:
+        bounds["$gte"] = year_min
+    if year_max is not None:
+        bounds["$lte"] = year_max
+    return {str(doc["_id"]) for doc in collection.find({"release_year": bounds}, {"_id": 1})}
+
+
+@pytest.fixture(scope="module")
+def cluster():
+    from pymongo import MongoClient
+    from pymongo.errors import PyMongoError
+
+    client = MongoClient(os.environ.get("MONGO_URI", "mongodb://localhost:27017/"), serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError as e:
+        pytest.skip(f"MongoDB unavailable: {e}")
+    client.drop_database(TEST_DB)
+    collection = client[TEST_DB]["movies"]
+    seed_catalog(collection, np.random.default_rng(7))
+
+    # Lus par les workers au démarrage (processus spawn : ils héritent de l'environnement)
+    previous = {name: os.environ.get(name) for name in ("MONGO_DB", "SEARCH_SHARD_AUTHKEY")}
+    os.environ["MONGO_DB"] = TEST_DB
+    os.environ["SEARCH_SHARD_AUTHKEY"] = "test-shard-key"
+    processes, spec = launch_local(parse_partitions(PARTITIONS), BASE_PORT)
+    try:
+        search = ShardedSearch(dim=DIM, shards=parse_shards(spec), timeout=10)
+        deadline = time.monotonic() + 120
+        while not all(search.stats()):
+            if time.monotonic() > deadline:
+                pytest.fail("shard workers did not start")
+            time.sleep(0.5)
+        search.load_from_collection(collection)
+        exact = EmbeddingIndex(dim=DIM)
+        exact.load_from_collection(collection)
+        yield search, exact, collection
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        client.drop_database(TEST_DB)
+
+
+def test_message_roundtrip():
+    vector = np.random.default_rng(0).normal(size=DIM).astype(np.float32)
+    message, decoded = decode_message(encode_message({"op": "search", "k": np.int64(5), "years": [1990, None]},
+                                                     vector))
+    assert message == {"op": "search", "k": 5, "years": [1990, None]}
+    assert np.array_equal(decoded, vector)
+    assert decode_message(encode_message({"op": "stats"})) == ({"op": "stats"}, None)
+
+
+def test_authkey_is_required(monkeypatch):
+    monkeypatch.delenv("SEARCH_SHARD_AUTHKEY", raising=False)
+    with pytest.raises(ValueError):
+        ShardedSearch(shards=parse_shards(f":@127.0.0.1:{BASE_PORT}"))
+    with pytest.raises(ValueError):
+        launch_local(parse_partitions(PARTITIONS), BASE_PORT)
+
+
+def test_merged_top_k_matches_exact_index(cluster):
+    search, exact, _ = cluster
+    assert len(search) == len(exact) == N_MOVIES
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        query = rng.normal(size=DIM)
+        hits, expected = search.search(query, k=10), exact.search(query, k=10)
+        assert [movie_id for movie_id, _ in hits] == [movie_id for movie_id, _ in expected]
+        assert np.allclose([score for _, score in hits], [score for _, score in expected], atol=1e-5)
+
+
+def test_year_filter_matches_partition_routing(cluster):
+    search, exact, collection = cluster
+    stats = search.stats()
+    assert [shard["partition"] for shard in stats] == PARTITIONS.split(",")
+    assert sum(shard["undated"] for shard in stats) == stats[-1]["undated"] == N_MOVIES // 50
+
+    rng = np.random.default_rng(2)
+    # Plages dans une seule partition, à cheval sur deux, et ouvertes
+    for years in [(1985, 1990), (None, 1975), (1995, 2005), (2020, None), (1979, 1980)]:
+        query = rng.normal(size=DIM)
+        hits = search.search(query, k=10, years=years)
+        expected = exact.search(query, k=10, allowed=allowed_in(collection, years))
+        assert [movie_id for movie_id, _ in hits] == [movie_id for movie_id, _ in expected]
+
+
+def test_add_is_routed_to_the_partition_of_its_year(cluster):
+    search, _, collection = cluster
+    rng = np.random.default_rng(3)
+
+    movie_id = str(collection.find_one({"release_year": {"$gte": 1980, "$lte": 1999}})["_id"])
+    assert search.remove(movie_id)
+    query = rng.normal(size=DIM)
+    assert search.add(movie_id, query)
+    assert search.search(query, k=1)[0][0] == movie_id
+    assert search.search(query, k=1, years=(1980, 1999))[0][0] == movie_id
+    assert search.search(query, k=1, years=(2000, None))[0][0] != movie_id
+
+    # Sans release_year : dernière partition, exclu de tout filtre par année
+    undated_id = str(collection.find_one({"release_year": None})["_id"])
+    query = rng.normal(size=DIM)
+    assert search.add(undated_id, query)
+    assert search.search(query, k=1)[0][0] == undated_id
+    assert search.search(query, k=1, years=(2000, None))[0][0] != undated_id
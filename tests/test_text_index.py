@@ -0,0 +1,79 @@
+"""Classement BM25 de TextIndex et fusion RRF des classements texte et poster."""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from text_index import TextIndex, reciprocal_rank_fusion, tokenize  # noqa: E402
+
+MOVIES = {
+    "title_match": {"title": "Space Odyssey", "overview": "A long voyage."},
+    "overview_match": {"title": "Voyage", "overview": "Astronauts drift through space."},
+    "twice_in_overview": {"title": "Drift", "overview": "Space, and more space, between stars and planets far away."},
+    "no_match": {"title": "Amélie", "overview": "A young woman in Paris.", "genres": ["Comedy"]},
+    "cast_match": {"title": "Heist", "overview": "A robbery.", "cast": [{"name": "Space Cowboy"}, "Jane Doe"]},
+}
+
+
+def build():
+    index = TextIndex()
+    for movie_id, movie in MOVIES.items():
+        index.add(movie_id, movie)
+    return index
+
+
+def ranking(index, query, k=10):
+    return [movie_id for movie_id, _ in index.search(query, k)]
+
+
+def test_tokenize_strips_accents_and_case():
+    assert tokenize("Amélie, LE Fabuleux destin!") == ["amelie", "le", "fabuleux", "destin"]
+
+
+def test_bm25_ordering_follows_field_weights_and_frequency():
+    index = build()
+    # Titre (poids 3) > cast (poids 2) > synopsis ; deux occurrences passent devant une seule
+    assert ranking(index, "space") == ["title_match", "cast_match", "twice_in_overview", "overview_match"]
+    scores = [score for _, score in index.search("space")]
+    assert scores == sorted(scores, reverse=True) and scores[-1] > 0
+    assert ranking(index, "space", k=2) == ["title_match", "cast_match"]
+    assert ranking(index, "amelie") == ["no_match"]
+    assert ranking(index, "comedy paris") == ["no_match"]
+    assert index.search("unknown words") == []
+
+
+def test_rare_terms_weigh_more():
+    index = build()
+    # "voyage" est dans deux films, "astronauts" dans un seul : ce dernier l'emporte à fréquence égale
+    assert ranking(index, "voyage astronauts")[0] == "overview_match"
+
+
+def test_remove_and_reindex_update_the_ranking():
+    index = build()
+    assert index.remove("title_match")
+    assert not index.remove("title_match")
+    assert "title_match" not in index and len(index) == len(MOVIES) - 1
+    assert ranking(index, "space")[0] == "cast_match"
+    # La ligne libérée est réutilisée, l'ancien texte du film réindexé n'est plus trouvé
+    index.add("new", {"title": "Space Space"})
+    index.add("cast_match", {"title": "Heist", "overview": "A robbery."})
+    assert ranking(index, "space")[0] == "new"
+    assert "cast_match" not in ranking(index, "space")
+    assert ranking(index, "cowboy") == []
+
+
+def test_reciprocal_rank_fusion_order():
+    text = [("a", 12.0), ("b", 8.0), ("c", 1.0)]
+    poster = [("c", 0.9), ("a", 0.8), ("d", 0.7)]
+    # a : 1/61 + 1/62, c : 1/63 + 1/61, b : 1/62, d : 1/63 (les scores d'origine sont ignorés)
+    fused = reciprocal_rank_fusion([text, poster])
+    assert [movie_id for movie_id, _ in fused] == ["a", "c", "b", "d"]
+    assert abs(fused[0][1] - (1 / 61 + 1 / 62)) < 1e-12
+    assert [movie_id for movie_id, _ in reciprocal_rank_fusion([text, poster], k=2)] == ["a", "c"]
+    # Avec une petite constante, la tête d'un seul classement passe devant un film moyen dans les deux
+    first = [("x", 1), ("a", 1), ("b", 1), ("m", 1)]
+    second = [("c", 1), ("d", 1), ("e", 1), ("m", 1)]
+    # m : 2/64 contre 1/61 pour x ; avec constant=0, m : 2/4 contre 1/1
+    assert reciprocal_rank_fusion([first, second], k=1, constant=60)[0][0] == "m"
+    assert reciprocal_rank_fusion([first, second], k=1, constant=0)[0][0] == "x"
+    assert reciprocal_rank_fusion([[], []]) == []
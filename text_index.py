@@ -0,0 +1,176 @@
+import math
+import re
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+from vector_index import changed_documents
+
+# Champs indexés et leur poids (un mot du titre compte plus qu'un mot du synopsis)
+TEXT_FIELDS = {"title": 3, "genres": 2, "cast": 2, "overview": 1}
+TEXT_PROJECTION = {field: 1 for field in TEXT_FIELDS}
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Minuscules sans accents, découpées en mots (« Amélie » -> ["amelie"])."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return TOKEN_PATTERN.findall(text)
+
+
+def movie_terms(movie):
+    """Fréquences pondérées des termes d'un document film."""
+    counts = {}
+    for field, weight in TEXT_FIELDS.items():
+        value = movie.get(field)
+        if not value:
+            continue
+        if isinstance(value, (list, tuple)):
+            # cast peut être une liste de chaînes ou de dicts {"name": ...}
+            value = " ".join(v.get("name", "") if isinstance(v, dict) else str(v) for v in value)
+        for term in tokenize(str(value)):
+            counts[term] = counts.get(term, 0) + weight
+    return counts
+
+
+def reciprocal_rank_fusion(rankings, k=10, constant=60):
+    """Fusionne plusieurs classements [(movie_id, score), ...] par RRF : somme de 1 / (constant + rang)."""
+    fused = {}
+    for ranking in rankings:
+        for rank, (movie_id, _) in enumerate(ranking, start=1):
+            fused[movie_id] = fused.get(movie_id, 0.0) + 1.0 / (constant + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class TextIndex:
+    """Index inversé BM25 en mémoire sur title, overview, genres et cast.
+
+    Chaque terme garde ses postings {ligne: fréquence} ; une copie numpy (lignes, fréquences)
+    est reconstruite à la demande quand le terme a changé, ce qui rend une recherche
+    proportionnelle à la taille des postings des termes de la requête, jamais au catalogue.
+    Les lignes libérées par remove sont réutilisées.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}
+        self._arrays = {}
+        self._ids = []
+        self._rows = {}
+        self._doc_terms = []
+        self._lengths = np.zeros(1024, dtype=np.float32)
+        self._free_rows = []
+        self._total_length = 0.0
+        self._last_object_id = None
+        self._last_updated_at = None
+        self._last_refresh = 0.0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, movie_id):
+        return str(movie_id) in self._rows
+
+    def _allocate_row(self, movie_id):
+        if self._free_rows:
+            row = self._free_rows.pop()
+            self._ids[row] = movie_id
+            return row
+        row = len(self._ids)
+        self._ids.append(movie_id)
+        self._doc_terms.append(None)
+        if row >= len(self._lengths):
+            self._lengths = np.concatenate([self._lengths, np.zeros(len(self._lengths), dtype=np.float32)])
+        return row
+
+    def _unindex(self, row):
+        for term in self._doc_terms[row]:
+            postings = self._postings[term]
+            del postings[row]
+            if not postings:
+                del self._postings[term]
+            self._arrays.pop(term, None)
+        self._total_length -= self._lengths[row]
+        self._lengths[row] = 0
+        self._doc_terms[row] = None
+
+    def add(self, movie_id, movie):
+        """Indexe (ou réindexe) les champs texte d'un film."""
+        movie_id = str(movie_id)
+        terms = movie_terms(movie)
+        with self._lock:
+            row = self._rows.get(movie_id)
+            if row is None:
+                row = self._allocate_row(movie_id)
+                self._rows[movie_id] = row
+            else:
+                self._unindex(row)
+            for term, count in terms.items():
+                self._postings.setdefault(term, {})[row] = count
+                self._arrays.pop(term, None)
+            length = sum(terms.values())
+            self._doc_terms[row] = list(terms)
+            self._lengths[row] = length
+            self._total_length += length
+
+    def remove(self, movie_id):
+        movie_id = str(movie_id)
+        with self._lock:
+            row = self._rows.pop(movie_id, None)
+            if row is None:
+                return False
+            self._unindex(row)
+            self._ids[row] = None
+            self._free_rows.append(row)
+        return True
+
+    def _term_arrays(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            postings = self._postings[term]
+            arrays = (
+                np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                np.fromiter(postings.values(), dtype=np.float32, count=len(postings)),
+            )
+            self._arrays[term] = arrays
+        return arrays
+
+    def search(self, query, k=10):
+        """Retourne les k films les plus pertinents pour la requête, en (movie_id, score BM25)."""
+        terms = set(tokenize(query))
+        with self._lock:
+            count = len(self._rows)
+            terms = [term for term in terms if term in self._postings]
+            if not count or not terms or k <= 0:
+                return []
+            average_length = self._total_length / count
+            scores = np.zeros(len(self._ids), dtype=np.float32)
+            for term in terms:
+                rows, frequencies = self._term_arrays(term)
+                idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[rows] / average_length)
+                scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + norm)
+            candidates = np.flatnonzero(scores)
+            if len(candidates) > k:
+                candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+            candidates = candidates[np.argsort(scores[candidates])[::-1]]
+            return [(self._ids[row], float(scores[row])) for row in candidates]
+
+    def load_from_collection(self, collection, batch_size=1000):
+        """Indexe (ou complète) depuis MongoDB les films insérés ou modifiés depuis le dernier chargement."""
+        loaded = 0
+        for movie in changed_documents(self, collection, {}, TEXT_PROJECTION, batch_size):
+            self.add(movie["_id"], movie)
+            loaded += 1
+        self._last_refresh = time.monotonic()
+        return loaded
+
+    def refresh_if_stale(self, collection, interval):
+        if interval is None or time.monotonic() - self._last_refresh < interval:
+            return 0
+        return self.load_from_collection(collection)
@@ -0,0 +1,253 @@
+import datetime
+import json
+import threading
+import time
+
+import numpy as np
+from bson.objectid import ObjectId
+
+from embedding_codec import decode_embedding
+
+
+def normalize(embedding):
+    """Convertit un embedding en vecteur float32 de norme 1 (ou None si nul)."""
+    vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    if norm == 0 or not np.isfinite(norm):
+        return None
+    return vector / norm
+
+
+def changed_documents(state, collection, query, projection, batch_size=1000, scope=None):
+    """Documents à (re)charger dans un index depuis son dernier chargement.
+
+    D'abord les films insérés après state._last_object_id (filtrés par query), puis les
+    films déjà chargés dont updated_at (posé par upsert_movies et edit_movie) dépasse
+    state._last_updated_at. Ces derniers ne sont filtrés que par scope : l'appelant
+    retire ceux qui ne répondent plus à query (ex: embedding effacé). Les deux repères
+    de state sont avancés au fil de la lecture."""
+    projection = {**projection, "updated_at": 1}
+    last_object_id, last_updated_at = state._last_object_id, state._last_updated_at
+    inserted = dict(query)
+    if last_object_id is not None:
+        inserted["_id"] = {"$gt": last_object_id}
+    for doc in collection.find(inserted, projection).sort("_id", 1).batch_size(batch_size):
+        state._last_object_id = doc["_id"]
+        _advance_updated_at(state, doc)
+        yield doc
+    if last_object_id is None:
+        return
+    updated = {**(scope or {}), "_id": {"$lte": last_object_id},
+               "updated_at": {"$gt": last_updated_at} if last_updated_at else {"$ne": None}}
+    for doc in collection.find(updated, projection).sort("_id", 1).batch_size(batch_size):
+        _advance_updated_at(state, doc)
+        yield doc
+
+
+def _advance_updated_at(state, doc):
+    updated_at = doc.get("updated_at")
+    if updated_at is not None and (state._last_updated_at is None or updated_at > state._last_updated_at):
+        state._last_updated_at = updated_at
+
+
+class SearchBackend:
+    """Interface commune des index de similarité de posters.
+
+    Les sous-classes implémentent add/remove/search/__len__ ainsi que
+    _save_data/_load_data ; le chargement depuis MongoDB et la persistance
+    des métadonnées de synchronisation sont partagés ici.
+
+    `version` est incrémenté à chaque modification du contenu de l'index, ce qui
+    permet aux caches de résultats de savoir s'ils sont encore valables.
+    """
+
+    kind = None
+    # Index réparti par plages de release_year (sharded_search.py) : search accepte years=(min, max)
+    partitioned = False
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self._last_object_id = None
+        self._last_updated_at = None
+        self._last_refresh = 0.0
+        self._lock = threading.RLock()
+        self._collection = None
+        self.version = 0
+
+    def add_many(self, movie_ids, embeddings):
+        added = 0
+        for movie_id, embedding in zip(movie_ids, embeddings):
+            if self.add(movie_id, embedding):
+                added += 1
+        return added
+
+    def bind_collection(self, collection):
+        """Collection relue hors de load_from_collection (re-ranking, routage des ajouts).
+
+        À rappeler après un fork (gunicorn post_fork) : le client MongoDB du maître ne doit
+        pas être utilisé par les workers."""
+        self._collection = collection
+
+    def load_from_collection(self, collection, batch_size=1000):
+        """Charge (ou complète) l'index depuis MongoDB en ne lisant que le champ embedding.
+
+        Les films modifiés depuis le dernier chargement sont réindexés (ou retirés si leur
+        embedding a été effacé), ce qui incrémente version et invalide le cache de requêtes."""
+        loaded = 0
+        ids, embeddings = [], []
+        for doc in changed_documents(self, collection, {"embedding": {"$ne": None}}, {"embedding": 1}, batch_size):
+            if doc.get("embedding") is None:
+                self.remove(doc["_id"])
+                continue
+            ids.append(doc["_id"])
+            embeddings.append(decode_embedding(doc["embedding"]))
+            if len(ids) >= batch_size:
+                loaded += self.add_many(ids, embeddings)
+                ids, embeddings = [], []
+        if ids:
+            loaded += self.add_many(ids, embeddings)
+        self._last_refresh = time.monotonic()
+        return loaded
+
+    def refresh_if_stale(self, collection, interval):
+        """Récupère les films insérés ou modifiés par d'autres processus (ex: scrap.py) depuis le dernier chargement."""
+        if interval is None or time.monotonic() - self._last_refresh < interval:
+            return 0
+        return self.load_from_collection(collection)
+
+    def save(self, path):
+        """Écrit l'index sur disque ; un fichier <path>.meta.json garde l'état de synchronisation."""
+        with self._lock:
+            self._save_data(path)
+            meta = {
+                "kind": self.kind,
+                "dim": self.dim,
+                "last_object_id": str(self._last_object_id) if self._last_object_id else None,
+                "last_updated_at": self._last_updated_at.isoformat() if self._last_updated_at else None,
+            }
+        with open(f"{path}.meta.json", "w") as f:
+            json.dump(meta, f)
+
+    def load(self, path):
+        with open(f"{path}.meta.json") as f:
+            meta = json.load(f)
+        if meta["kind"] != self.kind or meta["dim"] != self.dim:
+            raise ValueError(f"Index file {path} is a {meta['kind']}/{meta['dim']} index, expected {self.kind}/{self.dim}")
+        with self._lock:
+            self._load_data(path)
+            self._last_object_id = ObjectId(meta["last_object_id"]) if meta["last_object_id"] else None
+            last_updated_at = meta.get("last_updated_at")
+            self._last_updated_at = datetime.datetime.fromisoformat(last_updated_at) if last_updated_at else None
+        return self
+
+    def _save_data(self, path):
+        raise NotImplementedError
+
+    def _load_data(self, path):
+        raise NotImplementedError
+
+
+class EmbeddingIndex(SearchBackend):
+    """Index résident des embeddings de posters.
+
+    Les vecteurs sont normalisés à l'insertion et stockés dans une matrice float32
+    contiguë ; un tableau parallèle garde l'identifiant du film de chaque ligne.
+    Une recherche se résume donc à un produit matrice-vecteur suivi d'un argpartition.
+    """
+
+    kind = "exact"
+
+    def __init__(self, dim=512, initial_capacity=1024):
+        super().__init__(dim)
+        self._matrix = np.zeros((initial_capacity, dim), dtype=np.float32)
+        self._ids = []
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, movie_id):
+        return str(movie_id) in self._positions
+
+    def _grow(self, needed):
+        capacity = self._matrix.shape[0]
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, capacity * 2)
+        matrix = np.zeros((new_capacity, self.dim), dtype=np.float32)
+        matrix[:len(self._ids)] = self._matrix[:len(self._ids)]
+        self._matrix = matrix
+
+    def add(self, movie_id, embedding):
+        """Ajoute ou remplace l'embedding d'un film."""
+        vector = normalize(embedding)
+        if vector is None or vector.shape[0] != self.dim:
+            self.remove(movie_id)
+            return False
+        movie_id = str(movie_id)
+        with self._lock:
+            row = self._positions.get(movie_id)
+            if row is None:
+                row = len(self._ids)
+                self._grow(row + 1)
+                self._ids.append(movie_id)
+                self._positions[movie_id] = row
+            self._matrix[row] = vector
+            self.version += 1
+        return True
+
+    def remove(self, movie_id):
+        """Retire un film de l'index (la dernière ligne vient combler le trou)."""
+        movie_id = str(movie_id)
+        with self._lock:
+            row = self._positions.pop(movie_id, None)
+            if row is None:
+                return False
+            last = len(self._ids) - 1
+            if row != last:
+                last_id = self._ids[last]
+                self._matrix[row] = self._matrix[last]
+                self._ids[row] = last_id
+                self._positions[last_id] = row
+            self._ids.pop()
+            self.version += 1
+        return True
+
+    def search(self, query_embedding, k=5, allowed=None):
+        """Retourne les k films les plus proches sous forme de liste (movie_id, similarité).
+
+        Si allowed (ensemble d'identifiants) est fourni, seules ces lignes sont comparées.
+        """
+        query = normalize(query_embedding)
+        if query is None or query.shape[0] != self.dim:
+            return []
+        with self._lock:
+            if allowed is None:
+                rows = None
+                scores = self._matrix[:len(self._ids)] @ query
+            else:
+                rows = np.array([self._positions[m] for m in map(str, allowed) if m in self._positions], dtype=np.int64)
+                scores = self._matrix[rows] @ query
+            size = len(scores)
+            if size == 0 or k <= 0:
+                return []
+            k = min(k, size)
+            if k < size:
+                top = np.argpartition(scores, -k)[-k:]
+            else:
+                top = np.arange(size)
+            top = top[np.argsort(scores[top])[::-1]]
+            if rows is None:
+                return [(self._ids[i], float(scores[i])) for i in top]
+            return [(self._ids[rows[i]], float(scores[i])) for i in top]
+
+    def _save_data(self, path):
+        np.savez(f"{path}.npz", matrix=self._matrix[:len(self._ids)], ids=np.array(self._ids))
+
+    def _load_data(self, path):
+        data = np.load(f"{path}.npz")
+        self._matrix = np.ascontiguousarray(data["matrix"], dtype=np.float32)
+        self._ids = [str(movie_id) for movie_id in data["ids"]]
+        self._positions = {movie_id: row for row, movie_id in enumerate(self._ids)}
+        self._grow(len(self._ids) + 1)
+        self.version += 1